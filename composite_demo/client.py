@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from collections.abc import Iterable
 import os
+import sys
 from typing import Any, Protocol
 
 from huggingface_hub.inference._text_generation import TextGenerationStreamResponse, Token
@@ -16,6 +17,8 @@ TOOL_PROMPT = 'Answer the following questions as best as you can. You have acces
 MODEL_PATH = os.environ.get('MODEL_PATH', 'THUDM/chatglm3-6b')
 PT_PATH = os.environ.get('PT_PATH', None)
 TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
+# tiny 或 echo 时使用 openai_api_demo/tiny_model.py 中的替身模型，不需要下载权重
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'chatglm')
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 # for Mac Computer like M1
@@ -133,6 +136,12 @@ def stream_chat(self, tokenizer, query: str, history: list[tuple[str, str]] = No
 class HFClient(Client):
     def __init__(self, model_path: str, tokenizer_path: str, pt_checkpoint: str | None = None, DEVICE = 'cpu'):
         self.model_path = model_path
+        if MODEL_BACKEND != 'chatglm':
+            sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'openai_api_demo'))
+            from model_backend import load_model
+            self.model, self.tokenizer = load_model(MODEL_BACKEND)
+            return
+
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
 
         if pt_checkpoint is not None:
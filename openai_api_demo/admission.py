@@ -0,0 +1,203 @@
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+# 请求的优先级：interactive 为交互式对话，优先保证首 token 时间；bulk 为批量生成章节，使用剩余的算力
+PRIORITIES = ("interactive", "bulk")
+
+
+class AdmissionRejected(Exception):
+    """
+    请求未被接收，status_code 为 429（队列已满）或 503（排队超时）
+
+    position 为 429 时请求会排到的位置、503 时超时那一刻在队列中的位置。
+    """
+
+    def __init__(self, status_code: int, message: str, retry_after: int, position: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+        self.position = position
+
+
+class Ticket:
+    """
+    已接收的请求，生成结束后交还给 AdmissionController.release
+
+    响应头在接收之后才发送，X-Queue-Position 是请求到达时在队列中的位置（0 表示没有排队）；
+    当前的排队长度见被拒绝响应的 X-Queue-Depth 和 writer_queued_requests 指标。
+    """
+
+    def __init__(self, tokens: int, position: int, waited: float, priority: str = "interactive"):
+        self.tokens = tokens
+        self.priority = priority
+        self.position = position
+        self.waited = waited
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "X-Queue-Position": str(self.position),
+            "X-Queue-Wait-Ms": str(int(self.waited * 1000)),
+        }
+
+
+class Waiter:
+    def __init__(self, tokens: int, future: asyncio.Future, priority: str = "interactive"):
+        self.tokens = tokens
+        self.future = future
+        self.priority = priority
+
+
+# 估算请求占用的 token 数：UTF-8 字节数的 1/3（中文约一字一个 token，英文偏多），每条消息另加 4 个
+def estimate_tokens(contents: List[str], max_tokens: int, prompt_ids: Optional[List[int]] = None) -> int:
+    if prompt_ids:
+        prompt_tokens = len(prompt_ids)
+    else:
+        prompt_tokens = sum(len(content.encode("utf-8")) // 3 + 4 for content in contents)
+    return prompt_tokens + max_tokens
+
+
+class AdmissionController:
+    """
+    推理请求的准入控制
+
+    同时生成的请求数和 token 数（prompt + max_tokens）都有上限，超出时排队，
+    interactive 请求排在所有 bulk 请求之前，同一优先级按先后顺序；
+    队列已满时立即返回 429，排队超过 timeout 秒返回 503，都带上 Retry-After。
+    preempt_bulk 为 True 时调度器可以抢占 bulk 序列，interactive 请求只和其他 interactive 请求竞争名额。
+    只在事件循环中使用，不需要加锁。
+    """
+
+    def __init__(self, max_inflight: int, max_queue: int, max_tokens: int = 0, timeout: float = 60.0,
+                 preempt_bulk: bool = False):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max_queue
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.preempt_bulk = preempt_bulk
+
+        self.inflight = 0
+        self.inflight_tokens = 0
+        self.inflight_by: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self.tokens_by: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self.waiters: Dict[str, Deque[Waiter]] = {priority: deque() for priority in PRIORITIES}
+        # 单个请求平均耗时（秒），用于估算 Retry-After
+        self.service_time = 10.0
+
+        # 统计信息
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+    # 排在 priority 请求前面的等待者数量
+    def _ahead(self, priority: str) -> int:
+        count = 0
+        for item in PRIORITIES:
+            count += len(self.waiters[item])
+            if item == priority:
+                break
+        return count
+
+    def _can_admit(self, tokens: int, priority: str) -> bool:
+        if priority == "interactive" and self.preempt_bulk:
+            inflight, used = self.inflight_by[priority], self.tokens_by[priority]
+        else:
+            inflight, used = self.inflight, self.inflight_tokens
+        if inflight >= self.max_inflight:
+            return False
+        return self.max_tokens <= 0 or used + tokens <= self.max_tokens
+
+    def _admit(self, tokens: int, priority: str) -> None:
+        self.inflight += 1
+        self.inflight_tokens += tokens
+        self.inflight_by[priority] += 1
+        self.tokens_by[priority] += tokens
+        self.admitted += 1
+
+    def _wake(self) -> None:
+        for priority in PRIORITIES:
+            waiters = self.waiters[priority]
+            while waiters and self._can_admit(waiters[0].tokens, priority):
+                waiter = waiters.popleft()
+                if waiter.future.done():
+                    continue
+                self._admit(waiter.tokens, priority)
+                waiter.future.set_result(None)
+            # 高优先级的请求还在排队时，不让低优先级的请求插队
+            if waiters:
+                return
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.service_time * (self.queued + 1) / self.max_inflight))
+
+    async def acquire(self, tokens: int, priority: str = "interactive") -> Ticket:
+        # 超过上限的单个请求按上限计算，保证它最终能单独执行
+        if self.max_tokens > 0:
+            tokens = min(tokens, self.max_tokens)
+
+        if not self._ahead(priority) and self._can_admit(tokens, priority):
+            self._admit(tokens, priority)
+            return Ticket(tokens, 0, 0.0, priority)
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(429, '请求过多，请稍后重试', self.retry_after(), self._ahead(priority) + 1)
+
+        waiter = Waiter(tokens, asyncio.get_running_loop().create_future(), priority)
+        waiters = self.waiters[priority]
+        position = self._ahead(priority) + 1
+        waiters.append(waiter)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                return Ticket(tokens, position, time.monotonic() - start, priority)
+            # 前面的请求可能已经离开队列，按超时时的位置返回
+            position = self._ahead(priority) - len(waiters) + waiters.index(waiter) + 1
+            waiters.remove(waiter)
+            self.timeouts += 1
+            raise AdmissionRejected(503, '排队超时，请稍后重试', self.retry_after(), position)
+        except asyncio.CancelledError:
+            # 客户端在排队时断开
+            if waiter in waiters:
+                waiters.remove(waiter)
+            elif waiter.future.done():
+                self._release(tokens, priority)
+            raise
+
+        return Ticket(tokens, position, time.monotonic() - start, priority)
+
+    def _release(self, tokens: int, priority: str) -> None:
+        self.inflight -= 1
+        self.inflight_tokens -= tokens
+        self.inflight_by[priority] -= 1
+        self.tokens_by[priority] -= tokens
+        self._wake()
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket.released:
+            return
+        ticket.released = True
+        elapsed = time.monotonic() - ticket.admitted_at
+        self.service_time = self.service_time * 0.9 + elapsed * 0.1
+        self._release(ticket.tokens, ticket.priority)
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "inflight_tokens": self.inflight_tokens,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from admission import estimate_tokens
+from executor import run_storage
+from storage import write_json, read_json
+
+# 批量任务中的请求地址，与 OpenAI Batch API 的 endpoint 一致
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 排队中的任务为 validating，处理中为 in_progress，其余为结束状态
+BATCH_STATUSES = ("validating", "in_progress", "cancelling", "completed", "failed", "cancelled")
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    id: str
+    object: str = "batch"
+    endpoint: str = BATCH_ENDPOINT
+    status: str
+    created_at: int
+    in_progress_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts
+    errors: Optional[str] = None
+
+
+class BatchList(BaseModel):
+    object: str = "list"
+    data: List[BatchObject]
+
+
+# 解析上传的 JSONL，每行为 {"custom_id", "method", "url", "body"}，body 与 /v1/chat/completions 的请求相同
+def parse_batch_input(text: str) -> List[dict]:
+    items, custom_ids = [], set()
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise Exception(f'第 {number} 行不是合法的 JSON')
+        if not isinstance(item, dict) or not isinstance(item.get("body"), dict):
+            raise Exception(f'第 {number} 行缺少 body')
+        custom_id = item.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            raise Exception(f'第 {number} 行缺少 custom_id')
+        if custom_id in custom_ids:
+            raise Exception(f'第 {number} 行的 custom_id 重复：{custom_id}')
+        if item.get("url", BATCH_ENDPOINT) != BATCH_ENDPOINT or str(item.get("method", "POST")).upper() != "POST":
+            raise Exception(f'第 {number} 行只支持 POST {BATCH_ENDPOINT}')
+        custom_ids.add(custom_id)
+        items.append(item)
+    if not items:
+        raise Exception('批量任务中没有请求')
+    return items
+
+
+# 估算请求的 prompt token 数，用于按长度排序
+def prompt_length(item: dict) -> int:
+    messages = item["body"].get("messages") or []
+    return estimate_tokens([str(message.get("content") or "") for message in messages
+                            if isinstance(message, dict)], 0)
+
+
+class BatchJobs:
+    """
+    离线批量任务
+
+    上传的 JSONL 保存在 path/<batch_id>/input.jsonl，任务按提交顺序逐个处理。
+    请求按 prompt 长度从长到短排序，同时发出 concurrency 个，填满调度器的批次；
+    每完成一个请求就在 output.jsonl 追加一行，服务重启后跳过已经完成的 custom_id，从断点继续。
+    """
+
+    def __init__(self, path: str, run_request: Callable[[dict], Awaitable[dict]], concurrency: int):
+        self.path = path
+        self.run_request = run_request
+        self.concurrency = max(1, concurrency)
+        self.batches: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.current: Optional[str] = None
+        self.workers: List[asyncio.Task] = []
+
+    def _file(self, batch_id: str, name: str) -> str:
+        return os.path.join(self.path, batch_id, name)
+
+    def _load(self) -> List[dict]:
+        os.makedirs(self.path, exist_ok=True)
+        batches = []
+        for batch_id in os.listdir(self.path):
+            batch = read_json(self._file(batch_id, 'batch.json'))
+            if batch is not None:
+                batches.append(batch)
+        return sorted(batches, key=lambda batch: batch["created_at"])
+
+    def _save(self, batch: dict) -> None:
+        write_json(self._file(batch["id"], 'batch.json'), batch)
+
+    def _create(self, batch: dict, text: str) -> None:
+        os.makedirs(os.path.join(self.path, batch["id"]), exist_ok=True)
+        with open(self._file(batch["id"], 'input.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(text)
+        self._save(batch)
+
+    # 加载已有的任务，未结束的任务重新排队
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        for batch in await run_storage(self._load):
+            self.batches[batch["id"]] = batch
+            if batch["status"] == "cancelling":
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                await run_storage(self._save, batch)
+            elif batch["status"] not in FINAL_STATUSES:
+                self.queue.put_nowait(batch["id"])
+        self.task = asyncio.ensure_future(self._run())
+
+    # 停止处理，进行中的任务保持 in_progress，下次启动时继续
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def create(self, text: str) -> dict:
+        if self.queue is None:
+            raise Exception('批量任务未启动')
+        items = parse_batch_input(text)
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": BATCH_ENDPOINT,
+            "status": "validating",
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(items), "completed": 0, "failed": 0},
+        }
+        await run_storage(self._create, batch, text)
+        self.batches[batch["id"]] = batch
+        self.queue.put_nowait(batch["id"])
+        return batch
+
+    def get(self, batch_id: str) -> Optional[dict]:
+        return self.batches.get(batch_id)
+
+    def list(self) -> List[dict]:
+        return sorted(self.batches.values(), key=lambda batch: batch["created_at"], reverse=True)
+
+    def output_path(self, batch_id: str) -> str:
+        return self._file(batch_id, 'output.jsonl')
+
+    # 读取目前完成的输出，持有锁时不会读到写了一半的行
+    def read_output(self, batch_id: str) -> str:
+        with self.lock:
+            if not os.path.exists(self.output_path(batch_id)):
+                return ''
+            with open(self.output_path(batch_id), 'r', encoding='utf-8') as f:
+                return f.read()
+
+    async def cancel(self, batch_id: str) -> Optional[dict]:
+        batch = self.batches.get(batch_id)
+        if batch is None or batch["status"] in FINAL_STATUSES:
+            return batch
+        if batch_id != self.current:
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+            await run_storage(self._save, batch)
+            return batch
+
+        # 正在处理的任务先保存状态再停止进行中的请求，已经完成的输出保留
+        batch["status"] = "cancelling"
+        await run_storage(self._save, batch)
+        for worker in self.workers:
+            worker.cancel()
+        return batch
+
+    def stats(self) -> dict:
+        result = {(("status", status),): 0 for status in BATCH_STATUSES}
+        for batch in self.batches.values():
+            result[(("status", batch["status"]),)] += 1
+        return result
+
+    async def _run(self) -> None:
+        while True:
+            batch_id = await self.queue.get()
+            batch = self.batches[batch_id]
+            if batch["status"] in FINAL_STATUSES:
+                continue
+            self.current = batch_id
+            try:
+                await self._process(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+                batch.update(status="failed", failed_at=int(time.time()), errors=str(e))
+                await run_storage(self._save, batch)
+            finally:
+                self.current = None
+
+    # 读取已完成的输出，截掉写到一半的最后一行，返回还没有完成的请求
+    def _pending(self, batch: dict) -> List[dict]:
+        with open(self._file(batch["id"], 'input.jsonl'), 'r', encoding='utf-8') as f:
+            items = parse_batch_input(f.read())
+
+        done: Dict[str, bool] = {}
+        output_path = self.output_path(batch["id"])
+        if os.path.exists(output_path):
+            with open(output_path, 'rb+') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    done[result["custom_id"]] = result.get("error") is None
+                    offset += len(line)
+                f.truncate(offset)
+
+        completed = sum(done.values())
+        batch["request_counts"] = {"total": len(items), "completed": completed, "failed": len(done) - completed}
+        pending = [item for item in items if item["custom_id"] not in done]
+        # 从长到短处理：长请求先开始，最后不会只剩一个长请求在解码；相邻请求的长度接近，补齐的位置少
+        pending.sort(key=prompt_length, reverse=True)
+        return pending
+
+    def _append(self, batch_id: str, result: dict) -> None:
+        line = json.dumps(result, ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.output_path(batch_id), 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    async def _execute(self, item: dict) -> dict:
+        result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"],
+                  "response": None, "error": None}
+        try:
+            body = await self.run_request(item["body"])
+            result["response"] = {"status_code": 200, "body": body}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result["error"] = {"code": "request_failed", "message": str(e)}
+        return result
+
+    async def _process(self, batch: dict) -> None:
+        pending = await run_storage(self._pending, batch)
+        if batch["status"] == "validating":
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+        await run_storage(self._save, batch)
+
+        items = iter(pending)
+        counts = batch["request_counts"]
+
+        async def worker():
+            for item in items:
+                if batch["status"] != "in_progress":
+                    break
+                result = await self._execute(item)
+                await run_storage(self._append, batch["id"], result)
+                counts["failed" if result["error"] else "completed"] += 1
+
+        self.workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            # 取消任务时 worker 被取消，结果中是 CancelledError；服务停止时这里抛出 CancelledError
+            results = await asyncio.gather(*self.workers, return_exceptions=True)
+        finally:
+            for worker in self.workers:
+                worker.cancel()
+            self.workers = []
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+        else:
+            batch.update(status="completed", completed_at=int(time.time()))
+        await run_storage(self._save, batch)
@@ -0,0 +1,89 @@
+# 对比每步全量解码与增量解码的单 token 开销，增量解码的开销不随输出长度增长
+# Usage: python benchmark_detokenizer.py [--tokens 4096]
+# 设置 TOKENIZER_PATH 时使用 ChatGLM3 的分词器，否则使用 tiny_model 中的字节级分词器
+import os
+import json
+import time
+import random
+import argparse
+
+from utils import IncrementalDetokenizer
+from tiny_model import TinyChatTokenizer
+
+TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH")
+
+
+def load_tokenizer():
+    if TOKENIZER_PATH:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
+    return TinyChatTokenizer()
+
+
+def sample_ids(tokenizer, num_tokens: int):
+    text = "".join(random.choice("夜色里他推开门，看见了雨中的灯火。The rain kept falling. ")
+                   for _ in range(num_tokens * 2))
+    ids = tokenizer.encode(text)
+    # ChatGLM3 的 encode 会加上 [gMASK] sop
+    ids = [i for i in ids if i not in (tokenizer.get_command("[gMASK]"), tokenizer.get_command("sop"))]
+    return ids[:num_tokens]
+
+
+def full_decode(tokenizer, ids, buckets):
+    # 原来的做法：每一步都解码全部输出
+    timings, output_ids, previous_text = {}, [], ""
+    start = time.perf_counter()
+    for i, token_id in enumerate(ids, 1):
+        output_ids.append(token_id)
+        response = tokenizer.decode(output_ids)
+        if response and response[-1] != "�":
+            delta = response[len(previous_text):]
+            previous_text = response
+        if i in buckets:
+            timings[i] = time.perf_counter() - start
+    return timings, previous_text
+
+
+def incremental_decode(tokenizer, ids, buckets):
+    timings, detokenizer = {}, IncrementalDetokenizer(tokenizer)
+    start = time.perf_counter()
+    for i, token_id in enumerate(ids, 1):
+        detokenizer.add(token_id)
+        if i in buckets:
+            timings[i] = time.perf_counter() - start
+    detokenizer.flush()
+    return timings, detokenizer.text
+
+
+def per_token_us(timings, buckets):
+    # 每个区间内平均每个 token 的耗时（微秒）
+    result, previous_len, previous_time = {}, 0, 0.0
+    for bucket in buckets:
+        result[bucket] = round((timings[bucket] - previous_time) / (bucket - previous_len) * 1e6, 2)
+        previous_len, previous_time = bucket, timings[bucket]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    random.seed(0)
+    tokenizer = load_tokenizer()
+    ids = sample_ids(tokenizer, args.tokens)
+    buckets = [n for n in (256, 512, 1024, 2048, 4096, 8192) if n < len(ids)] + [len(ids)]
+
+    full_timings, full_text = full_decode(tokenizer, ids, buckets)
+    incremental_timings, incremental_text = incremental_decode(tokenizer, ids, buckets)
+
+    print(json.dumps({
+        "tokens": len(ids),
+        "same_text": full_text == incremental_text,
+        "full_decode_us_per_token": per_token_us(full_timings, buckets),
+        "incremental_us_per_token": per_token_us(incremental_timings, buckets),
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
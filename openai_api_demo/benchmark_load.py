@@ -0,0 +1,447 @@
+# 按配置的请求组合压测 openai_api.py：对话、流式对话、工具调用、书籍增删改查、会话追加消息
+# 按固定并发（--concurrency）或固定到达速率（--rate，泊松到达）发送请求，结果以 JSON 输出，
+# 包含每类请求的 p50/p95/p99 延迟、首 token 时间、token 间隔、生成速度和错误率，便于对比调度器和存储的改动。
+#
+# Usage:
+#   python benchmark_load.py --serve echo --requests 200 --concurrency 8
+#   python benchmark_load.py --url http://127.0.0.1:8600 --rate 4 --duration 60 --mix chat=2,stream=4,session=2
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+
+SCENARIOS = ("chat", "stream", "function", "books", "session")
+DEFAULT_MIX = "chat=3,stream=4,function=1,books=1,session=1"
+
+SYSTEM_PROMPT = "You are ChatGLM3, a large language model trained by Zhipu.AI. Follow the user's instructions carefully. Respond using markdown."
+QUERIES = [
+    "你好，给我讲一个故事，大概100字",
+    "续写下面的故事：夜色里他推开门，看见了雨中的灯火。",
+    "为一部都市悬疑小说起五个书名",
+    "用三句话概括这一章的主要情节",
+    "Describe the detective's office in a rainy night.",
+]
+FUNCTIONS = [
+    {
+        "name": "get_chapter_summary",
+        "description": "获取指定章节的摘要",
+        "parameters": {
+            "type": "object",
+            "properties": {"chapter": {"type": "string", "description": "章节标题"}},
+            "required": ["chapter"],
+        },
+    },
+]
+# 会话追加多少轮后删除并重建，避免历史无限增长
+SESSION_TURNS = 8
+
+
+class Result:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.status = 0
+        self.error: Optional[str] = None
+        self.latency = 0.0
+        self.ttft: Optional[float] = None
+        self.itl: List[float] = []
+        self.completion_tokens = 0
+        self.body = None
+        # function 请求是否返回了工具调用
+        self.function_call: Optional[bool] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and 200 <= self.status < 300
+
+
+# 计算 p50/p95/p99，scale 为单位换算，延迟默认转换为毫秒
+def percentiles(values: List[float], scale: float = 1000) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q: float) -> float:
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    return {
+        "p50": round(pick(0.50) * scale, 2),
+        "p95": round(pick(0.95) * scale, 2),
+        "p99": round(pick(0.99) * scale, 2),
+        "mean": round(sum(values) / len(values) * scale, 2),
+        "max": round(values[-1] * scale, 2),
+    }
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise Exception(f'不支持的请求类型：{name}，可选 {",".join(SCENARIOS)}')
+        weights[name] = float(weight or 1)
+    if not weights or sum(weights.values()) <= 0:
+        raise Exception('请求组合为空')
+    return weights
+
+
+class LoadGenerator:
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.weights = parse_mix(args.mix)
+        self.results: List[Result] = []
+        # 空闲的会话：(session_id, 已追加的轮数)，同一会话同时只被一个请求使用
+        self.sessions: List[list] = []
+        self.session_ids: List[str] = []
+        # 已经被使用过的书籍 id，包括压测开始前就存在的书籍
+        self.book_ids = set()
+
+    def choose(self) -> str:
+        names = list(self.weights)
+        return self.random.choices(names, weights=[self.weights[name] for name in names])[0]
+
+    def chat_body(self, messages: List[dict], stream: bool = False, **kwargs) -> dict:
+        return dict(
+            model=self.args.model,
+            messages=messages,
+            stream=stream,
+            max_tokens=self.args.max_tokens,
+            temperature=self.args.temperature,
+            top_p=0.8,
+            **kwargs,
+        )
+
+    def messages(self) -> List[dict]:
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": self.random.choice(QUERIES)},
+        ]
+
+    async def request(self, kind: str, method: str, path: str, **kwargs) -> Result:
+        result = Result(kind)
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            result.status = response.status_code
+            body = response.json() if response.content else {}
+            if result.ok and isinstance(body, dict):
+                usage = body.get("usage") or {}
+                result.completion_tokens = usage.get("completion_tokens", 0)
+                if body.get("success") is False:
+                    result.error = body.get("message") or "success=false"
+            result.body = body
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+        result.latency = time.perf_counter() - start
+        return result
+
+    async def chat(self) -> List[Result]:
+        return [await self.request("chat", "POST", "/v1/chat/completions", json=self.chat_body(self.messages()))]
+
+    async def stream(self) -> List[Result]:
+        result = Result("stream")
+        body = self.chat_body(self.messages(), stream=True)
+        start = last = time.perf_counter()
+        try:
+            async with self.client.stream("POST", "/v1/chat/completions", json=body) as response:
+                result.status = response.status_code
+                if not result.ok:
+                    await response.aread()
+                else:
+                    # 服务端每个 chunk 对应一个或多个 token（开启合并时），这里按 chunk 计数
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        delta = json.loads(data)["choices"][0]["delta"]
+                        if not delta.get("content"):
+                            continue
+                        now = time.perf_counter()
+                        if result.ttft is None:
+                            result.ttft = now - start
+                        else:
+                            result.itl.append(now - last)
+                        last = now
+                        result.completion_tokens += 1
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+        result.latency = time.perf_counter() - start
+        return [result]
+
+    async def function(self) -> List[Result]:
+        messages = [{"role": "user", "content": "调用 get_chapter_summary 获取第一章的摘要"}]
+        # 工具调用要完整生成才能解析，max_tokens 至少为 256
+        body = self.chat_body(messages, functions=FUNCTIONS)
+        body["max_tokens"] = max(body["max_tokens"], 256)
+        result = await self.request("function", "POST", "/v1/chat/completions", json=body)
+        if result.ok:
+            result.function_call = result.body["choices"][0]["finish_reason"] == "function_call"
+        return [result]
+
+    async def books(self) -> List[Result]:
+        # 一次完整的书籍增删改查：创建、修改、添加章节、读取章节、目录分页、删除
+        results = []
+        created = await self.request("books.create", "POST", "/v1/books")
+        results.append(created)
+        if not created.ok:
+            return results
+        # 并发创建时列表中可能有其他请求新建的书籍，取一本还没被使用的即可
+        fresh = [item for item in created.body["data"] if item["id"] not in self.book_ids]
+        if not fresh:
+            created.error = "新建的书籍不在列表中"
+            return results
+        book = fresh[-1]
+        book_id = book["id"]
+        self.book_ids.add(book_id)
+        book.update(title=f"压测书籍{self.random.randint(0, 1 << 30)}", description="雨夜里的一桩旧案")
+        results.append(await self.request("books.update", "PUT", f"/v1/books/{book_id}", json=book))
+        chapter = dict(title="第一章", description="开端", content="夜色里他推开门，看见了雨中的灯火。" * 20)
+        added = await self.request("books.chapter_create", "POST", f"/v1/books/{book_id}/chapters", json=chapter)
+        results.append(added)
+        if added.ok:
+            chapters = next(item for item in added.body["data"] if item["id"] == book_id)["chapters"]
+            if chapters:
+                results.append(await self.request(
+                    "books.chapter_get", "GET", f"/v1/books/{book_id}/chapters/{chapters[-1]['id']}"))
+        results.append(await self.request("books.catalog", "GET", "/v1/books/catalog", params={"limit": 20}))
+        results.append(await self.request("books.delete", "DELETE", f"/v1/books/{book_id}"))
+        return results
+
+    async def session(self) -> List[Result]:
+        results = []
+        if self.sessions:
+            item = self.sessions.pop()
+        else:
+            created = await self.request("session.create", "POST", "/v1/sessions")
+            results.append(created)
+            if not created.ok:
+                return results
+            session_id = created.body["data"][-1]["id"]
+            self.session_ids.append(session_id)
+            item = [session_id, 0]
+
+        session_id = item[0]
+        messages = [{"role": "user", "content": self.random.choice(QUERIES)}]
+        if item[1] == 0:
+            messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+        results.append(await self.request("session.append", "POST", "/v1/chat/completions",
+                                          json=self.chat_body(messages, session_id=session_id)))
+        item[1] += 1
+        if item[1] >= SESSION_TURNS:
+            self.session_ids.remove(session_id)
+            results.append(await self.request("session.delete", "DELETE", f"/v1/sessions/{session_id}"))
+        else:
+            self.sessions.append(item)
+        return results
+
+    async def run_one(self) -> None:
+        kind = self.choose()
+        self.results.extend(await getattr(self, kind)())
+
+    async def run(self) -> float:
+        args = self.args
+        if "books" in self.weights:
+            response = await self.client.get("/v1/books")
+            self.book_ids.update(item["id"] for item in response.json()["data"])
+        start = time.perf_counter()
+        deadline = start + args.duration if args.duration else None
+        remaining = [args.requests]
+
+        def more() -> bool:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            if args.requests and remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+        if args.rate:
+            # 开环：按泊松过程发送请求，不等待前面的请求完成
+            tasks = set()
+            limit = asyncio.Semaphore(args.max_outstanding)
+
+            async def guarded():
+                async with limit:
+                    await self.run_one()
+
+            while more():
+                task = asyncio.create_task(guarded())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await asyncio.sleep(self.random.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+        else:
+            # 闭环：concurrency 个客户端，各自收到响应后立即发送下一个请求
+            async def worker():
+                while more():
+                    await self.run_one()
+
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        return time.perf_counter() - start
+
+    async def cleanup(self) -> None:
+        for session_id in self.session_ids:
+            try:
+                await self.client.delete(f"/v1/sessions/{session_id}")
+            except Exception:
+                pass
+
+
+def summarize(results: List[Result], elapsed: float) -> dict:
+    def stats(items: List[Result]) -> dict:
+        ok = [item for item in items if item.ok]
+        statuses: Dict[str, int] = {}
+        for item in items:
+            key = str(item.status) if item.status else "exception"
+            statuses[key] = statuses.get(key, 0) + 1
+        tokens = sum(item.completion_tokens for item in ok)
+        rates = [item.completion_tokens / item.latency for item in ok if item.completion_tokens and item.latency > 0]
+        summary = {
+            "requests": len(items),
+            "errors": len(items) - len(ok),
+            "error_rate": round((len(items) - len(ok)) / len(items), 4) if items else 0,
+            "statuses": statuses,
+            "latency_ms": percentiles([item.latency for item in ok]),
+        }
+        if tokens:
+            summary["completion_tokens"] = tokens
+            summary["tokens_per_second"] = percentiles(rates, scale=1)
+        # 只有流式请求有首 token 时间和 token 间隔
+        ttft = [item.ttft for item in ok if item.ttft is not None]
+        if ttft:
+            summary["ttft_ms"] = percentiles(ttft)
+            summary["inter_token_latency_ms"] = percentiles([gap for item in ok for gap in item.itl])
+        calls = [item for item in ok if item.function_call is not None]
+        if calls:
+            summary["function_call_rate"] = round(sum(item.function_call for item in calls) / len(calls), 4)
+        errors = sorted({item.error for item in items if item.error})
+        if errors:
+            summary["error_samples"] = errors[:5]
+        return summary
+
+    kinds = sorted({item.kind for item in results})
+    total = stats(results)
+    generated = sum(item.completion_tokens for item in results if item.ok)
+    return {
+        "seconds": round(elapsed, 3),
+        "requests": len(results),
+        "requests_per_second": round(len(results) / elapsed, 2) if elapsed else 0,
+        "output_tokens_per_second": round(generated / elapsed, 2) if elapsed else 0,
+        "errors": total["errors"],
+        "error_rate": total["error_rate"],
+        "statuses": total["statuses"],
+        "by_kind": {kind: stats([item for item in results if item.kind == kind]) for kind in kinds},
+    }
+
+
+# 启动一个本地服务：在临时目录中运行，书籍和会话数据不会写入仓库
+def start_server(backend: str, env: Dict[str, str], url: str, timeout: float = 600) -> subprocess.Popen:
+    workdir = tempfile.mkdtemp(prefix="writer-bench-")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai_api.py")
+    process = subprocess.Popen(
+        [sys.executable, script], cwd=workdir,
+        env=dict(os.environ, MODEL_BACKEND=backend, **env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f'服务启动失败，退出码 {process.returncode}')
+        try:
+            if httpx.get(f"{url}/v1/models", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise Exception('服务启动超时')
+
+
+async def run(args: argparse.Namespace) -> dict:
+    limits = httpx.Limits(max_connections=max(args.concurrency, args.max_outstanding))
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        generator = LoadGenerator(client, args)
+        if args.warmup:
+            warmup = argparse.Namespace(**dict(vars(args), requests=args.warmup, duration=0, rate=0))
+            generator_warmup = LoadGenerator(client, warmup)
+            await generator_warmup.run()
+            await generator_warmup.cleanup()
+        elapsed = await generator.run()
+        await generator.cleanup()
+
+        report = summarize(generator.results, elapsed)
+        try:
+            response = await client.get("/metrics")
+            if response.status_code == 200:
+                report["server_metrics"] = [line for line in response.text.splitlines()
+                                            if line.startswith(("writer_requests_total", "writer_prefix_cache"))]
+        except httpx.HTTPError:
+            pass
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8600")
+    parser.add_argument("--serve", choices=["tiny", "echo", "chatglm"], default=None,
+                        help="先在本地启动服务（端口 8600），chatglm 使用 MODEL_PATH 指定的权重")
+    parser.add_argument("--scheduler", default=None, help="--serve 时传给服务的 SCHEDULER")
+    parser.add_argument("--storage", default=None, help="--serve 时传给服务的 STORAGE_BACKEND")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="请求类型及权重，如 chat=3,stream=4,books=1")
+    parser.add_argument("--requests", type=int, default=200, help="按 --mix 抽取的请求数（书籍、会话请求包含多次 HTTP 调用），0 表示只按 --duration 限制")
+    parser.add_argument("--duration", type=float, default=0, help="压测时长（秒），0 表示不限制")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="每秒到达的请求数，设置后忽略 --concurrency")
+    parser.add_argument("--max-outstanding", type=int, default=256, help="--rate 模式下同时进行的最多请求数")
+    parser.add_argument("--warmup", type=int, default=0, help="正式压测前的预热请求数，不计入结果")
+    parser.add_argument("--model", default="chatglm3-6b")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="结果写入的 JSON 文件")
+    args = parser.parse_args()
+
+    if not args.requests and not args.duration:
+        parser.error("--requests 和 --duration 至少指定一个")
+    parse_mix(args.mix)
+
+    process = None
+    if args.serve:
+        env = {}
+        if args.scheduler:
+            env["SCHEDULER"] = args.scheduler
+        if args.storage:
+            env["STORAGE_BACKEND"] = args.storage
+        process = start_server(args.serve, env, args.url)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+    text = json.dumps(report, indent=4, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
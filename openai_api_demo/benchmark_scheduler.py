@@ -0,0 +1,68 @@
+# 对比连续批处理调度器与逐个请求生成的吞吐量
+# Usage: python benchmark_scheduler.py --requests 32 --batch-size 8 --max-tokens 64
+import json
+import time
+import asyncio
+import argparse
+
+import torch
+
+from engine import GenerationEngine
+from openai_api import ChatMessage
+from tiny_model import load_tiny_model
+
+
+def build_params(i: int, max_tokens: int) -> dict:
+    return dict(
+        messages=[ChatMessage(role="user", content=f"第{i}章，续写下面的故事：" + "夜色" * (i % 7 + 1))],
+        temperature=0.0,
+        top_p=0.8,
+        max_tokens=max_tokens,
+        echo=False,
+        repetition_penalty=1.1,
+        functions=None,
+    )
+
+
+async def run(engine: GenerationEngine, num_requests: int, max_tokens: int) -> dict:
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[engine.generate(build_params(i, max_tokens))
+                                       for i in range(num_requests)])
+    elapsed = time.perf_counter() - start
+    completion_tokens = sum(item["usage"]["completion_tokens"] for item in responses)
+    return {
+        "max_batch_size": engine.max_batch_size,
+        "requests": num_requests,
+        "completion_tokens": completion_tokens,
+        "seconds": round(elapsed, 3),
+        "tokens_per_second": round(completion_tokens / elapsed, 1),
+        "decode_steps": engine.steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, torch.get_num_threads()))
+    model, tokenizer = load_tiny_model(
+        hidden_size=args.hidden_size, num_layers=args.layers)
+
+    # max_batch_size=1 时调度器每次只处理一个请求，等价于原来逐个生成的方式
+    results = {}
+    for name, batch_size in (("serial", 1), ("batch", args.batch_size)):
+        engine = GenerationEngine(model, tokenizer, max_batch_size=batch_size)
+        results[name] = asyncio.run(run(engine, args.requests, args.max_tokens))
+
+    results["speedup"] = round(
+        results["batch"]["tokens_per_second"] / results["serial"]["tokens_per_second"], 2)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
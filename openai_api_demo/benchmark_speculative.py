@@ -0,0 +1,92 @@
+# 对比普通解码与推测解码（提示词查找、小模型起草）的单请求生成速度和草稿接受率
+# Usage: python benchmark_speculative.py --requests 8 --max-tokens 128 --speculative-tokens 4
+import json
+import time
+import asyncio
+import argparse
+
+import torch
+
+from engine import GenerationEngine
+from openai_api import ChatMessage
+from speculative import PromptLookupDrafter, DraftModelDrafter
+from tiny_model import load_tiny_model, load_echo_model
+
+# 改写类的请求，回复大量重复上下文中的句子
+PASSAGE = "夜色渐深，山路上只剩下马蹄声。少年握紧缰绳，回头望了一眼远处的灯火，那是他离开的小镇。"
+
+
+def build_params(i: int, max_tokens: int) -> dict:
+    return dict(
+        messages=[ChatMessage(role="user", content=f"请润色第{i}段，保留原有的情节：" + PASSAGE * (i % 3 + 1))],
+        temperature=0.0,
+        top_p=0.8,
+        max_tokens=max_tokens,
+        echo=False,
+        repetition_penalty=1.1,
+        functions=None,
+    )
+
+
+# 请求逐个发送，每次只有一个序列在解码，测的是单请求的延迟
+async def run(engine: GenerationEngine, num_requests: int, max_tokens: int) -> dict:
+    texts, completion_tokens = [], 0
+    start = time.perf_counter()
+    for i in range(num_requests):
+        response = await engine.generate(build_params(i, max_tokens))
+        texts.append(response["text"])
+        completion_tokens += response["usage"]["completion_tokens"]
+    elapsed = time.perf_counter() - start
+    return {
+        "completion_tokens": completion_tokens,
+        "seconds": round(elapsed, 3),
+        "tokens_per_second": round(completion_tokens / elapsed, 1),
+        "decode_steps": engine.steps,
+        "draft_tokens": engine.draft_tokens,
+        "accepted_tokens": engine.accepted_tokens,
+        "acceptance_rate": round(engine.accepted_tokens / engine.draft_tokens, 3) if engine.draft_tokens else None,
+        "texts": texts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=("tiny", "echo"), default="tiny")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--speculative-tokens", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    # 草稿模型与主模型同为随机初始化的小模型，参数相同时等价于草稿全部被接受的上限
+    parser.add_argument("--draft-hidden-size", type=int, default=64)
+    parser.add_argument("--draft-layers", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, torch.get_num_threads()))
+    if args.backend == "tiny":
+        model, tokenizer = load_tiny_model(hidden_size=args.hidden_size, num_layers=args.layers)
+    else:
+        model, tokenizer = load_echo_model()
+    draft_model, _ = load_tiny_model(hidden_size=args.draft_hidden_size, num_layers=args.draft_layers)
+
+    results = {}
+    for name, drafter in (("baseline", None),
+                          ("prompt_lookup", PromptLookupDrafter()),
+                          ("draft_model", DraftModelDrafter(draft_model))):
+        engine = GenerationEngine(model, tokenizer, max_batch_size=1,
+                                  drafter=drafter, speculative_tokens=args.speculative_tokens)
+        results[name] = asyncio.run(run(engine, args.requests, args.max_tokens))
+
+    # 贪心解码时推测解码的输出应与普通解码完全相同
+    baseline = results["baseline"]
+    for name in ("prompt_lookup", "draft_model"):
+        result = results[name]
+        result["outputs_match"] = result["texts"] == baseline["texts"]
+        result["speedup"] = round(result["tokens_per_second"] / baseline["tokens_per_second"], 2)
+    for result in results.values():
+        del result["texts"]
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
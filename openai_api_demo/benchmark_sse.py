@@ -0,0 +1,70 @@
+# 对比逐 token 构造 pydantic 对象与 ChunkEncoder 拼接字符串编码 chunk 的速度
+# Usage: python benchmark_sse.py [--chunks 200000]
+import json
+import time
+import random
+import argparse
+
+from openai_api import ChatCompletionResponse, ChatCompletionResponseStreamChoice, DeltaMessage
+from stream_encoder import ChunkEncoder
+
+
+def sample_deltas(num_chunks: int):
+    alphabet = "夜色里他推开门，看见了雨中的灯火。The \"rain\" kept falling.\n\\"
+    return ["".join(random.choice(alphabet) for _ in range(random.randint(1, 4))) for _ in range(num_chunks)]
+
+
+def pydantic_chunks(model_id: str, deltas):
+    # 原来 predict 中的做法
+    for delta_text in deltas:
+        choice_data = ChatCompletionResponseStreamChoice(
+            index=0,
+            delta=DeltaMessage(content=delta_text, role="assistant", function_call=None),
+            finish_reason=None
+        )
+        chunk = ChatCompletionResponse(model=model_id, choices=[
+                                       choice_data], object="chat.completion.chunk")
+        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+
+
+def encoder_chunks(model_id: str, deltas):
+    encoder = ChunkEncoder(model_id)
+    for delta_text in deltas:
+        yield encoder.content(delta_text)
+
+
+def measure(func, model_id: str, deltas) -> float:
+    start = time.perf_counter()
+    for _ in func(model_id, deltas):
+        pass
+    return len(deltas) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=200000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    model_id = "chatglm3-6b"
+    deltas = sample_deltas(args.chunks)
+
+    # 两种编码解析后的 delta 和 finish_reason 一致
+    same = all(
+        json.loads(a)["choices"] == [dict(json.loads(b)["choices"][0], delta=dict(
+            json.loads(b)["choices"][0]["delta"], function_call=None))]
+        for a, b in zip(pydantic_chunks(model_id, deltas[:1000]), encoder_chunks(model_id, deltas[:1000])))
+
+    pydantic_rate = measure(pydantic_chunks, model_id, deltas)
+    encoder_rate = measure(encoder_chunks, model_id, deltas)
+    print(json.dumps({
+        "chunks": len(deltas),
+        "same_choices": same,
+        "pydantic_chunks_per_second": round(pydantic_rate),
+        "encoder_chunks_per_second": round(encoder_rate),
+        "speedup": round(encoder_rate / pydantic_rate, 2),
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,795 @@
+import time
+import asyncio
+import inspect
+import threading
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from transformers import PreTrainedModel, PreTrainedTokenizer
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from admission import PRIORITIES
+from metrics import STAGE_SECONDS, PREEMPTIONS, SPECULATIVE_TOKENS
+from utils import IncrementalDetokenizer, InvalidScoreLogitsProcessor, StopStringMatcher, get_stop_strings, process_chatglm_messages
+
+# 每层的 (key, value)
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+class ModelRunner:
+    """
+    对模型前向计算和 past_key_values 的封装
+
+    ChatGLM3 的 past_key_values 是 tuple 格式，形状为 [seq, batch, heads, dim]；
+    transformers 自带的模型使用 Cache 对象，形状为 [batch, heads, seq, dim]。
+    调度器只通过这里的方法操作 KV，不关心具体格式。
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        self.model = model
+        self.legacy_kv = getattr(model.config, 'model_type', '') == 'chatglm'
+        self.seq_dim, self.batch_dim = (0, 1) if self.legacy_kv else (2, 0)
+
+        # 只计算最后一个位置的 logits，避免长 prompt 预填充时生成 [seq, vocab] 的大张量
+        params = inspect.signature(model.forward).parameters
+        if 'return_last_logit' in params:
+            self.last_logit_kwargs = {'return_last_logit': True}
+        elif 'logits_to_keep' in params:
+            self.last_logit_kwargs = {'logits_to_keep': 1}
+        elif 'num_logits_to_keep' in params:
+            self.last_logit_kwargs = {'num_logits_to_keep': 1}
+        else:
+            self.last_logit_kwargs = {}
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @property
+    def seq_length(self) -> int:
+        config = self.model.config
+        return getattr(config, 'seq_length', None) or getattr(config, 'max_position_embeddings', 8192)
+
+    def pack(self, layers: Optional[KVLayers]):
+        if not layers or self.legacy_kv:
+            return tuple(layers) if layers else None
+
+        from transformers import DynamicCache
+        if hasattr(DynamicCache, 'from_legacy_cache'):
+            return DynamicCache.from_legacy_cache(tuple(layers))
+        return DynamicCache(ddp_cache_data=layers)
+
+    def unpack(self, past) -> KVLayers:
+        if hasattr(past, 'layers'):
+            return [(layer.keys, layer.values) for layer in past.layers]
+        if hasattr(past, 'key_cache'):
+            return list(zip(past.key_cache, past.value_cache))
+        return [(k, v) for k, v in past]
+
+    @torch.inference_mode()
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor,
+                layers: Optional[KVLayers] = None, last_only: bool = True) -> Tuple[torch.Tensor, KVLayers]:
+        kwargs = self.last_logit_kwargs if last_only else {}
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.pack(layers),
+            use_cache=True,
+            return_dict=True,
+            **kwargs,
+        )
+        logits = outputs.logits
+        # ChatGLM3 的 logits 形状与输入一致为 [batch, seq, vocab]
+        return logits, self.unpack(outputs.past_key_values)
+
+    def kv_length(self, layers: KVLayers) -> int:
+        return layers[0][0].shape[self.seq_dim] if layers else 0
+
+    def kv_pad_left(self, layers: KVLayers, length: int) -> KVLayers:
+        pad = length - self.kv_length(layers)
+        if pad <= 0:
+            return layers
+
+        def pad_tensor(tensor):
+            shape = list(tensor.shape)
+            shape[self.seq_dim] = pad
+            return torch.cat((tensor.new_zeros(shape), tensor), dim=self.seq_dim)
+
+        return [(pad_tensor(k), pad_tensor(v)) for k, v in layers]
+
+    def kv_cat_seq(self, items: List[KVLayers]) -> KVLayers:
+        if len(items) == 1:
+            return items[0]
+        return [(torch.cat([layers[i][0] for layers in items], dim=self.seq_dim),
+                 torch.cat([layers[i][1] for layers in items], dim=self.seq_dim))
+                for i in range(len(items[0]))]
+
+    def kv_cat_batch(self, items: List[KVLayers]) -> KVLayers:
+        return [(torch.cat([layers[i][0] for layers in items], dim=self.batch_dim),
+                 torch.cat([layers[i][1] for layers in items], dim=self.batch_dim))
+                for i in range(len(items[0]))]
+
+    def kv_select_batch(self, layers: KVLayers, index: torch.Tensor) -> KVLayers:
+        return [(k.index_select(self.batch_dim, index), v.index_select(self.batch_dim, index))
+                for k, v in layers]
+
+    def kv_slice(self, layers: KVLayers, start: int, end: Optional[int] = None) -> KVLayers:
+        return [(k.narrow(self.seq_dim, start, (end or k.shape[self.seq_dim]) - start),
+                 v.narrow(self.seq_dim, start, (end or v.shape[self.seq_dim]) - start))
+                for k, v in layers]
+
+    def kv_clone(self, layers: KVLayers) -> KVLayers:
+        return [(k.clone(), v.clone()) for k, v in layers]
+
+    def kv_to(self, layers: KVLayers, device) -> KVLayers:
+        return [(k.to(device), v.to(device)) for k, v in layers]
+
+    def kv_nbytes(self, layers: KVLayers) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+class Sequence:
+    """
+    一个生成请求在调度器中的状态
+    """
+
+    def __init__(self, params: dict, on_output: Callable[[object], None]):
+        self.params = params
+        self.on_output = on_output
+
+        self.temperature = float(params.get("temperature", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.repetition_penalty = float(
+            params.get("repetition_penalty", 1.0))
+        self.max_new_tokens = int(params.get("max_tokens", 256))
+        self.echo = params.get("echo", True)
+        self.do_sample = self.temperature > 1e-5
+        # 指定 seed 时使用单独的随机数生成器，结果不受同一批其他序列的影响
+        self.seed: Optional[int] = params.get("seed")
+        self.generator: Optional[torch.Generator] = None
+        # 会话模式下结束时保留整段对话的 KV
+        self.retain_kv = bool(params.get("retain_kv"))
+        # 截止时间（time.monotonic），超过后结束生成
+        self.deadline: Optional[float] = params.get("deadline")
+        self.priority = params.get("priority") or "interactive"
+        # 为 False 时只输出最终结果（和工具调用），批量任务不需要逐 token 的输出
+        self.partial_outputs = params.get("partial_outputs", True)
+        # 被抢占时保存在 CPU 上的 KV，恢复时直接并入批次，不需要重新预填充
+        self.saved_layers: Optional[KVLayers] = None
+        # 分块预填充的进度：已经计算的 prompt token 数和它们的 KV
+        self.prefilled = 0
+        self.prefill_layers: Optional[KVLayers] = None
+        # n > 1 时的其他回复：共用这个序列的预填充，之后复制 KV 各自采样
+        self.index = 0
+        self.forks: List['Sequence'] = []
+        # 推测解码时起草器为这个序列保存的状态
+        self.draft_state = None
+
+        # 与 model.stream_generate 使用相同的 logits 处理，top_k 为 transformers 的默认值
+        self.processors = LogitsProcessorList([InvalidScoreLogitsProcessor()])
+        if self.repetition_penalty != 1.0:
+            self.processors.append(
+                RepetitionPenaltyLogitsProcessor(self.repetition_penalty))
+        if self.do_sample:
+            if self.temperature != 1.0:
+                self.processors.append(
+                    TemperatureLogitsWarper(self.temperature))
+            self.processors.append(TopKLogitsWarper(50))
+            if self.top_p < 1.0:
+                self.processors.append(TopPLogitsWarper(self.top_p))
+
+        self.prompt_ids: List[int] = []
+        self.output_ids: List[int] = []
+        # 预分配的 token 序列，重复惩罚需要完整的输入
+        self.token_buffer: Optional[torch.Tensor] = None
+        self.length = 0
+        self.position = 0
+
+        self.detokenizer: Optional[IncrementalDetokenizer] = None
+        self.stopper = StopStringMatcher(get_stop_strings(params))
+        self.finished = False
+        self.cancelled = False
+        self.eos = False
+        self.created_at = time.time()
+
+    def set_prompt(self, prompt_ids: List[int], device: torch.device, tokenizer: PreTrainedTokenizer) -> None:
+        self.prompt_ids = prompt_ids
+        self.detokenizer = IncrementalDetokenizer(
+            tokenizer, prompt_ids if self.echo else None)
+        if self.echo:
+            self.stopper.text = self.detokenizer.text
+        self.token_buffer = torch.empty(
+            len(prompt_ids) + self.max_new_tokens, dtype=torch.long, device=device)
+        self.token_buffer[:len(prompt_ids)] = torch.tensor(
+            prompt_ids, dtype=torch.long)
+        self.length = len(prompt_ids)
+        self.position = len(prompt_ids)
+        if self.do_sample and self.seed is not None:
+            self.generator = torch.Generator(device=device).manual_seed(int(self.seed))
+
+    def append_token(self, token_id: int) -> None:
+        self.output_ids.append(token_id)
+        self.token_buffer[self.length] = token_id
+        self.length += 1
+
+    @property
+    def text(self) -> str:
+        return self.stopper.text
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    # 这个序列和共用预填充的其他回复
+    @property
+    def group(self) -> List['Sequence']:
+        return [self] + self.forks
+
+    # 在批次中占用的位置数
+    @property
+    def slots(self) -> int:
+        return 1 + len(self.forks)
+
+    @property
+    def last_token(self) -> int:
+        return self.output_ids[-1]
+
+    # 以 eos 结束时对话的 token，不含 eos，下一轮可以直接接上新消息
+    def conversation_ids(self) -> Optional[List[int]]:
+        if not self.eos:
+            return None
+        return self.prompt_ids + self.output_ids[:-1]
+
+    def usage(self) -> dict:
+        prompt_tokens = len(self.prompt_ids)
+        completion_tokens = len(self.output_ids)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    # 前 length 个 token 之后的位置的 logits，经过与采样相同的处理
+    def scores(self, logits: torch.Tensor, length: Optional[int] = None) -> torch.Tensor:
+        input_ids = self.token_buffer[:self.length if length is None else length].unsqueeze(0)
+        return self.processors(input_ids, logits.float().unsqueeze(0))
+
+    def sample(self, logits: torch.Tensor, length: Optional[int] = None) -> int:
+        scores = self.scores(logits, length)
+        if self.do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            return int(torch.multinomial(probs, num_samples=1, generator=self.generator)[0, 0])
+        return int(torch.argmax(scores, dim=-1)[0])
+
+    # 验证草稿 token：接受时返回 draft_id，否则返回代替它的 token
+    # 草稿是确定的，以 p(draft_id) 的概率接受，拒绝时从去掉 draft_id 后重新归一化的分布中采样，结果与直接采样同分布
+    def verify(self, logits: torch.Tensor, length: int, draft_id: int) -> int:
+        scores = self.scores(logits, length)
+        if not self.do_sample:
+            return int(torch.argmax(scores, dim=-1)[0])
+
+        probs = torch.softmax(scores, dim=-1)[0]
+        if float(torch.rand(1, generator=self.generator, device=probs.device)) < float(probs[draft_id]):
+            return draft_id
+        probs[draft_id] = 0
+        return int(torch.multinomial(probs / probs.sum(), num_samples=1, generator=self.generator)[0])
+
+
+class Batch:
+    """
+    正在解码的序列及其合并后的 KV
+
+    不同长度的序列左侧补齐，attention_mask 中补齐的位置为 0；
+    只有序列加入或退出时才重新拼接 KV。
+    """
+
+    def __init__(self, runner: ModelRunner):
+        self.runner = runner
+        self.sequences: List[Sequence] = []
+        self.layers: KVLayers = []
+        self.attention_mask: Optional[torch.Tensor] = None
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def add(self, seq: Sequence, layers: KVLayers) -> None:
+        self.extend([seq], layers)
+
+    # 加入多个序列，layers 的 batch 维与 sequences 一一对应
+    def extend(self, sequences: List[Sequence], layers: KVLayers) -> None:
+        runner = self.runner
+        mask = torch.ones(len(sequences), runner.kv_length(layers),
+                          dtype=torch.long, device=runner.device)
+        if not self.sequences:
+            self.sequences, self.layers, self.attention_mask = list(sequences), layers, mask
+            return
+
+        length = max(runner.kv_length(self.layers), runner.kv_length(layers))
+        self.layers = runner.kv_cat_batch([runner.kv_pad_left(self.layers, length),
+                                           runner.kv_pad_left(layers, length)])
+        self.attention_mask = torch.cat((self._pad_mask(self.attention_mask, length),
+                                         self._pad_mask(mask, length)), dim=0)
+        self.sequences.extend(sequences)
+
+    # 第 index 个序列最后 length 个位置的 KV
+    def sequence_layers(self, index: int, length: int) -> KVLayers:
+        runner = self.runner
+        layers = runner.kv_select_batch(self.layers, torch.tensor(
+            [index], dtype=torch.long, device=runner.device))
+        return runner.kv_slice(layers, runner.kv_length(layers) - length)
+
+    def _pad_mask(self, mask: torch.Tensor, length: int) -> torch.Tensor:
+        pad = length - mask.shape[1]
+        if pad <= 0:
+            return mask
+        return torch.cat((mask.new_zeros(mask.shape[0], pad), mask), dim=1)
+
+    def remove(self, finished: List[Sequence]) -> None:
+        if not finished:
+            return
+
+        keep = [i for i, seq in enumerate(self.sequences) if seq not in finished]
+        if not keep:
+            self.sequences, self.layers, self.attention_mask = [], [], None
+            return
+
+        index = torch.tensor(keep, dtype=torch.long,
+                             device=self.runner.device)
+        self.sequences = [self.sequences[i] for i in keep]
+        self.layers = self.runner.kv_select_batch(self.layers, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+
+        # 去掉所有序列都是补齐的列
+        start = int(self.attention_mask.any(dim=0).nonzero()[0])
+        if start > 0:
+            self.layers = self.runner.kv_slice(self.layers, start)
+            self.attention_mask = self.attention_mask[:, start:]
+
+    # 所有序列各解码一个 token，返回每个序列最后一个位置的 logits
+    def step(self) -> torch.Tensor:
+        device = self.runner.device
+        input_ids = torch.tensor([[seq.last_token] for seq in self.sequences],
+                                 dtype=torch.long, device=device)
+        position_ids = torch.tensor([[seq.position] for seq in self.sequences],
+                                    dtype=torch.long, device=device)
+        attention_mask = torch.cat(
+            (self.attention_mask, self.attention_mask.new_ones(len(self.sequences), 1)), dim=1)
+
+        logits, self.layers = self.runner.forward(
+            input_ids, attention_mask, position_ids, self.layers)
+        self.attention_mask = attention_mask
+        for seq in self.sequences:
+            seq.position += 1
+
+        return logits[:, -1, :]
+
+
+class GenerationEngine:
+    """
+    连续批处理调度器
+
+    在每个解码步之间接收新请求：新请求单独预填充后并入正在解码的批次，
+    结束的序列立即退出，每个序列的输出通过各自的回调返回。
+    interactive 请求先于 bulk 请求进入批次；批次已满而 interactive 请求还在等待时，
+    抢占正在解码的 bulk 序列，把它的 KV 移到 CPU 上，等有空位时再从断点继续解码。
+    prefill_chunk 大于 0 时每个解码步之前最多预填充这么多 token，
+    长 prompt 分成多块与其他序列的解码步交替进行，不会让正在输出的请求长时间停顿。
+    设置 drafter 时，批次中只有一个序列的解码步改为推测解码（指定 seed 的采样请求除外），见 _speculate。
+    """
+
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, max_batch_size: int = 8,
+                 prefix_cache=None, prefill_chunk: int = 0, drafter=None, speculative_tokens: int = 4):
+        self.runner = ModelRunner(model)
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        # 可选的 PrefixCache，命中时只预填充未缓存的部分
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk = prefill_chunk
+        # 可选的起草器（speculative.py），每次推测 speculative_tokens 个 token
+        self.drafter = drafter
+        self.speculative_tokens = speculative_tokens
+
+        self.waiting: Dict[str, Deque[Sequence]] = {priority: deque() for priority in PRIORITIES}
+        # 正在分块预填充的序列，占用批次的名额，interactive 排在前面
+        self.prefilling: List[Sequence] = []
+        self.batch = Batch(self.runner)
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+
+        self.eos_token_id = [
+            tokenizer.eos_token_id,
+            tokenizer.get_command("<|user|>"),
+        ]
+
+        # 统计信息
+        self.steps = 0
+        self.prefill_chunks = 0
+        self.generated_tokens = 0
+        self.cancelled_sequences = 0
+        self.preemptions = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+    def start(self) -> None:
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='generation-engine', daemon=True)
+                self.thread.start()
+
+    def add(self, seq: Sequence) -> None:
+        self.start()
+        with self.condition:
+            self.waiting[seq.priority].append(seq)
+            self.condition.notify()
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(len(waiting) for waiting in self.waiting.values())
+
+    # 按优先级统计正在解码、等待和被抢占的序列数
+    def stats(self) -> dict:
+        with self.condition:
+            waiting = {priority: list(items) for priority, items in self.waiting.items()}
+        running = list(self.batch.sequences)
+        prefilling = list(self.prefilling)
+        result = {}
+        for priority in PRIORITIES:
+            result[(("priority", priority), ("state", "running"))] = sum(
+                1 for seq in running if seq.priority == priority)
+            result[(("priority", priority), ("state", "prefilling"))] = sum(
+                seq.slots for seq in prefilling if seq.priority == priority)
+            result[(("priority", priority), ("state", "waiting"))] = sum(
+                seq.slots for seq in waiting[priority] if seq.saved_layers is None)
+            result[(("priority", priority), ("state", "preempted"))] = sum(
+                1 for seq in waiting[priority] if seq.saved_layers is not None)
+        return result
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.num_waiting and not len(self.batch) and not self.prefilling:
+                    self.condition.wait()
+                # 批次的空位不够 interactive 请求时，抢占 KV 最短的 bulk 序列（搬移的数据最少）
+                free = self.max_batch_size - len(self.batch) - sum(seq.slots for seq in self.prefilling)
+                bulk = sorted((seq for seq in self.batch.sequences if seq.priority == "bulk" and not seq.cancelled),
+                              key=lambda seq: seq.length)
+                needed = sum(seq.slots for seq in self.waiting["interactive"])
+                preempted = bulk[:max(0, min(len(bulk), needed - free))]
+                free += len(preempted)
+                # n > 1 的请求整体进入批次，空位不够时等待，不让后面的请求插队
+                admitted, taken = [], 0
+                for priority in PRIORITIES:
+                    while self.waiting[priority] and taken + self.waiting[priority][0].slots <= free:
+                        admitted.append(self.waiting[priority].popleft())
+                        taken += admitted[-1].slots
+                    if self.waiting[priority]:
+                        break
+
+            try:
+                if preempted:
+                    self._preempt(preempted)
+                for seq in admitted:
+                    if seq.saved_layers is not None:
+                        self._resume(seq)
+                    else:
+                        self._start_prefill(seq)
+                self._prefill()
+                if len(self.batch):
+                    self._decode()
+            except Exception as exc:
+                logger.exception(exc)
+                for seq in [fork for item in admitted + self.prefilling for fork in item.group] + self.batch.sequences:
+                    if not seq.finished:
+                        seq.finished = True
+                        seq.on_output(exc)
+                self.prefilling = []
+                self.batch = Batch(self.runner)
+
+    def _tokenize(self, seq: Sequence) -> List[int]:
+        params = seq.params
+        if params.get("prompt_ids"):
+            return list(params["prompt_ids"])
+        messages = process_chatglm_messages(
+            params["messages"], functions=params.get("functions"))
+        query, role = messages[-1]["content"], messages[-1]["role"]
+        inputs = self.tokenizer.build_chat_input(
+            query, history=messages[:-1], role=role)
+        return inputs["input_ids"][0].tolist()
+
+    def _start_prefill(self, seq: Sequence) -> None:
+        if seq.cancelled:
+            for fork in seq.group:
+                fork.finished = True
+            return
+
+        device = self.runner.device
+        if seq.expired():
+            prompt_ids = self._tokenize(seq)
+            for fork in seq.group:
+                fork.set_prompt(prompt_ids, device, self.tokenizer)
+                self._finish(fork)
+            return
+
+        with STAGE_SECONDS.time(stage="tokenize"):
+            prompt_ids = self._tokenize(seq)
+        for fork in seq.group:
+            fork.set_prompt(prompt_ids, device, self.tokenizer)
+        if seq.length >= self.runner.seq_length:
+            logger.warning(
+                f"Input length larger than {self.runner.seq_length}")
+
+        if self.prefix_cache is not None:
+            seq.prefilled, seq.prefill_layers = self.prefix_cache.match(seq.prompt_ids)
+        self.prefilling.append(seq)
+        self.prefilling.sort(key=lambda item: PRIORITIES.index(item.priority))
+
+    # 按顺序预填充等待中的序列，prefill_chunk 大于 0 时这一轮最多计算 prefill_chunk 个 token
+    def _prefill(self) -> None:
+        budget = self.prefill_chunk if self.prefill_chunk > 0 else None
+        while self.prefilling and (budget is None or budget > 0):
+            seq = self.prefilling[0]
+            if seq.cancelled:
+                for fork in seq.group:
+                    fork.finished = True
+                self.prefilling.pop(0)
+                continue
+            if seq.expired():
+                self.prefilling.pop(0)
+                for fork in seq.group:
+                    self._finish(fork)
+                continue
+
+            length = seq.length - seq.prefilled
+            if budget is not None:
+                length = min(length, budget)
+                budget -= length
+            if self._prefill_chunk(seq, length):
+                self.prefilling.pop(0)
+
+    # 预填充接下来的 length 个 prompt token，prompt 全部完成时采样第一个 token 并加入批次
+    def _prefill_chunk(self, seq: Sequence, length: int) -> bool:
+        device = self.runner.device
+        start = time.perf_counter()
+        end = seq.prefilled + length
+        input_ids = torch.tensor(
+            [seq.prompt_ids[seq.prefilled:end]], dtype=torch.long, device=device)
+        position_ids = torch.arange(
+            seq.prefilled, end, dtype=torch.long, device=device).unsqueeze(0)
+        attention_mask = torch.ones(1, end, dtype=torch.long, device=device)
+        logits, seq.prefill_layers = self.runner.forward(
+            input_ids, attention_mask, position_ids, seq.prefill_layers)
+        seq.prefilled = end
+        self.prefill_chunks += 1
+        if end < seq.length:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="prefill")
+            return False
+
+        layers, seq.prefill_layers = seq.prefill_layers, None
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.prompt_ids, layers)
+
+        # 采样时取出 token 会等待计算完成，计入预填充的耗时
+        group, seq.forks = seq.group, []
+        token_ids = [fork.sample(logits[0, -1]) for fork in group]
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="prefill")
+        for fork, token_id in zip(group, token_ids):
+            self._accept(fork, token_id)
+        # 每个回复复制一份 prompt 的 KV，一次并入批次
+        running = [fork for fork in group if not fork.finished]
+        if len(running) > 1:
+            self.batch.extend(running, self.runner.kv_cat_batch([layers] * len(running)))
+        elif running:
+            self.batch.add(running[0], layers)
+        return True
+
+    # 把序列移出批次，KV 保存到 CPU，排在同一优先级等待队列的最前面
+    def _preempt(self, sequences: List[Sequence]) -> None:
+        for seq in sequences:
+            index = self.batch.sequences.index(seq)
+            # 最后一个 token 还没有输入模型，KV 覆盖之前的所有 token
+            seq.saved_layers = self.runner.kv_to(
+                self.batch.sequence_layers(index, seq.length - 1), 'cpu')
+            PREEMPTIONS.inc(priority=seq.priority)
+        self.batch.remove(sequences)
+        self.preemptions += len(sequences)
+        with self.condition:
+            self.waiting["bulk"].extendleft(reversed(sequences))
+
+    def _resume(self, seq: Sequence) -> None:
+        layers, seq.saved_layers = seq.saved_layers, None
+        if seq.cancelled:
+            seq.finished = True
+            return
+        if seq.expired():
+            self._finish(seq)
+            return
+        self.batch.add(seq, self.runner.kv_to(layers, self.runner.device))
+
+    def _decode(self) -> None:
+        # 客户端已断开的序列在这一步之前退出，释放其 KV
+        cancelled = [seq for seq in self.batch.sequences if seq.cancelled]
+        if cancelled:
+            self.batch.remove(cancelled)
+            self.cancelled_sequences += len(cancelled)
+            if not len(self.batch):
+                return
+
+        start = time.perf_counter()
+        # 只有一个序列时解码受访存限制，一次验证多个 token 的耗时与解码一个 token 接近
+        if self.drafter is None or len(self.batch) != 1 or not self._speculate(self.batch.sequences[0]):
+            logits = self.batch.step()
+            self.steps += 1
+            for i, seq in enumerate(self.batch.sequences):
+                if not seq.cancelled:
+                    self._accept(seq, seq.sample(logits[i]))
+                    self._retain(seq, i)
+
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="decode_step")
+
+        self.cancelled_sequences += sum(
+            1 for seq in self.batch.sequences if seq.cancelled and not seq.finished)
+        self.batch.remove(
+            [seq for seq in self.batch.sequences if seq.finished or seq.cancelled])
+
+    # 最后一个 token 是 eos，KV 正好覆盖整段对话
+    def _retain(self, seq: Sequence, index: int) -> None:
+        if seq.eos and seq.retain_kv and self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.conversation_ids(),
+                                     self.batch.sequence_layers(index, seq.length - 1))
+
+    # 推测解码：起草器给出 k 个草稿 token，与最后一个 token 一起输入主模型，一次得到 k + 1 个位置的 logits，
+    # 依次验证，接受的草稿和第一个被拒绝位置重新采样的 token（全部接受时为下一个位置采样的 token）一起输出，
+    # 被拒绝的草稿的 KV 截掉。没有草稿时返回 False，按普通的解码步处理
+    # 验证消耗随机数的顺序与逐个采样不同，指定 seed 的采样请求不推测，保证同一个 seed 的输出不随配置变化
+    def _speculate(self, seq: Sequence) -> bool:
+        if seq.generator is not None:
+            return False
+        runner, batch = self.runner, self.batch
+        k = min(self.speculative_tokens, seq.max_new_tokens - len(seq.output_ids) - 1,
+                runner.seq_length - seq.length - 1)
+        if k <= 0:
+            return False
+        if seq.draft_state is None:
+            seq.draft_state = self.drafter.new_state()
+        draft = self.drafter.propose(seq.draft_state, seq.prompt_ids + seq.output_ids, k)
+        if not draft:
+            return False
+
+        device = runner.device
+        count = len(draft) + 1
+        input_ids = torch.tensor([[seq.last_token] + draft], dtype=torch.long, device=device)
+        position_ids = torch.arange(
+            seq.position, seq.position + count, dtype=torch.long, device=device).unsqueeze(0)
+        attention_mask = torch.cat(
+            (batch.attention_mask, batch.attention_mask.new_ones(1, count)), dim=1)
+        kv_length = runner.kv_length(batch.layers)
+        logits, layers = runner.forward(input_ids, attention_mask, position_ids, batch.layers, last_only=False)
+        self.steps += 1
+
+        # 草稿先写入 token_buffer，验证每个位置时重复惩罚看到的输入与逐个解码时相同
+        seq.token_buffer[seq.length:seq.length + len(draft)] = torch.tensor(draft, dtype=torch.long)
+        tokens = []
+        for i, draft_id in enumerate(draft):
+            tokens.append(seq.verify(logits[0, i], seq.length + i, draft_id))
+            if tokens[-1] != draft_id:
+                break
+        else:
+            tokens.append(seq.sample(logits[0, len(draft)], seq.length + len(draft)))
+        accepted = len(tokens) - 1
+        self.draft_tokens += len(draft)
+        self.accepted_tokens += accepted
+        SPECULATIVE_TOKENS.inc(len(draft), result="proposed")
+        SPECULATIVE_TOKENS.inc(accepted, result="accepted")
+
+        appended = 0
+        for token_id in tokens:
+            self._accept(seq, token_id)
+            appended += 1
+            if seq.finished:
+                break
+
+        # 保留到最后一个输出 token 之前的 KV，与逐个解码时一致
+        batch.layers = runner.kv_slice(layers, 0, kv_length + appended)
+        batch.attention_mask = attention_mask[:, :kv_length + appended]
+        seq.position += appended
+        self._retain(seq, 0)
+        return True
+
+    # 处理新生成的 token，与 generate_stream_chatglm3 的输出格式一致
+    def _accept(self, seq: Sequence, token_id: int) -> None:
+        seq.append_token(token_id)
+        self.generated_tokens += 1
+
+        if token_id in self.eos_token_id:
+            seq.eos = True
+            self._finish(seq)
+            return
+
+        start = time.perf_counter()
+        delta = seq.detokenizer.add(token_id)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="detokenize")
+        if delta:
+            start = time.perf_counter()
+            stop = seq.stopper.feed(delta)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="stop_check")
+            if stop is not None and stop != "<|observation|>":
+                self._finish(seq)
+                return
+
+            if seq.partial_outputs or stop:
+                seq.on_output({
+                    "text": seq.text,
+                    "usage": seq.usage(),
+                    "finish_reason": "function_call" if stop else None,
+                })
+            if stop:
+                self._finish(seq)
+                return
+
+        if len(seq.output_ids) >= seq.max_new_tokens or seq.length >= self.runner.seq_length or seq.expired():
+            self._finish(seq)
+
+    def _finish(self, seq: Sequence) -> None:
+        seq.finished = True
+        if seq.stopper.matched is None:
+            seq.stopper.feed(seq.detokenizer.flush())
+            seq.stopper.flush()
+        response = {
+            "text": seq.text,
+            "usage": seq.usage(),
+            "finish_reason": "stop",
+        }
+        if seq.retain_kv:
+            response["token_ids"] = seq.conversation_ids()
+        seq.on_output(response)
+        seq.on_output(None)
+
+    # 提交请求并以异步生成器返回输出，消费方退出时取消该序列
+    # params["n"] 大于 1 时生成多个回复，输出带 index，所有回复结束后返回
+    async def stream(self, params: dict) -> AsyncIterator[dict]:
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        n = int(params.get("n") or 1)
+        if n > self.max_batch_size:
+            raise Exception(f'n 不能超过批次大小 {self.max_batch_size}')
+        group = []
+        for index in range(n):
+            fork_params = params
+            # 指定 seed 时每个回复使用不同的 seed，避免采样出相同的回复
+            if index > 0 and params.get("seed") is not None:
+                fork_params = dict(params, seed=params["seed"] + index)
+            seq = Sequence(fork_params, lambda item, index=index: loop.call_soon_threadsafe(
+                items.put_nowait, dict(item, index=index) if n > 1 and isinstance(item, dict) else item))
+            seq.index = index
+            group.append(seq)
+        group[0].forks = group[1:]
+        self.add(group[0])
+
+        try:
+            remaining = n
+            while remaining:
+                item = await items.get()
+                if item is None:
+                    remaining -= 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            for seq in group:
+                seq.cancelled = True
+
+    async def generate(self, params: dict) -> dict:
+        response = None
+        async for response in self.stream(params):
+            pass
+        return response
@@ -0,0 +1,123 @@
+import os
+import time
+import queue
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from metrics import STORAGE_SECONDS
+
+# 书籍、会话等文件读写使用的线程数
+STORAGE_WORKERS = int(os.environ.get('STORAGE_WORKERS', '8'))
+
+storage_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_WORKERS, thread_name_prefix='storage')
+
+
+def _timed(func: Callable, *args, **kwargs) -> Any:
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        STORAGE_SECONDS.observe(time.perf_counter() - start,
+                                func=f"{func.__module__}.{func.__name__}")
+
+
+# 在线程池中执行阻塞的存储操作，避免阻塞事件循环
+async def run_storage(func: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(_timed, func, *args, **kwargs))
+
+
+class ModelExecutor:
+    """
+    模型推理线程
+
+    所有推理任务经由队列交给同一个线程依次执行，模型不会被多个线程同时调用，
+    事件循环只等待结果，不会因为生成过程而阻塞其他请求。
+    """
+
+    def __init__(self, name: str = 'model'):
+        self.name = name
+        self.tasks: queue.Queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            task = self.tasks.get()
+            task()
+
+    def submit(self, task: Callable[[], None]) -> None:
+        self._ensure_started()
+        self.tasks.put(task)
+
+    # 在推理线程中执行 func，返回其结果
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(result):
+            if not future.done():
+                future.set_result(result)
+
+        def set_exception(exc):
+            if not future.done():
+                future.set_exception(exc)
+
+        def task():
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as exc:
+                loop.call_soon_threadsafe(set_exception, exc)
+            else:
+                loop.call_soon_threadsafe(set_result, result)
+
+        self.submit(task)
+        return await future
+
+    # 在推理线程中运行生成器，把产生的每一项转交给事件循环中的异步生成器
+    async def iterate(self, func: Callable[..., Iterator], *args, **kwargs) -> AsyncIterator:
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def task():
+            generator = func(*args, **kwargs)
+            try:
+                for item in generator:
+                    loop.call_soon_threadsafe(items.put_nowait, (item, None))
+                    # 消费方已经退出时提前结束生成
+                    if stopped.is_set():
+                        break
+            except BaseException as exc:
+                loop.call_soon_threadsafe(items.put_nowait, (done, exc))
+                return
+            finally:
+                generator.close()
+            loop.call_soon_threadsafe(items.put_nowait, (done, None))
+
+        self.submit(task)
+        try:
+            while True:
+                item, exc = await items.get()
+                if exc is not None:
+                    raise exc
+                if item is done:
+                    break
+                yield item
+        finally:
+            stopped.set()
+
+
+model_executor = ModelExecutor()
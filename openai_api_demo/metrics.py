@@ -0,0 +1,173 @@
+# Prometheus 文本格式的指标，只实现服务用到的 Counter、Gauge 和 Histogram，不依赖 prometheus_client
+import math
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> LabelValues:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for key, value in items) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, Optional[Tuple[str, str]], float]]:
+        return iter(())
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, extra, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield self.name, labels, None, value
+
+
+class Gauge(Metric):
+    """
+    取值由 callback 在导出时计算，返回 {标签元组: 值} 或单个数值
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], object]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if value is None:
+            return
+        if isinstance(value, dict):
+            for labels, item in value.items():
+                yield self.name, _labels(dict(labels)), None, item
+        else:
+            yield self.name, (), None, value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        super().__init__(name, documentation)
+        self.buckets = list(buckets)
+        # 标签 -> (每个桶的计数, 总和, 总数)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                item = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            item[0][index] += 1
+            item[1][0] += value
+            item[1][1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(counts), list(total)) for labels, (counts, total) in self.values.items()]
+        for labels, counts, (total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [math.inf], counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels, ('le', _format_value(bound)), cumulative
+            yield f'{self.name}_sum', labels, None, total
+            yield f'{self.name}_count', labels, None, count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+REQUESTS = registry.register(Counter(
+    'writer_requests_total', '对话请求数，按结果（ok/error/rejected/cancelled）统计'))
+QUEUE_WAIT = registry.register(Histogram(
+    'writer_queue_wait_seconds', '准入控制中的排队时间，按优先级统计', LATENCY_BUCKETS))
+STAGE_SECONDS = registry.register(Histogram(
+    'writer_stage_seconds', '推理各阶段耗时：tokenize、prefill、decode_step、detokenize、stop_check、serialize',
+    LATENCY_BUCKETS))
+TIME_TO_FIRST_TOKEN = registry.register(Histogram(
+    'writer_time_to_first_token_seconds', '从开始生成到第一个输出的时间，按优先级统计', LATENCY_BUCKETS))
+INTER_TOKEN_LATENCY = registry.register(Histogram(
+    'writer_inter_token_latency_seconds', '相邻两次输出的间隔，按优先级统计', LATENCY_BUCKETS))
+TOKENS_PER_SECOND = registry.register(Histogram(
+    'writer_tokens_per_second', '单个请求的生成速度，按优先级统计', RATE_BUCKETS))
+PROMPT_TOKENS = registry.register(Histogram(
+    'writer_prompt_tokens', '请求的 prompt token 数', TOKEN_BUCKETS))
+COMPLETION_TOKENS = registry.register(Histogram(
+    'writer_completion_tokens', '请求生成的 token 数', TOKEN_BUCKETS))
+PREEMPTIONS = registry.register(Counter(
+    'writer_preemptions_total', '调度器为 interactive 请求抢占的序列数，按被抢占序列的优先级统计'))
+SPECULATIVE_TOKENS = registry.register(Counter(
+    'writer_speculative_tokens_total', '推测解码的草稿 token 数，按结果（proposed/accepted）统计，两者之比为接受率'))
+STORAGE_SECONDS = registry.register(Histogram(
+    'writer_storage_seconds', '书籍、会话存储操作耗时，按函数统计', LATENCY_BUCKETS))
@@ -0,0 +1,33 @@
+from typing import Tuple
+
+import torch
+
+# 可选的模型：chatglm 为 ChatGLM3-6B 权重，tiny 为随机初始化的小模型，echo 为脚本化的确定性模型
+MODEL_BACKENDS = ('chatglm', 'tiny', 'echo')
+
+
+# 加载模型和分词器，返回的对象都满足 generate_stream_chatglm3 和调度器的要求：
+# 分词器提供 build_chat_input、get_command、decode，模型提供 stream_generate 和前向计算
+def load_model(backend: str, model_path: str = '', tokenizer_path: str = '', device: str = 'cpu') -> Tuple[object, object]:
+    if backend == 'tiny':
+        from tiny_model import load_tiny_model
+        return load_tiny_model(device=device)
+
+    if backend == 'echo':
+        from tiny_model import load_echo_model
+        return load_echo_model(device=device)
+
+    if backend != 'chatglm':
+        raise Exception(f'不支持的模型：{backend}')
+
+    from transformers import AutoTokenizer, AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer_path or model_path, trust_remote_code=True)
+    if 'cuda' in device:  # AMD, NVIDIA GPU can use Half Precision
+        model = AutoModel.from_pretrained(
+            model_path, trust_remote_code=True).to(device).eval()
+    else:  # CPU, Intel GPU and other GPU can use Float16 Precision Only
+        model = AutoModel.from_pretrained(
+            model_path, trust_remote_code=True).half().to(device).eval()
+    return model, tokenizer
@@ -8,38 +8,281 @@
 
 import os
 import time
+import uuid
+import asyncio
+import threading
 from contextlib import asynccontextmanager
 from turtle import st
-from typing import List, Literal, Optional, Union, Dict
+from typing import AsyncIterator, List, Literal, Optional, Tuple, Union, Dict
 
 import torch
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from loguru import logger
 from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
 from transformers import AutoTokenizer, AutoModel
 
 import writer as writer
-from writer import BookList, BookDetail, ChapterList, ChapterDetail, BookType, ChapterType, NovelType, NovelTypeList
+from writer import BookList, BookDetail, ChapterList, ChapterDetail, BookType, ChapterType, NovelType, NovelTypeList, BookSummaryList, ChapterFieldList
 
 import session
 from session import SessionType, MessageType, SessionList, MessageList, SessionDetail
 
 
-from utils import process_response, generate_chatglm3, generate_stream_chatglm3
+from utils import process_response, generate_stream_chatglm3, build_session_input
+from executor import run_storage, model_executor, storage_executor
+from engine import GenerationEngine, ModelRunner
+from model_backend import load_model
+from prefix_cache import PrefixCache
+from speculative import PromptLookupDrafter, DraftModelDrafter
+from admission import AdmissionController, AdmissionRejected, Ticket, PRIORITIES, estimate_tokens
+from stream_encoder import ChunkEncoder, ChunkCoalescer, iterate_with_timeout
+from response_cache import ResponseCache, response_cache_key, replay_response
+from single_flight import SingleFlight, Flight
+from resumable_stream import StreamRegistry
+from batch_jobs import BatchJobs, BatchObject, BatchList
+from metrics import (registry, Gauge, REQUESTS, QUEUE_WAIT, STAGE_SECONDS, TIME_TO_FIRST_TOKEN,
+                     INTER_TOKEN_LATENCY, TOKENS_PER_SECOND, PROMPT_TOKENS, COMPLETION_TOKENS)
 
 MODEL_PATH = os.environ.get(
     'MODEL_PATH', '/Users/zix/workspace/llm/ChatGLM3/models/chatglm3-6b')
 TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
 DEVICE = 'cuda' if torch.cuda.is_available() else 'mps'
+# 模型：chatglm、tiny（随机初始化的小模型）或 echo（脚本化的确定性模型），为空时不加载
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', '')
+
+# 推理调度方式：serial 逐个请求生成，batch 使用连续批处理调度器
+SCHEDULER = os.environ.get('SCHEDULER', 'serial')
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '8'))
+# 连续批处理调度器每个解码步之前最多预填充的 token 数，长 prompt 分块预填充，0 表示不分块
+PREFILL_CHUNK_TOKENS = int(os.environ.get('PREFILL_CHUNK_TOKENS', '512'))
+# 推测解码（连续批处理调度器）：prompt_lookup 从上下文中查找草稿，draft 使用 DRAFT_MODEL_PATH 的小模型起草，为空时不使用
+# 贪心解码的输出与不推测时相同；指定 seed 的采样请求不推测，同一个 seed 在开关前后输出相同
+SPECULATIVE = os.environ.get('SPECULATIVE', '')
+SPECULATIVE_TOKENS = int(os.environ.get('SPECULATIVE_TOKENS', '4'))
+# 草稿模型与主模型使用同一个分词器，按 MODEL_BACKEND 加载
+DRAFT_MODEL_PATH = os.environ.get('DRAFT_MODEL_PATH', '')
+# 前缀 KV 缓存的内存上限（MB），0 表示不缓存
+PREFIX_CACHE_MB = int(os.environ.get('PREFIX_CACHE_MB', '1024'))
+
+# 准入控制：同时生成的请求数、排队长度、排队超时（秒）和同时占用的 token 数（0 表示不限）
+MAX_INFLIGHT = int(os.environ.get(
+    'MAX_INFLIGHT', str(MAX_BATCH_SIZE if SCHEDULER == 'batch' else 1)))
+MAX_QUEUE = int(os.environ.get('MAX_QUEUE', '64'))
+QUEUE_TIMEOUT = float(os.environ.get('QUEUE_TIMEOUT', '60'))
+MAX_INFLIGHT_TOKENS = int(os.environ.get('MAX_INFLIGHT_TOKENS', '65536'))
+
+# 单个请求的最长生成时间（秒），0 表示不限；请求中的 timeout 不能超过该值
+GENERATION_TIMEOUT = float(os.environ.get('GENERATION_TIMEOUT', '600'))
+# 流式响应合并相邻 token：距上次发送的毫秒数和累积的字符数，0 表示不合并；生成停顿时合并的文本最多等待 STREAM_COALESCE_MS
+STREAM_COALESCE_MS = float(os.environ.get('STREAM_COALESCE_MS', '0'))
+STREAM_COALESCE_CHARS = int(os.environ.get('STREAM_COALESCE_CHARS', '0'))
+# 非流式请求检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+# 确定性请求（temperature 为 0 或指定 seed）的响应缓存条数，0 表示不缓存；
+# RESPONSE_CACHE_DIR 不为空时同时缓存到磁盘；流式重放时每个 chunk 的字符数
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '')
+RESPONSE_CACHE_CHUNK_CHARS = int(os.environ.get('RESPONSE_CACHE_CHUNK_CHARS', '4'))
+# 相同的确定性请求同时到达时只生成一次，1 开启，0 关闭
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') == '1'
+# 流式响应断线续传：断开后继续生成并保留输出的秒数（0 表示不续传）和保留的事件数，没有发送的事件超出缓冲时停止生成
+STREAM_RESUME_SECONDS = float(os.environ.get('STREAM_RESUME_SECONDS', '30'))
+STREAM_RESUME_EVENTS = int(os.environ.get('STREAM_RESUME_EVENTS', '4096'))
+# 批量任务的保存目录和同时处理的请求数，默认填满调度器的批次
+BATCH_PATH = os.environ.get('BATCH_PATH', './batches')
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', str(MAX_BATCH_SIZE)))
+# 一个请求最多生成的回复数（n），不超过调度器的批次大小
+MAX_CHOICES = min(int(os.environ.get('MAX_CHOICES', '8')), MAX_BATCH_SIZE)
+
+# 连续批处理调度器可以抢占 bulk 序列，interactive 请求不受 bulk 请求占用的名额限制
+admission = AdmissionController(
+    MAX_INFLIGHT, MAX_QUEUE, MAX_INFLIGHT_TOKENS, QUEUE_TIMEOUT, preempt_bulk=SCHEDULER == 'batch')
+
+engine: Optional[GenerationEngine] = None
+prefix_cache: Optional[PrefixCache] = None
+response_cache: Optional[ResponseCache] = ResponseCache(
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DIR) if RESPONSE_CACHE_SIZE > 0 else None
+single_flight = SingleFlight()
+stream_registry: Optional[StreamRegistry] = StreamRegistry(
+    STREAM_RESUME_SECONDS, STREAM_RESUME_EVENTS) if STREAM_RESUME_SECONDS > 0 else None
+
+registry.register(Gauge('writer_inflight_requests', '正在生成的请求数，按优先级统计',
+                        lambda: {(("priority", key),): value for key, value in admission.inflight_by.items()}))
+registry.register(Gauge('writer_queued_requests', '排队中的请求数，按优先级统计',
+                        lambda: {(("priority", key),): len(value) for key, value in admission.waiters.items()}))
+registry.register(Gauge('writer_inflight_tokens', '正在生成的请求占用的 token 数',
+                        lambda: admission.inflight_tokens))
+registry.register(Gauge('writer_batch_size', '调度器中正在解码的序列数',
+                        lambda: len(engine.batch) if engine is not None else None))
+registry.register(Gauge('writer_scheduled_sequences', '调度器中正在解码、等待和被抢占的序列数，按优先级统计',
+                        lambda: engine.stats() if engine is not None else None))
+registry.register(Gauge('writer_prefix_cache', '前缀缓存的字节数、查询和命中的 token 数',
+                        lambda: {(("item", key),): value for key, value in prefix_cache.stats().items()}
+                        if prefix_cache is not None else None))
+registry.register(Gauge('writer_response_cache', '响应缓存的条数、命中和未命中次数',
+                        lambda: {(("item", key),): value for key, value in response_cache.stats().items()}
+                        if response_cache is not None else None))
+registry.register(Gauge('writer_single_flight', '共享生成的请求数：进行中的生成、订阅者、发起者和加入者',
+                        lambda: {(("item", key),): value for key, value in single_flight.stats().items()}))
+registry.register(Gauge('writer_resumable_streams', '可续传的流式响应：保留中的、已开始、已续传和断开后超时或溢出停止的数量',
+                        lambda: {(("item", key),): value for key, value in stream_registry.stats().items()}
+                        if stream_registry is not None else None))
+
+
+def get_prefix_cache() -> Optional[PrefixCache]:
+    global prefix_cache
+    if prefix_cache is None and PREFIX_CACHE_MB > 0:
+        prefix_cache = PrefixCache(ModelRunner(model), PREFIX_CACHE_MB << 20)
+    return prefix_cache
+
+
+def get_drafter():
+    if SPECULATIVE == 'prompt_lookup':
+        return PromptLookupDrafter()
+    if SPECULATIVE == 'draft':
+        draft_model, _ = load_model(MODEL_BACKEND, DRAFT_MODEL_PATH, TOKENIZER_PATH,
+                                    DEVICE if MODEL_BACKEND == 'chatglm' else 'cpu')
+        return DraftModelDrafter(draft_model)
+    if SPECULATIVE:
+        raise Exception(f'不支持的推测解码方式：{SPECULATIVE}')
+    return None
+
+
+def get_engine() -> GenerationEngine:
+    global engine
+    if engine is None:
+        engine = GenerationEngine(
+            model, tokenizer, MAX_BATCH_SIZE, get_prefix_cache(), PREFILL_CHUNK_TOKENS,
+            get_drafter(), SPECULATIVE_TOKENS)
+        engine.start()
+    return engine
+
+
+# 按 SCHEDULER 选择调度器或单独的推理线程；消费方退出时在下一个解码步停止生成
+# n > 1 的请求总是交给调度器，所有回复共用一次 prompt 预填充并在同一批次中解码
+async def stream_backend(params: dict) -> AsyncIterator[dict]:
+    if SCHEDULER == 'batch' or (params.get("n") or 1) > 1:
+        async for item in get_engine().stream(params):
+            yield item
+        return
+
+    cancelled = threading.Event()
+    try:
+        async for item in model_executor.iterate(generate_stream_chatglm3, model, tokenizer,
+                                                 dict(params, cancelled=cancelled), get_prefix_cache()):
+            yield item
+    finally:
+        cancelled.set()
+
+
+# 流式生成，记录首个输出的时间、输出间隔、生成速度和 token 数
+async def stream_generate(params: dict) -> AsyncIterator[dict]:
+    start = last = time.perf_counter()
+    priority = params.get("priority", "interactive")
+    # 批量任务只输出最终结果，不记录首个输出的时间和输出间隔
+    partial_outputs = params.get("partial_outputs", True)
+    # n > 1 时每个回复的最后一次输出，生成的 token 数为所有回复之和
+    responses = {}
+    async for response in stream_backend(params):
+        now = time.perf_counter()
+        if partial_outputs and last == start:
+            TIME_TO_FIRST_TOKEN.observe(now - start, priority=priority)
+        elif partial_outputs:
+            INTER_TOKEN_LATENCY.observe(now - last, priority=priority)
+        last = now
+        responses[response.get("index", 0)] = response
+        yield response
+
+    if responses:
+        completion_tokens = sum(response["usage"]["completion_tokens"] for response in responses.values())
+        PROMPT_TOKENS.observe(responses[min(responses)]["usage"]["prompt_tokens"])
+        COMPLETION_TOKENS.observe(completion_tokens)
+        if last > start:
+            TOKENS_PER_SECOND.observe(completion_tokens / (last - start), priority=priority)
+
+
+# 命中响应缓存时重放缓存的回复，否则生成并在正常结束后写入缓存
+async def generate_or_replay(params: dict) -> AsyncIterator[dict]:
+    if params.get("cached_response") is not None:
+        for item in replay_response(params["cached_response"], RESPONSE_CACHE_CHUNK_CHARS):
+            yield item
+        return
+
+    response, function_call = None, False
+    async for response in stream_generate(params):
+        function_call = function_call or response["finish_reason"] == "function_call"
+        yield response
+
+    # 超过截止时间被截断的回复不缓存
+    cache_key = params.get("cache_key")
+    deadline = params.get("deadline")
+    if cache_key and response_cache is not None and response is not None \
+            and (deadline is None or time.monotonic() < deadline):
+        await run_storage(response_cache.put, cache_key, dict(
+            response, finish_reason="function_call" if function_call else "stop"))
+
+
+# 共享生成的请求从订阅中读取输出，其他请求自己生成
+async def subscribe_or_generate(params: dict) -> AsyncIterator[dict]:
+    if params.get("subscriber") is not None:
+        async for item in params["subscriber"].iterate():
+            yield item
+        return
+
+    async for item in generate_or_replay(params):
+        yield item
+
+
+# 共享生成的生产者：排队等待名额后生成，结束时交还名额
+async def produce_flight(flight: Flight, params: dict, tokens: int, timeout: float) -> AsyncIterator[dict]:
+    ticket = await admission.acquire(tokens, params["priority"])
+    QUEUE_WAIT.observe(ticket.waited, priority=ticket.priority)
+    flight.started.set_result(ticket)
+    try:
+        if timeout > 0:
+            params["deadline"] = time.monotonic() + timeout
+        logger.debug(f"==== request ====\n{params}")
+        async for item in generate_or_replay(params):
+            yield item
+    finally:
+        admission.release(ticket)
+
+
+# 非流式请求：返回每个回复的最终结果，按 index 排序
+async def generate_choices(params: dict) -> List[dict]:
+    responses = {}
+    async for response in subscribe_or_generate(params):
+        responses[response.get("index", 0)] = response
+    return [responses[index] for index in sorted(responses)]
+
+
+# 非流式请求：客户端断开时取消生成
+async def cancel_on_disconnect(request: Request, awaitable):
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise Exception('客户端已断开')
+    finally:
+        task.cancel()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):  # collects GPU memory
+    # 没有加载模型时不处理批量任务，未完成的任务等下次加载模型时继续
+    if MODEL_BACKEND:
+        await batch_jobs.start()
     yield
+    await batch_jobs.stop()
+    storage_executor.shutdown(wait=False)
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
@@ -56,6 +299,25 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(AdmissionRejected)
+async def admission_exception_handler(request, exc: AdmissionRejected):
+    # 队列已满或排队超时，客户端按 Retry-After 重试
+    REQUESTS.inc(result="rejected")
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "success": False,
+            "message": exc.message
+        },
+        # 排队长度在发送时读取，是当前的值
+        headers={
+            "Retry-After": str(exc.retry_after),
+            "X-Queue-Position": str(exc.position),
+            "X-Queue-Depth": str(admission.queued),
+        },
+    )
+
+
 @app.exception_handler(Exception)
 async def generic_exception_handler(request, exc):
     # 处理异常
@@ -110,6 +372,17 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = None
     stream: Optional[bool] = False
     functions: Optional[Union[dict, List[dict]]] = None
+    stop: Optional[Union[str, List[str]]] = None
+    # 最长生成时间（秒）
+    timeout: Optional[float] = None
+    # 会话模式：messages 只包含新消息，历史消息从会话中读取
+    session_id: Optional[str] = None
+    # 采样的随机种子，指定后相同的请求得到相同的回复，可以使用响应缓存
+    seed: Optional[int] = None
+    # 优先级：interactive（默认）为交互式对话，bulk 为批量生成章节，也可以用请求头 X-Priority 指定
+    priority: Optional[Literal["interactive", "bulk"]] = None
+    # 回复数，多个回复共用一次预填充，流式输出时用 index 区分
+    n: Optional[int] = 1
     # Additional parameters
     repetition_penalty: Optional[float] = 1.1
 
@@ -141,6 +414,12 @@ class ChatCompletionResponse(BaseModel):
     usage: Optional[UsageInfo] = None
 
 
+# Prometheus 指标
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/v1/models", response_model=ModelList)
 async def list_models():
     model_card = ModelCard(id="chatglm3-6b")
@@ -153,22 +432,31 @@ async def list_models():
 # 获取书籍列表
 @app.get("/v1/books", response_model=BookList)
 async def fetchBooks():
-    books = writer.get_books()
+    books = await run_storage(writer.get_books)
     return BookList(data=books)
 
 
+# 获取书籍目录，只包含列表页需要的字段，按游标分页
+@app.get("/v1/books/catalog", response_model=BookSummaryList)
+async def fetchBookCatalog(cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=100),
+                           sort: str = 'createdAt', order: Literal['asc', 'desc'] = 'desc'):
+    summaries, next_cursor = await run_storage(
+        writer.get_book_summaries, cursor, limit, sort, order)
+    return BookSummaryList(data=summaries, nextCursor=next_cursor)
+
+
 # 创建书籍
 @app.post("/v1/books", response_model=BookList)
 async def createBook():
 
-    books = writer.create_book()
+    books = await run_storage(writer.create_book)
     return BookList(data=books)
 
 
 # 更新书籍
 @app.put("/v1/books/{book_id}", response_model=BookDetail)
 async def updateBook(book_id: str, request: BookType):
-    book_detail = writer.update_book(book_id, request)
+    book_detail = await run_storage(writer.update_book, book_id, request)
 
     return BookDetail(data=book_detail)  # type: ignore
 
@@ -176,7 +464,7 @@ async def updateBook(book_id: str, request: BookType):
 # 删除书籍
 @app.delete("/v1/books/{book_id}", response_model=BookList)
 async def deleteBook(book_id: str):
-    books = writer.delete_book(book_id)
+    books = await run_storage(writer.delete_book, book_id)
     return BookList(data=books)
 
 
@@ -184,11 +472,19 @@ async def deleteBook(book_id: str):
 # 章节相关接口
 ######################
 
+# 获取章节列表，fields 指定返回的章节字段，如 id,title,summary
+@app.get("/v1/books/{book_id}/chapters", response_model=ChapterFieldList)
+async def fetchChapters(book_id: str, fields: str = 'id,title,description,summary'):
+    chapters = await run_storage(
+        writer.get_chapter_fields, book_id, [field for field in fields.split(',') if field])
+    return ChapterFieldList(data=chapters)
+
+
 # 获取章节详情
 @app.get("/v1/books/{book_id}/chapters/{chapter_id}", response_model=ChapterDetail)
 async def fetchChapter(book_id: str, chapter_id: str):
 
-    chapter_detail = writer.get_chapter(book_id, chapter_id)
+    chapter_detail = await run_storage(writer.get_chapter, book_id, chapter_id)
 
     return ChapterDetail(data=chapter_detail)
 
@@ -196,21 +492,21 @@ async def fetchChapter(book_id: str, chapter_id: str):
 # 创建章节
 @app.post("/v1/books/{book_id}/chapters", response_model=BookList)
 async def create_chapter(book_id: str, request: ChapterType):
-    book_list = writer.create_chapter(book_id, request)
+    book_list = await run_storage(writer.create_chapter, book_id, request)
     return BookList(data=book_list)
 
 
 # 更新章节
 @app.put("/v1/books/{book_id}/chapters/{chapter_id}", response_model=BookList)
 async def update_chapter(book_id: str, chapter_id: str, request: ChapterType):
-    book_list = writer.update_chapter(book_id, chapter_id, request)
+    book_list = await run_storage(writer.update_chapter, book_id, chapter_id, request)
     return BookList(data=book_list)
 
 
 # 删除章节
 @app.delete("/v1/books/{book_id}/chapters/{chapter_id}", response_model=BookList)
 async def delete_chapter(book_id: str, chapter_id: str):
-    book_list = writer.delete_chapter(book_id, chapter_id)
+    book_list = await run_storage(writer.delete_chapter, book_id, chapter_id)
     return BookList(data=book_list)
 
 
@@ -222,28 +518,28 @@ async def delete_chapter(book_id: str, chapter_id: str):
 # 获取小说类型列表
 @app.get("/v1/books/novel-types", response_model=NovelTypeList)
 async def fetchNovelTypes():
-    novel_types = writer.get_novel_types()
+    novel_types = await run_storage(writer.get_novel_types)
     return NovelTypeList(data=novel_types)
 
 
 # 创建小说类型
 @app.post("/v1/books/novel-types", response_model=NovelTypeList)
 async def createNovelType(request: NovelType):
-    novel_types = writer.create_novel_type(request)
+    novel_types = await run_storage(writer.create_novel_type, request)
     return NovelTypeList(data=novel_types)
 
 
 #  更新小说类型
 @app.put("/v1/books/novel-types/{novel_type_label}", response_model=NovelTypeList)
 async def updateNovelType(novel_type_label: str, request: NovelType):
-    novel_types = writer.update_novel_type(novel_type_label, request)
+    novel_types = await run_storage(writer.update_novel_type, novel_type_label, request)
     return NovelTypeList(data=novel_types)
 
 
 # 删除小说类型
 @app.delete("/v1/books/novel-types/{novel_type_label}", response_model=NovelTypeList)
 async def deleteNovelType(novel_type_label: str):
-    novel_types = writer.delete_novel_type(novel_type_label)
+    novel_types = await run_storage(writer.delete_novel_type, novel_type_label)
     return NovelTypeList(data=novel_types)
 
 ##########################
@@ -254,53 +550,166 @@ async def deleteNovelType(novel_type_label: str):
 # 获取会话列表
 @app.get("/v1/sessions", response_model=SessionList)
 async def getSessions():
-    session_list = session.get_sessions()
+    session_list = await run_storage(session.get_sessions)
     return SessionList(data=session_list)
 
 
 # 新建会话
 @app.post("/v1/sessions", response_model=SessionList)
 async def createNewSession():
-    session_list = session.create_new_session()
+    session_list = await run_storage(session.create_new_session)
     return SessionList(data=session_list)
 
 
 # 删除会话
 @app.delete("/v1/sessions/{session_id}", response_model=SessionList)
 async def deleteSessionById(session_id: str):
-    sessions = session.delete_session(session_id)
+    sessions = await run_storage(session.delete_session, session_id)
     return SessionList(data=sessions)
 
 
 # 获取会话消息列表
 @app.get("/v1/sessions/{session_id}/messages", response_model=MessageList)
 async def getMessagesSessionById(session_id: str):
-    message_list = session.get_messages(session_id)
+    message_list = await run_storage(session.get_messages, session_id)
     return MessageList(data=message_list)
 
 
 # 更新会话消息
 @app.post("/v1/sessions/{session_id}/messages", response_model=MessageList)
 async def getSessionById(session_id: str, request: MessageType):
-    messages = session.update_message(session_id, request)
+    messages = await run_storage(session.update_message, session_id, request)
     return MessageList(data=messages)
 
 
 # 删除会话消息
 @app.delete("/v1/sessions/{session_id}/messages/{message_id}", response_model=MessageList)
 async def deleteMessage(session_id: str, message_id: str):
-    messages = session.delete_message(session_id, message_id)
+    messages = await run_storage(session.delete_message, session_id, message_id)
     return MessageList(data=messages)
 
 
+# 会话模式：读取历史消息并写入新消息，返回完整的消息列表和上一轮对话的 token
+def prepare_session_chat(session_id: str, messages: List[ChatMessage]) -> Tuple[List[ChatMessage], Optional[List[int]]]:
+    history = session.get_messages(session_id)
+    for message in messages:
+        session.append_message(session_id, MessageType(
+            role=message.role, content=message.content))
+
+    token_ids = session.get_session_tokens(
+        session_id, [item.id for item in history])
+    history = [ChatMessage(role=item.role, content=item.content)
+               for item in history if item.role in ("user", "assistant", "system")]
+    return history + messages, token_ids
+
+
+# 会话模式：保存回复，记录这一轮结束时对话的 token
+def finish_session_chat(session_id: str, response: dict) -> None:
+    messages = session.update_message(session_id, MessageType(
+        role="assistant", content=response["text"]))
+    if response.get("token_ids"):
+        session.set_session_tokens(
+            session_id, [item.id for item in messages], response["token_ids"])
+
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def create_chat_completion(request: ChatCompletionRequest):
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request, http_response: Response):
     global model, tokenizer
 
     if len(request.messages) < 1 or request.messages[-1].role == "assistant":
         raise HTTPException(status_code=400, detail="Invalid request??")
 
-    gen_params = dict(
+    # 断线重连：从 Last-Event-ID 之后继续发送，不重新生成；找不到时按新请求处理
+    last_event_id = raw_request.headers.get("Last-Event-ID")
+    if request.stream and last_event_id and stream_registry is not None:
+        events = stream_registry.resume(last_event_id)
+        if events is not None:
+            return EventSourceResponse(events, media_type="text/event-stream")
+        logger.warning(f"Stream {last_event_id} is not resumable, generating again")
+
+    gen_params = completion_params(
+        request, request.priority or raw_request.headers.get("X-Priority", "interactive"))
+    if gen_params["priority"] not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority: {gen_params['priority']}")
+    if not 1 <= gen_params["n"] <= MAX_CHOICES:
+        raise HTTPException(status_code=400, detail=f"Invalid n: must be between 1 and {MAX_CHOICES}")
+    if gen_params["n"] > 1 and request.session_id:
+        raise HTTPException(status_code=400, detail="Invalid n: sessions support only one choice")
+
+    # 确定性请求先查响应缓存，命中时不需要排队；会话模式的回复依赖历史消息，不缓存
+    if not request.session_id:
+        await lookup_response_cache(request, gen_params)
+    if "cached_response" in gen_params:
+        if request.stream:
+            return event_source(request.model, gen_params)
+        REQUESTS.inc(result="ok")
+        return chat_completion_response(
+            request, await generate_choices(gen_params))
+
+    timeout = generation_timeout(request)
+
+    # 排队等待生成名额，会话模式下历史消息也计入 token 数
+    contents = [message.content for message in request.messages]
+    if request.session_id:
+        history = await run_storage(session.get_messages, request.session_id)
+        contents += [item.content for item in history]
+    tokens = estimate_tokens(contents, gen_params["max_tokens"] * gen_params["n"])
+
+    # 相同的确定性请求共享同一次生成，截止时间以发起生成的请求为准
+    if SINGLE_FLIGHT and "cache_key" in gen_params:
+        flight_params = dict(gen_params)
+        subscriber = single_flight.join(gen_params["cache_key"], lambda flight: produce_flight(
+            flight, flight_params, tokens, timeout))
+        ticket = await subscriber.wait_started()
+        gen_params["subscriber"] = subscriber
+        if request.stream:
+            return event_source(request.model, gen_params, headers=ticket.headers())
+        try:
+            responses = await cancel_on_disconnect(raw_request, generate_choices(gen_params))
+        except BaseException:
+            REQUESTS.inc(result="error")
+            raise
+        REQUESTS.inc(result="ok")
+        http_response.headers.update(ticket.headers())
+        return chat_completion_response(request, responses)
+
+    ticket = await admission.acquire(tokens, gen_params["priority"])
+    QUEUE_WAIT.observe(ticket.waited, priority=ticket.priority)
+
+    try:
+        if timeout > 0:
+            gen_params["deadline"] = time.monotonic() + timeout
+
+        if request.session_id:
+            messages, token_ids = await run_storage(
+                prepare_session_chat, request.session_id, request.messages)
+            gen_params.update(messages=messages, session_id=request.session_id, retain_kv=True)
+            # 上一轮的 KV 保留在前缀缓存中，只需预填充新消息
+            if token_ids:
+                gen_params["prompt_ids"] = build_session_input(
+                    tokenizer, token_ids, request.messages)
+
+        logger.debug(f"==== request ====\n{gen_params}")
+
+        if request.stream:
+            return event_source(request.model, gen_params, ticket, ticket.headers())
+
+        responses = await cancel_on_disconnect(raw_request, generate_choices(gen_params))
+    except BaseException:
+        admission.release(ticket)
+        REQUESTS.inc(result="error")
+        raise
+    admission.release(ticket)
+    REQUESTS.inc(result="ok")
+
+    if request.session_id:
+        await run_storage(finish_session_chat, request.session_id, responses[0])
+    http_response.headers.update(ticket.headers())
+    return chat_completion_response(request, responses)
+
+
+def completion_params(request: ChatCompletionRequest, priority: str) -> dict:
+    return dict(
         messages=request.messages,
         temperature=request.temperature,
         top_p=request.top_p,
@@ -309,116 +718,259 @@ async def create_chat_completion(request: ChatCompletionRequest):
         stream=request.stream,
         repetition_penalty=request.repetition_penalty,
         functions=request.functions,
+        stop=request.stop,
+        seed=request.seed,
+        n=request.n if request.n is not None else 1,
+        priority=priority,
     )
 
-    logger.debug(f"==== request ====\n{gen_params}")
 
-    if request.stream:
-        generate = predict(request.model, gen_params)
-        return EventSourceResponse(generate, media_type="text/event-stream")
+# 确定性请求记录缓存键，命中时把缓存的回复放入 gen_params["cached_response"]
+async def lookup_response_cache(request: ChatCompletionRequest, gen_params: dict) -> None:
+    if response_cache is None and not SINGLE_FLIGHT:
+        return
+    # 推测解码的方式也计入缓存键，开关推测解码后不会命中之前生成的回复
+    cache_key = response_cache_key(request.model, gen_params,
+                                   f"{MODEL_BACKEND or MODEL_PATH}:{SPECULATIVE if SCHEDULER == 'batch' else ''}")
+    if cache_key:
+        gen_params["cache_key"] = cache_key
+    if cache_key and response_cache is not None:
+        cached_response = await run_storage(response_cache.get, cache_key)
+        if cached_response is not None:
+            gen_params["cached_response"] = cached_response
 
-    response = generate_chatglm3(model, tokenizer, gen_params)
-    usage = UsageInfo()
 
-    function_call, finish_reason = None, "stop"
-    if request.functions:
-        try:
-            function_call = process_response(response["text"], use_tool=True)
-        except:
-            logger.warning("Failed to parse tool call")
-
-    if isinstance(function_call, dict):
-        finish_reason = "function_call"
-        function_call = FunctionCallResponse(**function_call)
-
-    message = ChatMessage(
-        role="assistant",
-        content=response["text"],
-        function_call=function_call if isinstance(
-            function_call, FunctionCallResponse) else None,
-    )
+def generation_timeout(request: ChatCompletionRequest) -> float:
+    timeout = request.timeout or GENERATION_TIMEOUT
+    if GENERATION_TIMEOUT > 0:
+        timeout = min(timeout, GENERATION_TIMEOUT)
+    return timeout
 
-    choice_data = ChatCompletionResponseChoice(
-        index=0,
-        message=message,
-        finish_reason=finish_reason,
-    )
-
-    task_usage = UsageInfo.model_validate(response["usage"])
-    for usage_key, usage_value in task_usage.model_dump().items():
-        setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
-
-    return ChatCompletionResponse(model=request.model, choices=[choice_data], object="chat.completion", usage=usage)
 
+# 多个回复的 prompt 相同，prompt_tokens 只计一次，completion_tokens 为所有回复之和
+def chat_completion_response(request: ChatCompletionRequest, responses: List[dict]) -> ChatCompletionResponse:
+    usage = UsageInfo()
+    choices = []
+    for index, response in enumerate(responses):
+        function_call, finish_reason = None, "stop"
+        if request.functions:
+            try:
+                function_call = process_response(response["text"], use_tool=True)
+            except:
+                logger.warning("Failed to parse tool call")
 
-async def predict(model_id: str, params: dict):
-    global model, tokenizer
+        if isinstance(function_call, dict):
+            finish_reason = "function_call"
+            function_call = FunctionCallResponse(**function_call)
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(role="assistant"),
-        finish_reason=None
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[
-                                   choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+        message = ChatMessage(
+            role="assistant",
+            content=response["text"],
+            function_call=function_call if isinstance(
+                function_call, FunctionCallResponse) else None,
+        )
 
-    previous_text = ""
-    for new_response in generate_stream_chatglm3(model, tokenizer, params):
+        choices.append(ChatCompletionResponseChoice(
+            index=index,
+            message=message,
+            finish_reason=finish_reason,
+        ))
+
+        task_usage = UsageInfo.model_validate(response["usage"])
+        usage.prompt_tokens = task_usage.prompt_tokens
+        usage.completion_tokens += task_usage.completion_tokens
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+
+    return ChatCompletionResponse(model=request.model, choices=choices, object="chat.completion", usage=usage)
+
+
+# 流式响应；开启断线续传时在后台任务中生成，事件带 id，客户端断开后可以用 Last-Event-ID 重连
+# 响应体没有开始发送时 predict 不会运行，名额在响应结束或后台任务结束时交还
+def event_source(model_id: str, params: dict, ticket: Optional[Ticket] = None,
+                 headers: Optional[Dict[str, str]] = None) -> EventSourceResponse:
+    if stream_registry is None:
+        return EventSourceResponse(
+            predict(model_id, params, ticket), media_type="text/event-stream", headers=headers,
+            background=BackgroundTask(admission.release, ticket) if ticket is not None else None)
+
+    request_id = f"chatcmpl-{uuid.uuid4().hex}"
+    stream = stream_registry.start(request_id, predict(model_id, params, ticket, request_id))
+    if ticket is not None:
+        stream.task.add_done_callback(lambda task: admission.release(ticket))
+    return EventSourceResponse(stream.events(), media_type="text/event-stream", headers=headers)
+
+
+async def predict(model_id: str, params: dict, ticket: Optional[Ticket] = None, request_id: Optional[str] = None):
+    result = "cancelled"
+    try:
+        async for item in stream_chunks(model_id, params, request_id):
+            yield item
+        result = "ok"
+    except Exception:
+        result = "error"
+        raise
+    finally:
+        REQUESTS.inc(result=result)
+        # 生成结束或客户端断开时交还名额
+        if ticket is not None:
+            admission.release(ticket)
+
+
+async def stream_chunks(model_id: str, params: dict, request_id: Optional[str] = None):
+    encoder = ChunkEncoder(model_id, request_id)
+    n = params.get("n") or 1
+    # n > 1 时每个回复分别计算增量和合并，chunk 带各自的 index
+    coalescers = [ChunkCoalescer(STREAM_COALESCE_MS / 1000, STREAM_COALESCE_CHARS) for _ in range(n)]
+    for index in range(n):
+        yield encoder.role(index)
+
+    previous_texts, responses = [""] * n, [None] * n
+    source = subscribe_or_generate(params)
+    if STREAM_COALESCE_MS > 0:
+        # 生成停顿时合并中的文本不等下一个 token，到时间就发送
+        source = iterate_with_timeout(source, lambda: min(
+            (delay for delay in (coalescer.delay() for coalescer in coalescers) if delay is not None),
+            default=None))
+    # 生成在推理线程或调度器中进行，事件循环只负责转发结果
+    async for new_response in source:
+        if new_response is None:
+            for index, coalescer in enumerate(coalescers):
+                if coalescer.delay() == 0:
+                    yield encoder.content(coalescer.flush(), index=index)
+            continue
+        index = new_response.get("index", 0)
+        coalescer = coalescers[index]
+        responses[index] = new_response
         decoded_unicode = new_response["text"]
-        delta_text = decoded_unicode[len(previous_text):]
-        previous_text = decoded_unicode
+        delta_text = decoded_unicode[len(previous_texts[index]):]
+        previous_texts[index] = decoded_unicode
 
         finish_reason = new_response["finish_reason"]
-        if len(delta_text) == 0 and finish_reason != "function_call":
-            continue
-
-        function_call = None
         if finish_reason == "function_call":
+            function_call = None
             try:
                 function_call = process_response(
                     decoded_unicode, use_tool=True)
             except:
                 print("Failed to parse tool call")
 
-        if isinstance(function_call, dict):
-            function_call = FunctionCallResponse(**function_call)
+            if isinstance(function_call, dict):
+                function_call = FunctionCallResponse(**function_call).model_dump()
+            else:
+                function_call = None
+            yield encoder.function_call((coalescer.flush() or "") + delta_text, function_call, index)
+            continue
 
-        delta = DeltaMessage(
-            content=delta_text,
-            role="assistant",
-            function_call=function_call if isinstance(
-                function_call, FunctionCallResponse) else None,
-        )
+        if len(delta_text) == 0:
+            continue
 
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=delta,
-            finish_reason=finish_reason
-        )
-        chunk = ChatCompletionResponse(model=model_id, choices=[
-                                       choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
-
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(),
-        finish_reason="stop"
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[
-                                   choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+        text = coalescer.add(delta_text)
+        if text:
+            start = time.perf_counter()
+            chunk = encoder.content(text, index=index)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="serialize")
+            yield chunk
+
+    for index, coalescer in enumerate(coalescers):
+        text = coalescer.flush()
+        if text:
+            yield encoder.content(text, index=index)
+
+    if params.get("session_id") and responses[0] is not None:
+        await run_storage(finish_session_chat, params["session_id"], responses[0])
+
+    for index in range(n):
+        yield encoder.finish("stop", index)
     yield '[DONE]'
 
 
+# 批量任务中的一个请求：与非流式的 /v1/chat/completions 相同，按 bulk 优先级排队，只输出最终结果
+async def run_batch_request(body: dict) -> dict:
+    request = ChatCompletionRequest.model_validate(body)
+    if len(request.messages) < 1 or request.messages[-1].role == "assistant":
+        raise Exception('最后一条消息不能是 assistant')
+    if request.stream or request.session_id:
+        raise Exception('批量任务不支持流式输出和会话模式')
+
+    gen_params = completion_params(request, "bulk")
+    gen_params["partial_outputs"] = False
+    if not 1 <= gen_params["n"] <= MAX_CHOICES:
+        raise Exception(f'n 必须在 1 到 {MAX_CHOICES} 之间')
+    await lookup_response_cache(request, gen_params)
+    if "cached_response" in gen_params:
+        return chat_completion_response(request, await generate_choices(gen_params)).model_dump()
+
+    tokens = estimate_tokens([message.content for message in request.messages],
+                             gen_params["max_tokens"] * gen_params["n"])
+    while True:
+        try:
+            ticket = await admission.acquire(tokens, "bulk")
+            break
+        except AdmissionRejected as e:
+            # 队列已满或排队超时时稍后重试，批量任务不因为繁忙而失败
+            await asyncio.sleep(e.retry_after)
+    QUEUE_WAIT.observe(ticket.waited, priority=ticket.priority)
+
+    try:
+        timeout = generation_timeout(request)
+        if timeout > 0:
+            gen_params["deadline"] = time.monotonic() + timeout
+        responses = await generate_choices(gen_params)
+    finally:
+        admission.release(ticket)
+    return chat_completion_response(request, responses).model_dump()
+
+
+batch_jobs = BatchJobs(BATCH_PATH, run_batch_request, BATCH_CONCURRENCY)
+registry.register(Gauge('writer_batch_jobs', '批量任务数，按状态统计', batch_jobs.stats))
+
+
+# 提交批量任务，请求体为 JSONL，每行为 {"custom_id", "method", "url", "body"}
+@app.post("/v1/batches", response_model=BatchObject)
+async def create_batch(raw_request: Request):
+    text = (await raw_request.body()).decode("utf-8")
+    try:
+        batch = await batch_jobs.create(text)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return BatchObject.model_validate(batch)
+
+
+@app.get("/v1/batches", response_model=BatchList)
+async def list_batches():
+    return BatchList(data=[BatchObject.model_validate(batch) for batch in batch_jobs.list()])
+
+
+@app.get("/v1/batches/{batch_id}", response_model=BatchObject)
+async def retrieve_batch(batch_id: str):
+    batch = batch_jobs.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return BatchObject.model_validate(batch)
+
+
+@app.post("/v1/batches/{batch_id}/cancel", response_model=BatchObject)
+async def cancel_batch(batch_id: str):
+    batch = await batch_jobs.cancel(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return BatchObject.model_validate(batch)
+
+
+# 已完成请求的输出，每行带 custom_id 和 usage；任务进行中时返回目前完成的部分
+@app.get("/v1/batches/{batch_id}/output")
+async def fetch_batch_output(batch_id: str):
+    if batch_jobs.get(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return PlainTextResponse(await run_storage(batch_jobs.read_output, batch_id), media_type="application/jsonl")
+
+
 if __name__ == "__main__":
 
-    # tokenizer = AutoTokenizer.from_pretrained(
-    #     TOKENIZER_PATH, trust_remote_code=True)
-    # if 'cuda' in DEVICE:  # AMD, NVIDIA GPU can use Half Precision
-    #     model = AutoModel.from_pretrained(
-    #         MODEL_PATH, trust_remote_code=True).to(DEVICE).eval()
-    # else:  # CPU, Intel GPU and other GPU can use Float16 Precision Only
-    #     model = AutoModel.from_pretrained(
-    #         MODEL_PATH, trust_remote_code=True).half().to(DEVICE).eval()
+    # MODEL_BACKEND 为空时不加载模型，只提供书籍和会话接口；tiny、echo 在 CPU 上运行
+    if MODEL_BACKEND:
+        model, tokenizer = load_model(MODEL_BACKEND, MODEL_PATH, TOKENIZER_PATH,
+                                      DEVICE if MODEL_BACKEND == 'chatglm' else 'cpu')
+    if SPECULATIVE and SCHEDULER != 'batch':
+        logger.warning("SPECULATIVE only applies to SCHEDULER=batch")
     uvicorn.run(app, host='0.0.0.0', port=8600, workers=1)
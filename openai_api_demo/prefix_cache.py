@@ -0,0 +1,175 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from engine import KVLayers, ModelRunner
+
+
+class PrefixNode:
+    """
+    基数树的一个节点，保存这一段 token 及其对应的 KV
+    """
+
+    def __init__(self, tokens: List[int], layers: Optional[KVLayers], parent: Optional['PrefixNode'], nbytes: int = 0):
+        self.tokens = tokens
+        self.layers = layers
+        self.parent = parent
+        self.children: Dict[int, PrefixNode] = {}
+        self.nbytes = nbytes
+        self.last_access = 0
+
+
+class PrefixCache:
+    """
+    按 token 前缀缓存 past_key_values
+
+    写作请求的开头总是相同的系统提示词、小说类型提示词和书籍简介，
+    命中最长的已缓存前缀后只需预填充剩余的 token。
+    超过内存上限时按最近最少使用淘汰叶子节点。
+    """
+
+    def __init__(self, runner: ModelRunner, max_bytes: int):
+        self.runner = runner
+        self.max_bytes = max_bytes
+        self.root = PrefixNode([], None, None)
+        self.nbytes = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+
+        # 统计信息
+        self.queries = 0
+        self.hits = 0
+        self.query_tokens = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def _touch(self, node: PrefixNode) -> None:
+        self.clock += 1
+        while node is not None:
+            node.last_access = self.clock
+            node = node.parent
+
+    @staticmethod
+    def _common_length(a: List[int], b: List[int]) -> int:
+        length = min(len(a), len(b))
+        for i in range(length):
+            if a[i] != b[i]:
+                return i
+        return length
+
+    # 返回命中的前缀长度和对应的 KV，至少留一个 token 用于计算下一个 token 的 logits
+    def match(self, tokens: List[int]) -> Tuple[int, Optional[KVLayers]]:
+        tokens = tokens[:len(tokens) - 1]
+        with self.lock:
+            self.queries += 1
+            self.query_tokens += len(tokens) + 1
+
+            node, position, segments = self.root, 0, []
+            while position < len(tokens):
+                child = node.children.get(tokens[position])
+                if child is None:
+                    break
+                common = self._common_length(child.tokens, tokens[position:])
+                if common < len(child.tokens):
+                    segments.append(self.runner.kv_slice(child.layers, 0, common))
+                    position += common
+                    node = child
+                    break
+                segments.append(child.layers)
+                position += common
+                node = child
+
+            if not position:
+                return 0, None
+            self._touch(node)
+            self.hits += 1
+            self.hit_tokens += position
+
+        return position, self.runner.kv_cat_seq(segments)
+
+    # 缓存 tokens 的 KV，layers 的长度可以大于 tokens，多出的部分忽略
+    def insert(self, tokens: List[int], layers: KVLayers) -> None:
+        if not tokens or self.max_bytes <= 0:
+            return
+
+        runner = self.runner
+        with self.lock:
+            node, position = self.root, 0
+            while position < len(tokens):
+                child = node.children.get(tokens[position])
+                if child is None:
+                    break
+                common = self._common_length(child.tokens, tokens[position:])
+                position += common
+                if common < len(child.tokens):
+                    self._split(child, common)
+                    node = child.parent
+                    break
+                node = child
+
+            if position < len(tokens):
+                segment = runner.kv_clone(runner.kv_slice(
+                    layers, position, len(tokens)))
+                nbytes = runner.kv_nbytes(segment)
+                if nbytes > self.max_bytes:
+                    self._touch(node)
+                    return
+                leaf = PrefixNode(tokens[position:], segment, node, nbytes)
+                node.children[leaf.tokens[0]] = leaf
+                self.nbytes += nbytes
+                node = leaf
+
+            self._touch(node)
+            self._evict(keep=node)
+
+    # 把节点在 length 处分成两段
+    def _split(self, node: PrefixNode, length: int) -> None:
+        runner = self.runner
+        head_layers = runner.kv_clone(runner.kv_slice(node.layers, 0, length))
+        tail_layers = runner.kv_clone(runner.kv_slice(node.layers, length))
+
+        head = PrefixNode(node.tokens[:length], head_layers, node.parent,
+                          runner.kv_nbytes(head_layers))
+        head.last_access = node.last_access
+        node.parent.children[head.tokens[0]] = head
+
+        tail_nbytes = runner.kv_nbytes(tail_layers)
+        self.nbytes += head.nbytes + tail_nbytes - node.nbytes
+        node.tokens = node.tokens[length:]
+        node.layers = tail_layers
+        node.nbytes = tail_nbytes
+        node.parent = head
+        head.children[node.tokens[0]] = node
+
+    def _evict(self, keep: Optional[PrefixNode] = None) -> None:
+        while self.nbytes > self.max_bytes:
+            leaves = []
+            stack = list(self.root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node is not keep:
+                    leaves.append(node)
+            if not leaves:
+                return
+
+            node = min(leaves, key=lambda item: item.last_access)
+            del node.parent.children[node.tokens[0]]
+            self.nbytes -= node.nbytes
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.root = PrefixNode([], None, None)
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "bytes": self.nbytes,
+                "queries": self.queries,
+                "hits": self.hits,
+                "query_tokens": self.query_tokens,
+                "hit_tokens": self.hit_tokens,
+                "evictions": self.evictions,
+            }
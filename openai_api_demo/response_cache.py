@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+# temperature 不超过该值时按贪心解码，与 generate_stream_chatglm3 一致
+GREEDY_TEMPERATURE = 1e-5
+
+
+# 请求的缓存键：模型、消息、工具和采样参数的规范化 JSON 的 sha256
+# 只有确定性的请求可以缓存：贪心解码，或者指定了 seed 的采样；n > 1 的多个回复不缓存
+def response_cache_key(model_id: str, params: dict, namespace: str = '') -> Optional[str]:
+    if (params.get("n") or 1) > 1:
+        return None
+    temperature = float(params.get("temperature") or 0)
+    seed = params.get("seed")
+    greedy = temperature <= GREEDY_TEMPERATURE
+    if not greedy and seed is None:
+        return None
+
+    stop = params.get("stop")
+    messages = [message.model_dump(exclude_none=True) if hasattr(message, "model_dump") else message
+                for message in params["messages"]]
+    key = {
+        "namespace": namespace,
+        "model": model_id,
+        "messages": messages,
+        "functions": params.get("functions"),
+        "max_tokens": params.get("max_tokens"),
+        "repetition_penalty": params.get("repetition_penalty"),
+        "stop": [stop] if isinstance(stop, str) else stop,
+        "echo": params.get("echo"),
+    }
+    # 贪心解码时 top_p 和 seed 不影响结果
+    if not greedy:
+        key.update(temperature=temperature, top_p=params.get("top_p"), seed=seed)
+    text = json.dumps(key, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# 把缓存的回复按 chunk_chars 个字符一段重新切分，格式与 generate_stream_chatglm3 的输出相同
+def replay_response(response: dict, chunk_chars: int = 4) -> Iterator[dict]:
+    text, usage = response["text"], response["usage"]
+    chunk_chars = max(1, chunk_chars)
+    for end in range(chunk_chars, len(text), chunk_chars):
+        yield {"text": text[:end], "usage": usage, "finish_reason": None}
+    if response.get("finish_reason") == "function_call":
+        yield {"text": text, "usage": usage, "finish_reason": "function_call"}
+    yield {"text": text, "usage": usage, "finish_reason": "stop"}
+
+
+class ResponseCache:
+    """
+    确定性请求的响应缓存
+
+    写作时经常用 temperature 为 0 的请求重新生成同样的大纲、书名，相同的输入得到相同的输出，
+    命中时直接返回缓存的回复，不再占用推理名额。
+    内存中按最近最少使用保留 max_entries 条；设置 disk_path 时同时写入磁盘，
+    内存未命中时从磁盘读取，服务重启后仍可命中。
+    """
+
+    def __init__(self, max_entries: int, disk_path: str = ''):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.entries: 'OrderedDict[str, dict]' = OrderedDict()
+        self.lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.disk_path, key[:2], f'{key}.json')
+
+    def _remember(self, key: str, entry: dict) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = None
+        if self.disk_path:
+            try:
+                with open(self._file(key), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key: str, response: dict) -> None:
+        entry = {
+            "text": response["text"],
+            "usage": response["usage"],
+            "finish_reason": response.get("finish_reason") or "stop",
+        }
+        with self.lock:
+            self._remember(key, entry)
+            self.stores += 1
+
+        if self.disk_path:
+            # 先写临时文件再替换，读到的总是完整的 JSON
+            path = self._file(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,149 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+
+class ResumableStream:
+    """
+    可以断线续传的流式响应
+
+    生成在单独的任务中进行，每个事件带有递增的 id（stream_id:序号），最近 max_events 个事件保存在缓冲中。
+    所有连接都断开后继续生成 grace 秒，期间客户端带上 Last-Event-ID 重新连接，从断开处继续接收，不重新生成；
+    超过 grace 秒没有重连，或者没有发送的事件超出缓冲（重连后也无法续传）时停止生成并丢弃缓冲。
+    """
+
+    def __init__(self, registry: 'StreamRegistry', stream_id: str, source: AsyncIterator[str]):
+        self.registry = registry
+        self.id = stream_id
+        self.buffer: Deque[Tuple[int, str]] = deque(maxlen=registry.max_events)
+        self.seq = 0
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        # 已经发送给客户端的最大序号，断开期间缓冲不能丢弃它之后的事件
+        self.sent = 0
+        self.updated = asyncio.Event()
+        self.attached = 0
+        # 没有连接时开始计时，客户端一直没有接收也会按时停止
+        self.expire_handle: Optional[asyncio.TimerHandle] = asyncio.get_running_loop().call_later(
+            registry.grace, self._expire)
+        self.task = asyncio.ensure_future(self._produce(source))
+
+    async def _produce(self, source: AsyncIterator[str]) -> None:
+        try:
+            async for data in source:
+                self.seq += 1
+                self.buffer.append((self.seq, data))
+                self._notify()
+                if not self.attached and not self.available(self.sent):
+                    self._overflow()
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+        # 缓冲溢出提前结束时停止生成
+        if hasattr(source, "aclose"):
+            await source.aclose()
+
+    def _notify(self) -> None:
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    # 缓冲中是否还保留 seq 之后的所有事件
+    def available(self, seq: int) -> bool:
+        if seq > self.seq:
+            return False
+        return not self.buffer or self.buffer[0][0] <= seq + 1
+
+    def _attach(self) -> None:
+        self.attached += 1
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+
+    def _detach(self) -> None:
+        self.attached -= 1
+        if self.attached == 0:
+            self.expire_handle = asyncio.get_running_loop().call_later(
+                self.registry.grace, self._expire)
+
+    # 断开期间没有发送的事件被挤出缓冲，重连也无法续传，立即丢弃
+    def _overflow(self) -> None:
+        self.error = Exception('断线期间的输出已从缓冲中丢弃')
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        self.registry.expired += 1
+        self.registry.streams.pop(self.id, None)
+
+    def _expire(self) -> None:
+        self.expire_handle = None
+        if self.attached > 0:
+            return
+        if not self.task.done():
+            self.task.cancel()
+            self.registry.expired += 1
+        self.registry.streams.pop(self.id, None)
+
+    # 发送 last_seq 之后的事件，直到生成结束
+    async def events(self, last_seq: int = 0) -> AsyncIterator[dict]:
+        self._attach()
+        try:
+            while True:
+                updated = self.updated
+                if not self.available(last_seq):
+                    raise Exception('断线期间的输出已从缓冲中丢弃')
+                for seq, data in [item for item in self.buffer if item[0] > last_seq]:
+                    self.sent = max(self.sent, seq)
+                    yield {"id": f"{self.id}:{seq}", "data": data}
+                    last_seq = seq
+                if last_seq < self.seq:
+                    continue
+                if self.finished:
+                    break
+                await updated.wait()
+            if self.error is not None:
+                raise self.error
+        finally:
+            self._detach()
+
+
+class StreamRegistry:
+    """
+    按 stream_id 记录可以续传的流式响应
+    """
+
+    def __init__(self, grace: float, max_events: int):
+        self.grace = grace
+        self.max_events = max_events
+        self.streams: Dict[str, ResumableStream] = {}
+
+        # 统计信息
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+
+    def start(self, stream_id: str, source: AsyncIterator[str]) -> ResumableStream:
+        stream = self.streams[stream_id] = ResumableStream(self, stream_id, source)
+        self.started += 1
+        return stream
+
+    # 根据 Last-Event-ID 找到断开的响应，返回从断开处继续的事件；找不到或缓冲已丢弃时返回 None
+    def resume(self, last_event_id: str) -> Optional[AsyncIterator[dict]]:
+        stream_id, _, seq = last_event_id.rpartition(':')
+        stream = self.streams.get(stream_id)
+        if stream is None or not seq.isdigit() or not stream.available(int(seq)):
+            return None
+        self.resumed += 1
+        return stream.events(int(seq))
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.streams),
+            "started": self.started,
+            "resumed": self.resumed,
+            "expired": self.expired,
+        }
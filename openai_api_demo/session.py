@@ -1,11 +1,15 @@
 from __future__ import unicode_literals
-from typing import List, Dict
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
 from pydantic import BaseModel
 import os
 import json
 import datetime
+import threading
 import uuid
 
+from storage import create_session_storage
+
 
 class SessionType(BaseModel):
     id: str
@@ -42,45 +46,47 @@ class SessionDetail(BaseModel):
 # 对话目录
 SESSION_PATH = './sessions'
 
+session_storage = create_session_storage(SESSION_PATH)
+
+# 最多缓存多少个会话的消息
+MESSAGE_CACHE_MAX = int(os.environ.get('MESSAGE_CACHE_MAX', '64'))
+
+# 已解析的会话消息，按日志文件的版本标记判断是否过期，按最近使用淘汰；只在 session_storage.lock 内访问
+message_cache: 'OrderedDict[str, Tuple[Tuple[int, int], List[MessageType]]]' = OrderedDict()
+
+# 最多记录多少个会话的对话 token
+SESSION_TOKENS_MAX = int(os.environ.get('SESSION_TOKENS_MAX', '256'))
+
+# 会话上一轮结束时对话的 token 及对应的消息 id，KV 保存在前缀缓存中
+session_tokens: 'OrderedDict[str, Tuple[List[str], List[int]]]' = OrderedDict()
+session_tokens_lock = threading.Lock()
+
 
 # 新建对话目录
 def create_session_dir() -> bool:
-    # 新建对话目录
-    session_dir = os.path.join(SESSION_PATH)
-    session_config_path = os.path.join(session_dir, 'config.json')
-    if not os.path.exists(session_dir):
-        os.mkdir(session_dir)
-        if not os.path.exists(session_config_path):
-            with open(session_config_path, "w") as f:
-                f.write(json.dumps([]))
+    session_storage.init()
 
     return True
 
 
 # 保存对话文件列表
 def save_sessions(sessions: List[SessionType]) -> bool:
-    create_session_dir()
-    session_file_path = os.path.join(SESSION_PATH, 'config.json')
     data = []
     for session in sessions:
-        data.append(session.dict())
+        data.append(session.model_dump())
 
-    with open(session_file_path, "w") as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+    session_storage.save_sessions(data)
 
     return True
 
 
-# 保存对话文件列表
+# 保存对话消息，整体重写该会话的消息日志
 def save_messages(session_id: str, messages: List[MessageType]) -> bool:
-    create_session_dir()
-    session_file_path = os.path.join(SESSION_PATH, session_id + '.json')
-    data = []
-    for message in messages:
-        data.append(message.dict())
-
-    with open(session_file_path, "w") as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+    with session_storage.lock:
+        session_storage.init()
+        session_storage.write_messages(
+            session_id, [message.model_dump() for message in messages])
+        message_cache.pop(session_id, None)
 
     return True
 
@@ -89,11 +95,8 @@ def save_messages(session_id: str, messages: List[MessageType]) -> bool:
 def get_sessions() -> List[SessionType]:
     create_session_dir()
 
-    # 读取 config.json 文件
-    session_file_path = os.path.join(SESSION_PATH, 'config.json')
-    with open(session_file_path, "r") as f:
-        data = json.loads(f.read())
-        sessions: List[SessionType] = [SessionType(**item) for item in data]
+    sessions: List[SessionType] = [SessionType(**item)
+                                   for item in session_storage.load_sessions()]
 
     return sessions
 
@@ -102,25 +105,38 @@ def get_sessions() -> List[SessionType]:
 def get_session(session_id: str) -> SessionType:
     sessions = get_sessions()
     session = next(
-        (item for item in sessions if item.id == session_id))
+        (item for item in sessions if item.id == session_id), None)
     if not session:
         raise Exception('会话不存在')
 
     return session
 
 
-# 获取对话消息列表
-def get_messages(session_id: str) -> List[MessageType]:
+# 与日志版本一致的缓存消息，没有缓存或已过期时返回 None
+def _cached_messages(session_id: str) -> Optional[List[MessageType]]:
+    cached = message_cache.get(session_id)
+    if cached is None or cached[0] != session_storage.log_stamp(session_id):
+        return None
+    message_cache.move_to_end(session_id)
+    return cached[1]
 
-    message_file_path = os.path.join(SESSION_PATH, session_id + ".json")
-    if not os.path.exists(message_file_path):
-        return []
 
-    with open(message_file_path, "r") as f:
-        data = json.loads(f.read())
-        messages: List[MessageType] = [MessageType(**item) for item in data]
+def _cache_messages(session_id: str, messages: List[MessageType]) -> None:
+    message_cache[session_id] = (session_storage.log_stamp(session_id), messages)
+    message_cache.move_to_end(session_id)
+    while len(message_cache) > MESSAGE_CACHE_MAX:
+        message_cache.popitem(last=False)
 
-    return messages
+
+# 获取对话消息列表
+def get_messages(session_id: str) -> List[MessageType]:
+    with session_storage.lock:
+        messages = _cached_messages(session_id)
+        if messages is None:
+            messages = [MessageType(**item) for item in session_storage.iter_messages(session_id)]
+            _cache_messages(session_id, messages)
+
+        return list(messages)
 
 
 # 新建会话
@@ -141,7 +157,10 @@ def create_new_session() -> List[SessionType]:
 # 更新会话
 def update_session(session_id: str, session: SessionType) -> List[SessionType]:
     sessions = get_sessions()
-    old_session = next((item for item in sessions if item.id == session_id))
+    old_session = next(
+        (item for item in sessions if item.id == session_id), None)
+    if not old_session:
+        raise Exception('会话不存在')
     old_session.name = session.name
 
     save_sessions(sessions)
@@ -149,51 +168,92 @@ def update_session(session_id: str, session: SessionType) -> List[SessionType]:
     return sessions
 
 
-# 更新会话消息
-def update_message(session_id: str, message: MessageType) -> List[MessageType]:
+# 追加一条会话消息，只在日志末尾写一行，不读取已有的消息
+def append_message(session_id: str, message: MessageType) -> MessageType:
     # 获取对话文件名
     session = get_session(session_id)
 
+    # 只有第一条消息会修改会话名称，之后不再重写会话列表
     if (session.name == '新会话'):
         session.name = message.content[:10]
         update_session(session_id, session)
 
-    # 获取对话
-    messages = get_messages(session_id)
-    messages.append(MessageType(
+    new_message = MessageType(
         id=str(uuid.uuid4()),
         role=message.role,
         content=message.content
-    ))
-    save_messages(session_id, messages)
+    )
+
+    # 在日志末尾追加一行，消息已缓存时同时更新缓存
+    with session_storage.lock:
+        messages = _cached_messages(session_id)
+        session_storage.append_message(session_id, new_message.model_dump())
+        if messages is not None:
+            messages.append(new_message)
+            _cache_messages(session_id, messages)
+
+    return new_message
+
+
+# 更新会话消息，返回全部消息
+def update_message(session_id: str, message: MessageType) -> List[MessageType]:
+    append_message(session_id, message)
+
+    return get_messages(session_id)
+
 
-    return messages
+# 获取会话的对话 token，消息有增删时返回 None
+def get_session_tokens(session_id: str, message_ids: List[str]) -> Optional[List[int]]:
+    with session_tokens_lock:
+        item = session_tokens.get(session_id)
+        if item is None or item[0] != message_ids:
+            return None
+        session_tokens.move_to_end(session_id)
+        return item[1]
+
+
+# 记录会话的对话 token
+def set_session_tokens(session_id: str, message_ids: List[str], token_ids: List[int]) -> None:
+    with session_tokens_lock:
+        session_tokens[session_id] = (message_ids, token_ids)
+        session_tokens.move_to_end(session_id)
+        while len(session_tokens) > SESSION_TOKENS_MAX:
+            session_tokens.popitem(last=False)
 
 
 # 删除会话
 def delete_session(session_id: str) -> List[SessionType]:
     sessions = get_sessions()
-    session = next((item for item in sessions if item.id == session_id))
+    session = next(
+        (item for item in sessions if item.id == session_id), None)
+    if not session:
+        raise Exception('会话不存在')
     sessions.remove(session)
 
     save_sessions(sessions)
 
     # 删除会话消息文件
-    message_file_path = os.path.join(SESSION_PATH, session_id + '.json')
-    if os.path.exists(message_file_path):
-        os.remove(message_file_path)
+    with session_storage.lock:
+        session_storage.delete_session(session_id)
+        message_cache.pop(session_id, None)
+    with session_tokens_lock:
+        session_tokens.pop(session_id, None)
 
     return sessions
 
 
 # 删除消息
 def delete_message(session_id: str, message_id: str) -> List[MessageType]:
-    messages = get_messages(session_id)
-    message = next(item for item in messages if item.id == message_id)
-    # 删除消息
-    messages.remove(message)
-
-    # 获取对话文件名
-    save_messages(session_id, messages)
-
-    return messages
+    with session_storage.lock:
+        messages = get_messages(session_id)
+        message = next(
+            (item for item in messages if item.id == message_id), None)
+        if not message:
+            raise Exception('消息不存在')
+
+        # 追加删除记录，日志中失效记录过多时会自动压缩
+        session_storage.delete_message(session_id, message_id)
+        messages = [item for item in messages if item.id != message_id]
+        _cache_messages(session_id, messages)
+
+    return list(messages)
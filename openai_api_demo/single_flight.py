@@ -0,0 +1,123 @@
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+
+class Flight:
+    """
+    一次正在进行的生成，相同的请求都订阅它的输出
+
+    started 在生成真正开始（通过准入控制）时设置，结果由生产者决定，比如准入的 Ticket。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.subscribers: List['Subscriber'] = []
+        # 最近一次输出，生成的输出是累积的文本，后加入的请求先收到它
+        self.latest: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def push(self, item: dict) -> None:
+        self.latest = item
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait((item, None))
+
+    def close(self, exc: Optional[BaseException] = None) -> None:
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait((None, exc))
+
+    def leave(self, subscriber: 'Subscriber') -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        # 所有请求都已退出时停止生成
+        if not self.subscribers and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+class Subscriber:
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.queue: asyncio.Queue = asyncio.Queue()
+        if flight.latest is not None:
+            self.queue.put_nowait((flight.latest, None))
+        flight.subscribers.append(self)
+
+    # 等待生成开始，返回生产者设置的结果；生成未能开始时抛出同样的异常
+    async def wait_started(self):
+        try:
+            return await asyncio.shield(self.flight.started)
+        except BaseException:
+            self.close()
+            raise
+
+    async def iterate(self) -> AsyncIterator[dict]:
+        try:
+            while True:
+                item, exc = await self.queue.get()
+                if exc is not None:
+                    raise exc
+                if item is None:
+                    break
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.flight.leave(self)
+
+
+class SingleFlight:
+    """
+    相同的确定性请求只生成一次
+
+    第一个请求启动生成，之后到达的相同请求订阅同一次生成，先收到已生成的部分，再逐个收到新的输出。
+    生成结束后不再保留，之后的请求由响应缓存处理。只在事件循环中使用，不需要加锁。
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+
+        # 统计信息
+        self.leaders = 0
+        self.followers = 0
+
+    # produce(flight) 生成输出，开始生成时设置 flight.started
+    def join(self, key: str, produce: Callable[[Flight], AsyncIterator[dict]]) -> Subscriber:
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.followers += 1
+            return Subscriber(flight)
+
+        flight = self.flights[key] = Flight(key)
+        self.leaders += 1
+        subscriber = Subscriber(flight)
+        flight.task = asyncio.ensure_future(self._run(flight, produce))
+        return subscriber
+
+    async def _run(self, flight: Flight, produce: Callable[[Flight], AsyncIterator[dict]]) -> None:
+        exc = None
+        try:
+            async for item in produce(flight):
+                flight.push(item)
+        except BaseException as e:
+            exc = e
+            if not flight.started.done():
+                if isinstance(e, asyncio.CancelledError):
+                    flight.started.cancel()
+                else:
+                    flight.started.set_exception(e)
+        finally:
+            # 先移除再通知订阅者，结束后到达的请求会重新生成或命中响应缓存
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            flight.close(exc)
+        if isinstance(exc, asyncio.CancelledError):
+            raise exc
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self.flights),
+            "subscribers": sum(len(flight.subscribers) for flight in self.flights.values()),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import PreTrainedModel
+
+from engine import KVLayers, ModelRunner
+
+
+class PromptLookupState:
+    def __init__(self):
+        # n-gram 最近一次出现的结束位置，下一个 token 从这里开始
+        self.index: Dict[Tuple[int, ...], int] = {}
+        self.size = 1
+
+
+class PromptLookupDrafter:
+    """
+    提示词查找：在 prompt 和已生成的 token 中找到与末尾 n 个 token 相同的片段，把它后面的 k 个 token 作为草稿
+
+    改写、续写章节时回复中大段重复上下文里的句子，不需要额外的模型就能猜中。
+    n 从 max_ngram 到 1 依次尝试，索引随生成增量更新。
+    """
+
+    def __init__(self, max_ngram: int = 3):
+        self.max_ngram = max_ngram
+
+    def new_state(self) -> PromptLookupState:
+        return PromptLookupState()
+
+    def propose(self, state: PromptLookupState, token_ids: List[int], k: int) -> List[int]:
+        # 不索引以最后一个 token 结尾的 n-gram，查到的总是之前的出现位置
+        for end in range(state.size, len(token_ids)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                state.index[tuple(token_ids[end - n:end])] = end
+        state.size = max(state.size, len(token_ids))
+
+        for n in range(min(self.max_ngram, len(token_ids)), 0, -1):
+            end = state.index.get(tuple(token_ids[-n:]))
+            if end is not None:
+                return token_ids[end:end + k]
+        return []
+
+
+class DraftModelState:
+    def __init__(self):
+        self.layers: Optional[KVLayers] = None
+        # KV 对应的 token，末尾可能是上次被拒绝的草稿
+        self.token_ids: List[int] = []
+        # 上次调用时已确认的 token 数，这之前的 KV 一定可以复用
+        self.confirmed = 0
+
+
+class DraftModelDrafter:
+    """
+    小模型起草：与主模型使用同一个分词器的小模型贪心生成 k 个 token
+
+    每个序列保留草稿模型自己的 KV，下次起草前截掉被拒绝的部分，只输入新确认的 token。
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        self.runner = ModelRunner(model)
+
+    def new_state(self) -> DraftModelState:
+        return DraftModelState()
+
+    def propose(self, state: DraftModelState, token_ids: List[int], k: int) -> List[int]:
+        runner = self.runner
+        device = runner.device
+
+        # 至少重新输入最后一个 token，才能得到下一个位置的 logits
+        limit = min(len(state.token_ids), len(token_ids) - 1)
+        common = min(state.confirmed, limit)
+        while common < limit and state.token_ids[common] == token_ids[common]:
+            common += 1
+        layers = runner.kv_slice(state.layers, 0, common) if common else None
+
+        feed, draft = token_ids[common:], []
+        for _ in range(k):
+            input_ids = torch.tensor([feed], dtype=torch.long, device=device)
+            position_ids = torch.arange(
+                common, common + len(feed), dtype=torch.long, device=device).unsqueeze(0)
+            attention_mask = torch.ones(1, common + len(feed), dtype=torch.long, device=device)
+            logits, layers = runner.forward(input_ids, attention_mask, position_ids, layers)
+            common += len(feed)
+            feed = [int(torch.argmax(logits[0, -1]))]
+            draft.append(feed[0])
+
+        state.layers = layers
+        state.token_ids = token_ids + draft[:-1]
+        state.confirmed = len(token_ids)
+        return draft
@@ -0,0 +1,466 @@
+from __future__ import unicode_literals
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List, Iterator, Optional, Tuple
+
+from storage import FileBookStorage, FileSessionStorage
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS books (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    novelType TEXT NOT NULL DEFAULT '',
+    title TEXT NOT NULL DEFAULT '',
+    cover TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    summary TEXT NOT NULL DEFAULT '',
+    characters TEXT NOT NULL DEFAULT '[]',
+    createdAt TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_books_position ON books (position);
+CREATE INDEX IF NOT EXISTS idx_books_created ON books (createdAt);
+
+CREATE TABLE IF NOT EXISTS chapters (
+    book_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    summary TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (book_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_chapters_position ON chapters (book_id, position);
+
+CREATE TABLE IF NOT EXISTS paragraphs (
+    book_id TEXT NOT NULL,
+    chapter_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    id TEXT NOT NULL DEFAULT '',
+    previous TEXT NOT NULL DEFAULT '',
+    style TEXT NOT NULL DEFAULT '',
+    fragment TEXT NOT NULL DEFAULT '',
+    requirement TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (book_id, chapter_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS novel_types (
+    label TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    prompt TEXT NOT NULL DEFAULT '[]'
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    createdAt TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions (createdAt);
+
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    role TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL DEFAULT '',
+    createdAt REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, seq);
+CREATE INDEX IF NOT EXISTS idx_messages_id ON messages (session_id, id);
+'''
+
+CHAPTER_FIELDS = ('title', 'description', 'summary', 'content')
+PARAGRAPH_FIELDS = ('id', 'previous', 'style',
+                    'fragment', 'requirement', 'content')
+
+
+class SqliteDatabase:
+    """
+    SQLite 数据库连接，每个线程使用自己的连接，开启 WAL 模式以支持并发读写
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.ready = False
+        self.init_lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # isolation_level=None 时由 transaction() 显式控制事务
+            conn = sqlite3.connect(
+                self.db_path, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def init(self) -> None:
+        if self.ready:
+            return
+
+        with self.init_lock:
+            if self.ready:
+                return
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self.conn.executescript(SCHEMA)
+            self.ready = True
+
+    # 写事务，BEGIN IMMEDIATE 在开始时就获取写锁，避免读锁升级时的死锁
+    @contextmanager
+    def transaction(self):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, conn: sqlite3.Connection, key: str, value: str) -> None:
+        conn.execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value', (key, value))
+
+
+class SqliteBookStorage:
+    """
+    书籍的 SQLite 存储，每次写入都在一个事务中完成并递增 generation
+
+    transaction() 中的多次写入共用一个事务，只递增一次 generation。
+    """
+
+    def __init__(self, db_path: str, legacy: Optional[FileBookStorage] = None):
+        self.db = SqliteDatabase(db_path)
+        self.legacy = legacy
+        # 当前线程进行中的事务连接
+        self.local = threading.local()
+
+    def init(self) -> None:
+        self.db.init()
+        if self.legacy is not None and self.db.get_meta('books_imported') is None:
+            self.import_books(self.legacy.export_books(),
+                              self.legacy.load_novel_types())
+
+    # 首次启动时导入 json 文件中的数据，只执行一次
+    def import_books(self, books: List[dict], novel_types: List[dict]) -> None:
+        with self.db.transaction() as conn:
+            for book in books:
+                self._save_book(conn, book)
+                for chapter in book.get('chapters', []):
+                    self._save_chapter(conn, book['id'], chapter)
+            self._save_novel_types(conn, novel_types)
+            self.db.set_meta(conn, 'books_imported', str(len(books)))
+            self._bump(conn)
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self.local, 'conn', None) is not None:
+            yield
+            return
+
+        self.db.init()
+        with self.db.transaction() as conn:
+            self.local.conn = conn
+            try:
+                yield
+            finally:
+                self.local.conn = None
+            self._bump(conn)
+
+    @contextmanager
+    def _writing(self):
+        with self.transaction():
+            yield self.local.conn
+
+    def _bump(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('generation', '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    # 数据版本标记，任何连接提交写入后都会变化
+    def stamp(self) -> int:
+        self.db.init()
+        return int(self.db.get_meta('generation', '0'))
+
+    def _book_from_row(self, row: sqlite3.Row) -> dict:
+        book = dict(row)
+        book.pop('position')
+        book['characters'] = json.loads(book['characters'])
+        book['chapters'] = []
+        return book
+
+    def _chapter_from_row(self, row: sqlite3.Row) -> dict:
+        chapter = {'id': row['id']}
+        chapter.update({key: row[key] for key in CHAPTER_FIELDS})
+        chapter['paragraphs'] = []
+        return chapter
+
+    # 一次查询取出书籍、章节和段落后在内存中组装
+    def _load(self, book_id: Optional[str] = None) -> List[dict]:
+        where, args = ('WHERE book_id = ?', (book_id,)) if book_id else ('', ())
+        conn = self.db.conn
+
+        book_where = 'WHERE id = ?' if book_id else ''
+        books = {row['id']: self._book_from_row(row) for row in conn.execute(
+            f'SELECT * FROM books {book_where} ORDER BY position', args)}
+
+        chapters = {}
+        for row in conn.execute(
+                f'SELECT * FROM chapters {where} ORDER BY book_id, position', args):
+            chapter = self._chapter_from_row(row)
+            chapters[(row['book_id'], row['id'])] = chapter
+            if row['book_id'] in books:
+                books[row['book_id']]['chapters'].append(chapter)
+
+        for row in conn.execute(
+                f'SELECT * FROM paragraphs {where} ORDER BY book_id, chapter_id, position', args):
+            chapter = chapters.get((row['book_id'], row['chapter_id']))
+            if chapter is not None:
+                chapter['paragraphs'].append(
+                    {key: row[key] for key in PARAGRAPH_FIELDS})
+
+        return list(books.values())
+
+    def get_catalog(self) -> List[dict]:
+        self.db.init()
+        rows = self.db.conn.execute(
+            'SELECT id, title, novelType, cover, createdAt FROM books ORDER BY position')
+        return [dict(row) for row in rows]
+
+    def load_book(self, book_id: str) -> Optional[dict]:
+        self.db.init()
+        books = self._load(book_id)
+        return books[0] if books else None
+
+    def load_books(self) -> List[dict]:
+        self.db.init()
+        return self._load()
+
+    def load_chapter(self, book_id: str, chapter_id: str) -> Optional[dict]:
+        self.db.init()
+        conn = self.db.conn
+        row = conn.execute('SELECT * FROM chapters WHERE book_id = ? AND id = ?',
+                           (book_id, chapter_id)).fetchone()
+        if row is None:
+            return None
+
+        chapter = self._chapter_from_row(row)
+        for paragraph in conn.execute(
+                'SELECT * FROM paragraphs WHERE book_id = ? AND chapter_id = ? ORDER BY position',
+                (book_id, chapter_id)):
+            chapter['paragraphs'].append(
+                {key: paragraph[key] for key in PARAGRAPH_FIELDS})
+
+        return chapter
+
+    def _next_position(self, conn: sqlite3.Connection, table: str, where: str = '', args: tuple = ()) -> int:
+        row = conn.execute(
+            f'SELECT COALESCE(MAX(position), -1) + 1 FROM {table} {where}', args).fetchone()
+        return row[0]
+
+    def _save_book(self, conn: sqlite3.Connection, book: dict) -> None:
+        values = (
+            book.get('novelType', ''),
+            book.get('title', ''),
+            book.get('cover', ''),
+            book.get('description', ''),
+            book.get('summary', ''),
+            json.dumps(book.get('characters', []), ensure_ascii=False),
+            book.get('createdAt', ''),
+        )
+        updated = conn.execute(
+            'UPDATE books SET novelType = ?, title = ?, cover = ?, description = ?, '
+            'summary = ?, characters = ?, createdAt = ? WHERE id = ?',
+            values + (book['id'],)).rowcount
+        if not updated:
+            conn.execute(
+                'INSERT INTO books (id, position, novelType, title, cover, description, '
+                'summary, characters, createdAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (book['id'], self._next_position(conn, 'books')) + values)
+
+        # 章节顺序以书籍中的章节列表为准
+        for position, chapter in enumerate(book.get('chapters', [])):
+            conn.execute('UPDATE chapters SET position = ? WHERE book_id = ? AND id = ?',
+                         (position, book['id'], chapter['id']))
+
+    def _save_chapter(self, conn: sqlite3.Connection, book_id: str, chapter: dict) -> None:
+        values = tuple(chapter.get(key, '') for key in CHAPTER_FIELDS)
+        updated = conn.execute(
+            'UPDATE chapters SET title = ?, description = ?, summary = ?, content = ? '
+            'WHERE book_id = ? AND id = ?', values + (book_id, chapter['id'])).rowcount
+        if not updated:
+            position = self._next_position(
+                conn, 'chapters', 'WHERE book_id = ?', (book_id,))
+            conn.execute(
+                'INSERT INTO chapters (book_id, id, position, title, description, summary, content) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (book_id, chapter['id'], position) + values)
+
+        conn.execute('DELETE FROM paragraphs WHERE book_id = ? AND chapter_id = ?',
+                     (book_id, chapter['id']))
+        conn.executemany(
+            'INSERT INTO paragraphs (book_id, chapter_id, position, id, previous, style, '
+            'fragment, requirement, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(book_id, chapter['id'], position) + tuple(paragraph.get(key, '') for key in PARAGRAPH_FIELDS)
+             for position, paragraph in enumerate(chapter.get('paragraphs', []))])
+
+    def save_book(self, book: dict) -> None:
+        self.db.init()
+        with self._writing() as conn:
+            self._save_book(conn, book)
+
+    def save_chapter(self, book_id: str, chapter: dict) -> None:
+        self.db.init()
+        with self._writing() as conn:
+            self._save_chapter(conn, book_id, chapter)
+
+    def delete_chapter(self, book_id: str, chapter_id: str) -> None:
+        self.db.init()
+        with self._writing() as conn:
+            conn.execute('DELETE FROM paragraphs WHERE book_id = ? AND chapter_id = ?',
+                         (book_id, chapter_id))
+            conn.execute('DELETE FROM chapters WHERE book_id = ? AND id = ?',
+                         (book_id, chapter_id))
+
+    def delete_book(self, book_id: str) -> None:
+        self.db.init()
+        with self._writing() as conn:
+            conn.execute(
+                'DELETE FROM paragraphs WHERE book_id = ?', (book_id,))
+            conn.execute('DELETE FROM chapters WHERE book_id = ?', (book_id,))
+            conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+
+    def _save_novel_types(self, conn: sqlite3.Connection, novel_types: List[dict]) -> None:
+        conn.execute('DELETE FROM novel_types')
+        conn.executemany(
+            'INSERT INTO novel_types (label, position, prompt) VALUES (?, ?, ?)',
+            [(item['label'], position, json.dumps(item.get('prompt', []), ensure_ascii=False))
+             for position, item in enumerate(novel_types)])
+
+    def load_novel_types(self) -> List[dict]:
+        self.db.init()
+        rows = self.db.conn.execute(
+            'SELECT label, prompt FROM novel_types ORDER BY position')
+        return [{'label': row['label'], 'prompt': json.loads(row['prompt'])} for row in rows]
+
+    def save_novel_types(self, novel_types: List[dict]) -> None:
+        self.db.init()
+        with self._writing() as conn:
+            self._save_novel_types(conn, novel_types)
+
+
+class SqliteSessionStorage:
+    """
+    会话和消息的 SQLite 存储，追加消息只插入一行
+    """
+
+    def __init__(self, db_path: str, legacy: Optional[FileSessionStorage] = None):
+        self.db = SqliteDatabase(db_path)
+        self.legacy = legacy
+        self.lock = threading.RLock()
+
+    def init(self) -> None:
+        self.db.init()
+        if self.legacy is not None and self.db.get_meta('sessions_imported') is None:
+            self.import_sessions()
+
+    # 首次启动时导入 json 文件中的会话和消息，只执行一次
+    def import_sessions(self) -> None:
+        sessions = self.legacy.load_sessions() if os.path.exists(
+            self.legacy.config_path) else []
+        with self.db.transaction() as conn:
+            self._save_sessions(conn, sessions)
+            for session in sessions:
+                self._insert_messages(
+                    conn, session['id'], self.legacy.iter_messages(session['id']))
+            self.db.set_meta(conn, 'sessions_imported', str(len(sessions)))
+
+    def _save_sessions(self, conn: sqlite3.Connection, sessions: List[dict]) -> None:
+        ids = [session['id'] for session in sessions]
+        conn.execute(
+            f'DELETE FROM sessions WHERE id NOT IN ({",".join("?" * len(ids))})', ids)
+        conn.executemany(
+            'INSERT INTO sessions (id, position, name, createdAt) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET position = excluded.position, '
+            'name = excluded.name, createdAt = excluded.createdAt',
+            [(session['id'], position, session.get('name', ''), session.get('createdAt', ''))
+             for position, session in enumerate(sessions)])
+
+    def _insert_messages(self, conn: sqlite3.Connection, session_id: str, messages) -> None:
+        now = time.time()
+        conn.executemany(
+            'INSERT INTO messages (session_id, id, role, content, createdAt) VALUES (?, ?, ?, ?, ?)',
+            [(session_id, message.get('id', ''), message.get('role', ''), message.get('content', ''), now)
+             for message in messages])
+
+    def load_sessions(self) -> List[dict]:
+        self.db.init()
+        rows = self.db.conn.execute(
+            'SELECT id, name, createdAt FROM sessions ORDER BY position')
+        return [dict(row) for row in rows]
+
+    def save_sessions(self, sessions: List[dict]) -> None:
+        self.db.init()
+        with self.db.transaction() as conn:
+            self._save_sessions(conn, sessions)
+
+    # 消息数和最大序号，消息新增或删除后都会变化
+    def log_stamp(self, session_id: str) -> Tuple[int, int]:
+        self.db.init()
+        row = self.db.conn.execute(
+            'SELECT COUNT(*), COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?',
+            (session_id,)).fetchone()
+        return row[0], row[1]
+
+    def iter_messages(self, session_id: str) -> Iterator[dict]:
+        self.db.init()
+        rows = self.db.conn.execute(
+            'SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY seq', (session_id,))
+        return (dict(row) for row in rows)
+
+    def write_messages(self, session_id: str, messages: List[dict]) -> None:
+        self.db.init()
+        with self.db.transaction() as conn:
+            conn.execute(
+                'DELETE FROM messages WHERE session_id = ?', (session_id,))
+            self._insert_messages(conn, session_id, messages)
+
+    def append_message(self, session_id: str, message: dict) -> None:
+        self.db.init()
+        with self.db.transaction() as conn:
+            self._insert_messages(conn, session_id, [message])
+
+    def delete_message(self, session_id: str, message_id: str) -> None:
+        self.db.init()
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE session_id = ? AND id = ?',
+                         (session_id, message_id))
+
+    def delete_session(self, session_id: str) -> None:
+        self.db.init()
+        with self.db.transaction() as conn:
+            conn.execute(
+                'DELETE FROM messages WHERE session_id = ?', (session_id,))
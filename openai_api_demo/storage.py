@@ -0,0 +1,443 @@
+from __future__ import unicode_literals
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import ContextManager, List, Dict, Iterator, Optional, Protocol, Tuple
+
+# 存储后端：file（json 文件）或 sqlite
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'file')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', './writer.db')
+
+
+# 原子写入 json 文件，先写临时文件再替换，避免写到一半时进程退出导致文件损坏
+def write_json(file_path: str, data, indent: Optional[int] = 4) -> None:
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False, indent=indent))
+    os.replace(tmp_path, file_path)
+
+
+def read_json(file_path: str, default=None):
+    if not os.path.exists(file_path):
+        return default
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.loads(f.read())
+
+
+class BookStorage(Protocol):
+    def init(self) -> None: ...
+
+    def stamp(self) -> int: ...
+
+    # 其中的多次写入作为一次修改提交，可以嵌套
+    def transaction(self) -> ContextManager[None]: ...
+
+    def get_catalog(self) -> List[dict]: ...
+
+    def load_book(self, book_id: str) -> Optional[dict]: ...
+
+    def load_books(self) -> List[dict]: ...
+
+    def load_chapter(self, book_id: str, chapter_id: str) -> Optional[dict]: ...
+
+    def save_book(self, book: dict) -> None: ...
+
+    def save_chapter(self, book_id: str, chapter: dict) -> None: ...
+
+    def delete_chapter(self, book_id: str, chapter_id: str) -> None: ...
+
+    def delete_book(self, book_id: str) -> None: ...
+
+    def load_novel_types(self) -> List[dict]: ...
+
+    def save_novel_types(self, novel_types: List[dict]) -> None: ...
+
+
+class SessionStorage(Protocol):
+    lock: threading.RLock
+
+    def init(self) -> None: ...
+
+    def load_sessions(self) -> List[dict]: ...
+
+    def save_sessions(self, sessions: List[dict]) -> None: ...
+
+    def log_stamp(self, session_id: str) -> Tuple[int, int]: ...
+
+    def iter_messages(self, session_id: str) -> Iterator[dict]: ...
+
+    def write_messages(self, session_id: str, messages: List[dict]) -> None: ...
+
+    def append_message(self, session_id: str, message: dict) -> None: ...
+
+    def delete_message(self, session_id: str, message_id: str) -> None: ...
+
+    def delete_session(self, session_id: str) -> None: ...
+
+
+class FileBookStorage:
+    """
+    按书籍分片的文件存储
+
+    books/
+        catalog.json                        书籍目录，只保存书籍的基本信息和顺序
+        <book_id>/book.json                 书籍信息和章节顺序，不包含章节正文
+        <book_id>/chapters/<chapter_id>.json  章节内容
+        novel_type.json                     小说类型
+        .stamp                              每次写入都会更新它的修改时间，供缓存判断数据是否变化
+
+    修改一个章节只会重写该章节自己的文件。
+    文件无法回滚，transaction() 只保证写入互斥，并在结束时更新一次 stamp。
+    """
+
+    # 写入目录的书籍字段，列表页只需要这些字段
+    CATALOG_FIELDS = ('id', 'title', 'novelType', 'cover', 'createdAt')
+
+    def __init__(self, root: str):
+        self.root = root
+        self.catalog_path = os.path.join(root, 'catalog.json')
+        self.legacy_config_path = os.path.join(root, 'config.json')
+        self.novel_type_path = os.path.join(root, 'novel_type.json')
+        self.stamp_path = os.path.join(root, '.stamp')
+        self._last_stamp = 0
+        self.lock = threading.RLock()
+        # 事务嵌套的层数，事务中的写入推迟到最外层结束时再更新 stamp
+        self._depth = 0
+        self._dirty = False
+
+    # 创建书籍目录，如果存在旧版的 config.json 则迁移一次
+    def init(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(self.catalog_path):
+            self.migrate()
+
+    # 将旧版单文件 config.json 拆分为目录 + 每本书、每个章节一个文件
+    def migrate(self) -> int:
+        books = read_json(self.legacy_config_path, default=[])
+        for book in books:
+            for chapter in book.get('chapters', []):
+                self.save_chapter(book['id'], chapter)
+            self._save_book_file(book)
+
+        # 目录最后写入，迁移中途退出时下次启动会重新迁移
+        write_json(self.catalog_path, [self._catalog_entry(book)
+                                       for book in books])
+        if os.path.exists(self.legacy_config_path):
+            os.replace(self.legacy_config_path,
+                       self.legacy_config_path + '.migrated')
+        self._touch()
+
+        return len(books)
+
+    # 数据版本标记，任何进程写入后都会变化
+    def stamp(self) -> int:
+        try:
+            return os.stat(self.stamp_path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if not self._depth and self._dirty:
+                    self._dirty = False
+                    self._touch()
+
+    def _touch(self) -> None:
+        if self._depth:
+            self._dirty = True
+            return
+        # 保证修改时间单调递增，同一时钟刻度内的两次写入也能区分
+        stamp = max(time.time_ns(), self.stamp() + 1, self._last_stamp + 1)
+        if not os.path.exists(self.stamp_path):
+            open(self.stamp_path, "w").close()
+        os.utime(self.stamp_path, ns=(stamp, stamp))
+        self._last_stamp = stamp
+
+    def _book_dir(self, book_id: str) -> str:
+        return os.path.join(self.root, book_id)
+
+    def _book_path(self, book_id: str) -> str:
+        return os.path.join(self.root, book_id, 'book.json')
+
+    def _chapter_path(self, book_id: str, chapter_id: str) -> str:
+        return os.path.join(self.root, book_id, 'chapters', chapter_id + '.json')
+
+    def _catalog_entry(self, book: dict) -> dict:
+        return {key: book.get(key, '') for key in self.CATALOG_FIELDS}
+
+    def _save_book_file(self, book: dict) -> None:
+        data = {key: value for key, value in book.items() if key != 'chapters'}
+        data['chapterIds'] = [chapter['id']
+                              for chapter in book.get('chapters', [])]
+        os.makedirs(os.path.join(self._book_dir(book['id']), 'chapters'),
+                    exist_ok=True)
+        write_json(self._book_path(book['id']), data)
+
+    def get_catalog(self) -> List[dict]:
+        return read_json(self.catalog_path, default=[])
+
+    # 读取全部书籍，兼容旧版 config.json，不修改任何文件（用于导入到其他存储后端）
+    def export_books(self) -> List[dict]:
+        if os.path.exists(self.catalog_path):
+            return self.load_books()
+        return read_json(self.legacy_config_path, default=[])
+
+    # 读取书籍及其全部章节
+    def load_book(self, book_id: str) -> Optional[dict]:
+        data = read_json(self._book_path(book_id))
+        if data is None:
+            return None
+
+        chapter_ids = data.pop('chapterIds', [])
+        chapters = []
+        for chapter_id in chapter_ids:
+            chapter = self.load_chapter(book_id, chapter_id)
+            if chapter is not None:
+                chapters.append(chapter)
+        data['chapters'] = chapters
+
+        return data
+
+    def load_books(self) -> List[dict]:
+        books = []
+        for entry in self.get_catalog():
+            book = self.load_book(entry['id'])
+            if book is not None:
+                books.append(book)
+
+        return books
+
+    def load_chapter(self, book_id: str, chapter_id: str) -> Optional[dict]:
+        return read_json(self._chapter_path(book_id, chapter_id))
+
+    # 保存书籍信息和章节顺序（不写章节正文），目录中的信息有变化时同步更新目录
+    def save_book(self, book: dict) -> None:
+        self._save_book_file(book)
+
+        catalog = self.get_catalog()
+        entry = self._catalog_entry(book)
+        index = next((i for i, item in enumerate(catalog)
+                      if item['id'] == book['id']), None)
+        if index is None:
+            catalog.append(entry)
+        elif catalog[index] != entry:
+            catalog[index] = entry
+        else:
+            catalog = None
+
+        if catalog is not None:
+            write_json(self.catalog_path, catalog)
+        self._touch()
+
+    def save_chapter(self, book_id: str, chapter: dict) -> None:
+        chapter_dir = os.path.join(self._book_dir(book_id), 'chapters')
+        os.makedirs(chapter_dir, exist_ok=True)
+        write_json(self._chapter_path(book_id, chapter['id']), chapter)
+        self._touch()
+
+    def delete_chapter(self, book_id: str, chapter_id: str) -> None:
+        chapter_path = self._chapter_path(book_id, chapter_id)
+        if os.path.exists(chapter_path):
+            os.remove(chapter_path)
+        self._touch()
+
+    def delete_book(self, book_id: str) -> None:
+        catalog = [item for item in self.get_catalog()
+                   if item['id'] != book_id]
+        write_json(self.catalog_path, catalog)
+
+        chapter_dir = os.path.join(self._book_dir(book_id), 'chapters')
+        if os.path.exists(chapter_dir):
+            for name in os.listdir(chapter_dir):
+                os.remove(os.path.join(chapter_dir, name))
+            os.rmdir(chapter_dir)
+        if os.path.exists(self._book_path(book_id)):
+            os.remove(self._book_path(book_id))
+        if os.path.exists(self._book_dir(book_id)):
+            os.rmdir(self._book_dir(book_id))
+        self._touch()
+
+    def load_novel_types(self) -> List[dict]:
+        return read_json(self.novel_type_path, default=[])
+
+    def save_novel_types(self, novel_types: List[dict]) -> None:
+        write_json(self.novel_type_path, novel_types)
+
+
+class FileSessionStorage:
+    """
+    会话文件存储，消息以追加日志的形式保存
+
+    sessions/
+        config.json         会话列表
+        <session_id>.jsonl  消息日志，每行一条记录：
+                            {"op": "add", "message": {...}} 新增消息
+                            {"op": "del", "id": "..."}      删除消息（墓碑）
+        <session_id>.json   旧版消息文件，首次访问时迁移为日志
+
+    追加一条消息只需要在日志末尾写一行，删除消息只追加墓碑，
+    墓碑和被删除的消息数超过存活消息数时压缩日志。
+    """
+
+    # 日志中失效记录少于该数量时不压缩
+    COMPACT_MIN_DEAD = 64
+
+    def __init__(self, root: str):
+        self.root = root
+        self.config_path = os.path.join(root, 'config.json')
+        self.lock = threading.RLock()
+        # 每个会话日志中存活消息数、失效记录数
+        self._stats: Dict[str, List[int]] = {}
+
+    def init(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(self.config_path):
+            write_json(self.config_path, [])
+
+    def load_sessions(self) -> List[dict]:
+        return read_json(self.config_path, default=[])
+
+    def save_sessions(self, sessions: List[dict]) -> None:
+        self.init()
+        write_json(self.config_path, sessions)
+
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self.root, session_id + '.jsonl')
+
+    def _legacy_path(self, session_id: str) -> str:
+        return os.path.join(self.root, session_id + '.json')
+
+    # 将旧版整文件保存的消息迁移为日志
+    def _migrate(self, session_id: str) -> None:
+        legacy_path = self._legacy_path(session_id)
+        if not os.path.exists(legacy_path) or os.path.exists(self._log_path(session_id)):
+            return
+
+        self.write_messages(session_id, read_json(legacy_path, default=[]))
+        os.remove(legacy_path)
+
+    def write_messages(self, session_id: str, messages: List[dict]) -> None:
+        log_path = self._log_path(session_id)
+        tmp_path = log_path + '.tmp'
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for message in messages:
+                f.write(json.dumps({"op": "add", "message": message},
+                                   ensure_ascii=False) + "\n")
+        os.replace(tmp_path, log_path)
+        self._stats[session_id] = [len(messages), 0]
+
+    # 日志文件的版本标记，文件追加或替换后都会变化
+    def log_stamp(self, session_id: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(self._log_path(session_id))
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_size, stat.st_mtime_ns
+
+    # 逐行读取日志并回放，返回存活的消息
+    # 第一遍只记录每条存活消息所在的行，第二遍再逐条解析返回，内存中不保存消息内容
+    def iter_messages(self, session_id: str) -> Iterator[dict]:
+        with self.lock:
+            self._migrate(session_id)
+            log_path = self._log_path(session_id)
+            if not os.path.exists(log_path):
+                return iter([])
+
+            # 压缩日志会替换文件，已经打开的文件不受影响；第二遍只读第一遍读过的行，之后追加的记录不读取
+            f = open(log_path, "rb")
+            alive: Dict[str, int] = {}
+            records = lines = 0
+            try:
+                for line in f:
+                    lines += 1
+                    if not line.strip():
+                        continue
+                    records += 1
+                    record = json.loads(line)
+                    if record["op"] == "add":
+                        alive[record["message"]["id"]] = lines
+                    elif record["op"] == "del":
+                        alive.pop(record["id"], None)
+            except Exception:
+                f.close()
+                raise
+
+            self._stats[session_id] = [len(alive), records - len(alive)]
+            return self._replay(f, lines, alive)
+
+    def _replay(self, f, lines: int, alive: Dict[str, int]) -> Iterator[dict]:
+        with f:
+            f.seek(0)
+            for number, line in enumerate(itertools.islice(f, lines), 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["op"] == "add" and alive.get(record["message"]["id"]) == number:
+                    yield record["message"]
+
+    def _append(self, session_id: str, record: dict) -> None:
+        with open(self._log_path(session_id), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def append_message(self, session_id: str, message: dict) -> None:
+        with self.lock:
+            self.init()
+            self._migrate(session_id)
+            self._append(session_id, {"op": "add", "message": message})
+            if session_id in self._stats:
+                self._stats[session_id][0] += 1
+
+    def delete_message(self, session_id: str, message_id: str) -> None:
+        with self.lock:
+            if session_id not in self._stats:
+                list(self.iter_messages(session_id))
+            self._append(session_id, {"op": "del", "id": message_id})
+
+            # 被删除的消息和墓碑都是失效记录
+            stats = self._stats[session_id]
+            stats[0] -= 1
+            stats[1] += 2
+            if stats[1] >= self.COMPACT_MIN_DEAD and stats[1] > stats[0]:
+                self.compact(session_id)
+
+    # 只保留存活的消息重写日志
+    def compact(self, session_id: str) -> None:
+        with self.lock:
+            self.write_messages(session_id, list(self.iter_messages(session_id)))
+
+    def delete_session(self, session_id: str) -> None:
+        with self.lock:
+            for path in (self._log_path(session_id), self._legacy_path(session_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._stats.pop(session_id, None)
+
+
+def create_book_storage(book_path: str, backend: str = STORAGE_BACKEND, sqlite_path: str = SQLITE_PATH) -> BookStorage:
+    if backend == 'sqlite':
+        from sqlite_storage import SqliteBookStorage
+        return SqliteBookStorage(sqlite_path, legacy=FileBookStorage(book_path))
+    if backend != 'file':
+        raise Exception(f'不支持的存储后端: {backend}')
+
+    return FileBookStorage(book_path)
+
+
+def create_session_storage(session_path: str, backend: str = STORAGE_BACKEND, sqlite_path: str = SQLITE_PATH) -> SessionStorage:
+    if backend == 'sqlite':
+        from sqlite_storage import SqliteSessionStorage
+        return SqliteSessionStorage(sqlite_path, legacy=FileSessionStorage(session_path))
+    if backend != 'file':
+        raise Exception(f'不支持的存储后端: {backend}')
+
+    return FileSessionStorage(session_path)
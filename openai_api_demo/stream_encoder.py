@@ -0,0 +1,111 @@
+import json
+import time
+import uuid
+import asyncio
+from json.encoder import encode_basestring
+from typing import AsyncIterator, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class ChunkEncoder:
+    """
+    流式响应的 chat.completion.chunk 编码
+
+    同一请求的 id、model、created、object 不变，预先拼好 JSON 外壳，
+    每个 token 只需转义新增的文本再拼接，不再为每个 token 创建 pydantic 对象。
+    n > 1 时用 index 区分不同的回复。
+    """
+
+    def __init__(self, model_id: str, request_id: Optional[str] = None, created: Optional[int] = None):
+        self.id = request_id or f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = created or int(time.time())
+        self.prefix = (
+            '{"id":' + encode_basestring(self.id)
+            + ',"object":"chat.completion.chunk","created":' + str(self.created)
+            + ',"model":' + encode_basestring(model_id)
+            + ',"choices":[{"index":'
+        )
+
+    def _prefix(self, index: int) -> str:
+        return self.prefix + str(index) + ',"delta":'
+
+    def role(self, index: int = 0) -> str:
+        return self._prefix(index) + '{"role":"assistant"},"finish_reason":null}]}'
+
+    def content(self, text: str, finish_reason: Optional[str] = None, index: int = 0) -> str:
+        return (self._prefix(index) + '{"role":"assistant","content":' + encode_basestring(text)
+                + '},"finish_reason":' + ('null' if finish_reason is None else encode_basestring(finish_reason))
+                + '}]}')
+
+    def function_call(self, text: str, function_call: Optional[dict], index: int = 0) -> str:
+        delta = {"role": "assistant", "content": text, "function_call": function_call}
+        return (self._prefix(index) + json.dumps(delta, ensure_ascii=False, separators=(',', ':'))
+                + ',"finish_reason":"function_call"}]}')
+
+    def finish(self, finish_reason: str = "stop", index: int = 0) -> str:
+        return self._prefix(index) + '{},"finish_reason":' + encode_basestring(finish_reason) + '}]}'
+
+
+class ChunkCoalescer:
+    """
+    把相邻 token 的文本合并成一个 chunk，距上次发送超过 window 秒或累积超过 max_chars 个字符时发送
+
+    window 和 max_chars 都为 0 时每个 token 单独发送。
+    add 只在新 token 到达时检查时间，生成停顿时由调用方在 delay() 秒后调用 flush，见 iterate_with_timeout。
+    """
+
+    def __init__(self, window: float = 0.0, max_chars: int = 0):
+        self.window = window
+        self.max_chars = max_chars
+        self.pending = ""
+        self.last_flush = time.monotonic()
+
+    def add(self, text: str) -> Optional[str]:
+        self.pending += text
+        if not self.window and not self.max_chars:
+            return self.flush()
+        if self.max_chars and len(self.pending) >= self.max_chars:
+            return self.flush()
+        if self.window and time.monotonic() - self.last_flush >= self.window:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        self.last_flush = time.monotonic()
+        pending, self.pending = self.pending, ""
+        return pending or None
+
+    # 有未发送的文本时，距离按时间发送还剩的秒数；没有文本或不按时间合并时为 None
+    def delay(self) -> Optional[float]:
+        if not self.pending or not self.window:
+            return None
+        return max(0.0, self.last_flush + self.window - time.monotonic())
+
+
+# 逐个返回 source 的结果，等待超过 timeout() 秒（None 表示一直等待）时先返回 None，
+# 调用方借此在生成停顿时发送合并中的文本；等待中的结果不会丢失
+async def iterate_with_timeout(source: AsyncIterator[T],
+                               timeout: Callable[[], Optional[float]]) -> AsyncIterator[Optional[T]]:
+    iterator = source.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait((pending,), timeout=timeout())
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        # 提前结束时停止 source，取消正在等待的结果即可
+        if pending is not None:
+            pending.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
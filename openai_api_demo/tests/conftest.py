@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在 openai_api_demo 目录下，按脚本方式导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tiny_model import load_echo_model, load_tiny_model  # noqa: E402
+
+
+# 随机初始化的小模型，用于比较不同生成路径的输出
+@pytest.fixture(scope="session")
+def tiny():
+    return load_tiny_model()
+
+
+# 回复最后一条消息原文的脚本化模型，以 eos 结束
+@pytest.fixture(scope="session")
+def echo():
+    return load_echo_model()
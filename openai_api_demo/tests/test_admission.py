@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+# 被接收的请求带到达时的排队位置，被拒绝的请求带拒绝时的位置
+def test_queue_positions():
+    async def run():
+        admission = AdmissionController(1, 1, timeout=0.05)
+        first = await admission.acquire(10)
+        waiting = asyncio.ensure_future(admission.acquire(10))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire(10)
+        assert (rejected.value.status_code, rejected.value.position) == (429, 2)
+        with pytest.raises(AdmissionRejected) as timeout:
+            await waiting
+        assert (timeout.value.status_code, timeout.value.position) == (503, 1)
+
+        waiting = asyncio.ensure_future(admission.acquire(10))
+        await asyncio.sleep(0)
+        admission.release(first)
+        second = await waiting
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.headers()["X-Queue-Position"] == "0"
+    assert second.headers()["X-Queue-Position"] == "1"
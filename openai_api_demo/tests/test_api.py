@@ -0,0 +1,166 @@
+import json
+import asyncio
+from collections import OrderedDict
+
+import pytest
+from fastapi.testclient import TestClient
+
+import openai_api
+import session
+from admission import AdmissionController
+from batch_jobs import BATCH_ENDPOINT, FINAL_STATUSES, BatchJobs
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from storage import write_json
+
+
+# 使用 echo 模型的服务，书籍、会话等数据写在临时目录中
+@pytest.fixture(params=["serial", "batch"])
+def client(request, echo, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model, tokenizer = echo
+    monkeypatch.setattr(openai_api, "model", model, raising=False)
+    monkeypatch.setattr(openai_api, "tokenizer", tokenizer, raising=False)
+    monkeypatch.setattr(openai_api, "SCHEDULER", request.param)
+    monkeypatch.setattr(openai_api, "engine", None)
+    monkeypatch.setattr(openai_api, "prefix_cache", None)
+    monkeypatch.setattr(openai_api, "response_cache", ResponseCache(64))
+    monkeypatch.setattr(openai_api, "single_flight", SingleFlight())
+    monkeypatch.setattr(openai_api, "admission", AdmissionController(
+        8, 64, preempt_bulk=request.param == "batch"))
+    monkeypatch.setattr(session, "message_cache", OrderedDict())
+    monkeypatch.setattr(session, "session_tokens", OrderedDict())
+    return TestClient(openai_api.app)
+
+
+def chat(**kwargs) -> dict:
+    body = {"model": "m", "messages": [{"role": "user", "content": "你好，世界"}], "max_tokens": 40, "temperature": 0}
+    body.update(kwargs)
+    return body
+
+
+def stream(client: TestClient, body: dict) -> dict:
+    texts, finish_reasons = {}, {}
+    with client.stream("POST", "/v1/chat/completions", json=dict(body, stream=True)) as response:
+        for line in response.iter_lines():
+            if not line.startswith("data: {"):
+                continue
+            choice = json.loads(line[6:])["choices"][0]
+            texts[choice["index"]] = texts.get(choice["index"], "") + (choice["delta"].get("content") or "")
+            finish_reasons[choice["index"]] = choice["finish_reason"]
+    return {"texts": [texts[index] for index in sorted(texts)], "finish_reasons": finish_reasons}
+
+
+def test_stop_strings(client):
+    response = client.post("/v1/chat/completions", json=chat(stop=["世"])).json()
+    assert response["choices"][0]["message"]["content"] == "\n你好，"
+    assert stream(client, chat(stop="世界"))["texts"] == ["\n你好，"]
+
+
+# 相同的确定性请求第二次直接返回缓存的回复，流式请求按 chunk 重放
+def test_response_cache_replay(client):
+    first = client.post("/v1/chat/completions", json=chat()).json()
+    second = client.post("/v1/chat/completions", json=chat()).json()
+    assert openai_api.response_cache.stats()["hits"] == 1
+    assert second["choices"] == first["choices"]
+    assert second["usage"] == first["usage"]
+
+    replay = stream(client, chat())
+    assert openai_api.response_cache.stats()["hits"] == 2
+    assert replay["texts"] == [first["choices"][0]["message"]["content"]]
+    assert replay["finish_reasons"][0] == "stop"
+
+
+def test_n_choices(client):
+    response = client.post("/v1/chat/completions", json=chat(n=3)).json()
+    assert [choice["index"] for choice in response["choices"]] == [0, 1, 2]
+    assert [choice["message"]["content"] for choice in response["choices"]] == ["\n你好，世界"] * 3
+    assert stream(client, chat(n=2))["texts"] == ["\n你好，世界"] * 2
+    assert client.post("/v1/chat/completions", json=chat(n=0)).status_code == 400
+    assert client.post("/v1/chat/completions", json=chat(n=openai_api.MAX_CHOICES + 1)).status_code == 400
+    # 串行调度时 n > 1 的请求也交给调度器
+    assert openai_api.engine is not None
+
+
+# 会话的下一轮从前缀缓存中取得上一轮整段对话的 KV，只预填充新的消息
+def test_session_kv_reuse(client):
+    session_id = client.post("/v1/sessions").json()["data"][-1]["id"]
+    body = chat(session_id=session_id, messages=[{"role": "user", "content": "第一轮"}])
+    assert client.post("/v1/chat/completions", json=body).json()["choices"][0]["message"]["content"] == "\n第一轮"
+    conversation = session.session_tokens[session_id][1]
+
+    before = openai_api.prefix_cache.stats()["hit_tokens"]
+    body = chat(session_id=session_id, messages=[{"role": "user", "content": "第二轮"}])
+    assert client.post("/v1/chat/completions", json=body).json()["choices"][0]["message"]["content"] == "\n第二轮"
+    assert openai_api.prefix_cache.stats()["hit_tokens"] - before >= len(conversation) - 1
+
+    messages = client.get(f"/v1/sessions/{session_id}/messages").json()["data"]
+    assert [(message["role"], message["content"]) for message in messages] == [
+        ("user", "第一轮"), ("assistant", "\n第一轮"), ("user", "第二轮"), ("assistant", "\n第二轮")]
+
+
+# 服务中断后重新启动：截掉写了一半的最后一行，已经完成的请求不再处理，其余的继续完成
+def test_batch_job_resume_after_truncation(client, tmp_path):
+    items = [{"custom_id": f"r{i}", "body": chat(messages=[{"role": "user", "content": f"第{i}章"}])}
+             for i in range(6)]
+    done = {"id": "batch_req_0", "custom_id": "r0", "response": {"status_code": 200, "body": {}}, "error": None}
+    batch_dir = tmp_path / "batches" / "batch_1"
+    batch_dir.mkdir(parents=True)
+    (batch_dir / "input.jsonl").write_text(
+        "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items), encoding="utf-8")
+    (batch_dir / "output.jsonl").write_text(json.dumps(done) + "\n" + '{"custom_id": "r1", "resp', encoding="utf-8")
+    write_json(str(batch_dir / "batch.json"), {
+        "id": "batch_1", "object": "batch", "endpoint": BATCH_ENDPOINT, "status": "in_progress",
+        "created_at": 0, "in_progress_at": 0, "request_counts": {"total": 6, "completed": 1, "failed": 0}})
+
+    async def run():
+        jobs = BatchJobs(str(tmp_path / "batches"), openai_api.run_batch_request, 4)
+        await jobs.start()
+        try:
+            while jobs.get("batch_1")["status"] not in FINAL_STATUSES:
+                await asyncio.sleep(0.01)
+        finally:
+            await jobs.stop()
+        return jobs.get("batch_1"), [json.loads(line) for line in jobs.read_output("batch_1").splitlines()]
+
+    batch, results = asyncio.run(asyncio.wait_for(run(), 60))
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 6, "completed": 6, "failed": 0}
+    assert results[0] == done
+    assert sorted(result["custom_id"] for result in results) == [f"r{i}" for i in range(6)]
+    assert {result["custom_id"]: result["response"]["body"]["choices"][0]["message"]["content"]
+            for result in results[1:]} == {f"r{i}": f"\n第{i}章" for i in range(1, 6)}
+
+
+# 队列已满时返回 429，带上当前的排队长度和请求会排到的位置
+def test_rejected_queue_headers(client, monkeypatch):
+    admission = AdmissionController(1, 0)
+    monkeypatch.setattr(openai_api, "admission", admission)
+    asyncio.run(admission.acquire(1))
+
+    response = client.post("/v1/chat/completions", json=chat())
+    assert response.status_code == 429
+    assert response.headers["X-Queue-Depth"] == "0"
+    assert response.headers["X-Queue-Position"] == "1"
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+# 客户端在响应体开始发送之前断开，predict 没有运行，名额也要交还
+def test_stream_ticket_released_before_body(client, monkeypatch):
+    monkeypatch.setattr(openai_api, "stream_registry", None)
+    admission = openai_api.admission
+
+    async def run():
+        ticket = await admission.acquire(1)
+        response = openai_api.event_source("m", {}, ticket, ticket.headers())
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await asyncio.Event().wait()
+
+        await response({"type": "http", "method": "POST", "headers": []}, receive, send)
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert admission.inflight == 0
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from engine import GenerationEngine
+from openai_api import ChatMessage
+from utils import generate_chatglm3
+
+
+def build_params(content: str, **kwargs) -> dict:
+    params = dict(
+        messages=[ChatMessage(role="user", content=content)],
+        temperature=0.0,
+        top_p=0.8,
+        max_tokens=24,
+        echo=False,
+        repetition_penalty=1.1,
+        functions=None,
+    )
+    params.update(kwargs)
+    return params
+
+
+PROMPTS = ["你好", "请续写第三章：" + "夜色渐深。" * 12, "给这本书起一个名字", "人物小传" * 5]
+
+
+# 连续批处理（不同长度的请求同时解码、分块预填充）与逐个生成的贪心输出相同
+def test_batch_matches_serial(tiny):
+    model, tokenizer = tiny
+    expected = [generate_chatglm3(model, tokenizer, build_params(prompt))["text"] for prompt in PROMPTS]
+
+    engine = GenerationEngine(model, tokenizer, max_batch_size=4, prefill_chunk=16)
+
+    async def run():
+        return await asyncio.gather(*[engine.generate(build_params(prompt)) for prompt in PROMPTS])
+
+    assert [response["text"] for response in asyncio.run(run())] == expected
+
+
+# n > 1 的每个回复与 seed 依次加一的单个请求相同，共享一次预填充
+def test_n_choices_match_single_requests(tiny):
+    model, tokenizer = tiny
+    engine = GenerationEngine(model, tokenizer, max_batch_size=4)
+    params = dict(temperature=0.9, top_p=0.9, seed=11)
+
+    async def run():
+        singles = [await engine.generate(build_params(PROMPTS[1], **dict(params, seed=11 + i))) for i in range(3)]
+        choices = {}
+        async for response in engine.stream(build_params(PROMPTS[1], n=3, **params)):
+            choices[response["index"]] = response
+        return singles, [choices[index] for index in range(3)]
+
+    singles, choices = asyncio.run(run())
+    assert [choice["text"] for choice in choices] == [single["text"] for single in singles]
+    assert len({choice["text"] for choice in choices}) > 1
+
+
+# 空位不够整组回复时等待，批次不超过 max_batch_size；n 超过批次大小的请求直接拒绝
+def test_n_choices_fit_batch(tiny):
+    model, tokenizer = tiny
+    engine = GenerationEngine(model, tokenizer, max_batch_size=4)
+    sizes = []
+    decode = engine._decode
+
+    def record():
+        sizes.append(len(engine.batch))
+        decode()
+
+    engine._decode = record
+
+    async def run():
+        async def choices(content):
+            return [response async for response in engine.stream(build_params(content, n=3))]
+
+        return await asyncio.gather(choices(PROMPTS[0]), choices(PROMPTS[2]))
+
+    assert all(responses for responses in asyncio.run(run()))
+    assert sizes and max(sizes) <= 4
+
+    async def too_many():
+        return [response async for response in engine.stream(build_params(PROMPTS[0], n=5))]
+
+    with pytest.raises(Exception):
+        asyncio.run(too_many())
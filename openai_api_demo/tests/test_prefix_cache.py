@@ -0,0 +1,33 @@
+import pytest
+
+from engine import ModelRunner
+from openai_api import ChatMessage
+from prefix_cache import PrefixCache
+from utils import generate_chatglm3
+
+
+def build_params(repetition_penalty: float) -> dict:
+    return dict(
+        messages=[ChatMessage(role="user", content="请续写这一章，保留原有的情节。" * 3)],
+        temperature=0.0,
+        top_p=0.8,
+        max_tokens=32,
+        echo=False,
+        repetition_penalty=repetition_penalty,
+        functions=None,
+    )
+
+
+# 命中前缀缓存时重复惩罚仍作用于完整的 prompt，贪心输出与未命中时相同
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.1, 1.5])
+def test_prefix_hit_matches_miss(tiny, repetition_penalty):
+    model, tokenizer = tiny
+    expected = generate_chatglm3(model, tokenizer, build_params(repetition_penalty))
+
+    prefix_cache = PrefixCache(ModelRunner(model), 64 << 20)
+    miss = generate_chatglm3(model, tokenizer, build_params(repetition_penalty), prefix_cache)
+    hit = generate_chatglm3(model, tokenizer, build_params(repetition_penalty), prefix_cache)
+
+    assert prefix_cache.stats()["hits"] == 1
+    assert miss["text"] == expected["text"]
+    assert hit["text"] == expected["text"]
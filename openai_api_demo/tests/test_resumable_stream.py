@@ -0,0 +1,54 @@
+import asyncio
+
+from resumable_stream import StreamRegistry
+
+
+async def numbers(produced: list, count: int = 50):
+    for i in range(count):
+        produced.append(i)
+        yield str(i)
+        await asyncio.sleep(0.005)
+
+
+# 中途断开后带 Last-Event-ID 重连，收到完整的输出，只生成一次
+def test_resume_receives_full_completion():
+    async def run():
+        registry = StreamRegistry(grace=5, max_events=100)
+        produced = []
+        stream = registry.start('s', numbers(produced))
+
+        events = stream.events()
+        received = [await events.__anext__() for _ in range(3)]
+        await events.aclose()
+        # 断开期间继续生成
+        await asyncio.sleep(0.05)
+        assert not stream.finished and len(produced) > 3
+
+        async for event in registry.resume(received[-1]["id"]):
+            received.append(event)
+        return produced, received, registry
+
+    produced, received, registry = asyncio.run(run())
+    assert [event["data"] for event in received] == [str(i) for i in range(50)]
+    assert [event["id"] for event in received] == [f"s:{i}" for i in range(1, 51)]
+    assert produced == list(range(50))
+    assert registry.stats()["resumed"] == 1 and registry.stats()["expired"] == 0
+
+
+# 断开期间没有发送的事件超出缓冲时停止生成，不能再续传
+def test_detached_overflow_stops_generation():
+    async def run():
+        registry = StreamRegistry(grace=5, max_events=4)
+        produced = []
+        stream = registry.start('s', numbers(produced))
+
+        events = stream.events()
+        received = await events.__anext__()
+        await events.aclose()
+        await asyncio.sleep(0.2)
+        return produced, stream, registry, received
+
+    produced, stream, registry, received = asyncio.run(run())
+    assert stream.finished and len(produced) < 50
+    assert registry.stats()["expired"] == 1
+    assert registry.resume(received["id"]) is None
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+import pytest
+
+import session
+from session import MessageType
+from storage import FileSessionStorage
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    storage = FileSessionStorage(str(tmp_path / 'sessions'))
+    monkeypatch.setattr(session, 'session_storage', storage)
+    monkeypatch.setattr(session, 'message_cache', OrderedDict())
+    monkeypatch.setattr(session, 'MESSAGE_CACHE_MAX', 2)
+    return storage
+
+
+def test_message_cache_is_bounded(sessions):
+    session_ids = [session.create_new_session()[-1].id for _ in range(3)]
+    for session_id in session_ids:
+        session.update_message(session_id, MessageType(role='user', content=session_id))
+    assert list(session.message_cache) == session_ids[1:]
+    assert [message.content for message in session.get_messages(session_ids[0])] == [session_ids[0]]
+    assert list(session.message_cache) == [session_ids[2], session_ids[0]]
+
+
+# 没有缓存时追加消息只写日志，不回放已有的消息
+def test_append_does_not_read_log(sessions, monkeypatch):
+    session_id = session.create_new_session()[-1].id
+    for i in range(3):
+        session.update_message(session_id, MessageType(role='user', content=f'消息{i}'))
+    session.message_cache.clear()
+
+    def fail(session_id):
+        raise AssertionError('不应读取日志')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(sessions, 'iter_messages', fail)
+        session.append_message(session_id, MessageType(role='assistant', content='回复'))
+
+    assert [message.content for message in session.get_messages(session_id)] == ['消息0', '消息1', '消息2', '回复']
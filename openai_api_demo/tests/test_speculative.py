@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from engine import GenerationEngine
+from openai_api import ChatMessage
+from speculative import PromptLookupDrafter
+
+PASSAGE = "夜色渐深，山路上只剩下马蹄声。"
+
+
+def build_params(**kwargs) -> dict:
+    params = dict(
+        messages=[ChatMessage(role="user", content="请改写：" + PASSAGE * 3)],
+        temperature=0.0,
+        top_p=0.8,
+        max_tokens=48,
+        echo=False,
+        repetition_penalty=1.1,
+        functions=None,
+    )
+    params.update(kwargs)
+    return params
+
+
+def generate(model, tokenizer, drafter, params: dict) -> str:
+    engine = GenerationEngine(model, tokenizer, max_batch_size=1, drafter=drafter)
+    return asyncio.run(engine.generate(params))["text"]
+
+
+# 推测解码不改变贪心解码和指定 seed 的采样的输出
+@pytest.mark.parametrize("kwargs", [{}, {"temperature": 0.8, "top_p": 0.9, "seed": 7}])
+def test_speculative_matches_baseline(tiny, kwargs):
+    model, tokenizer = tiny
+    expected = generate(model, tokenizer, None, build_params(**kwargs))
+    assert generate(model, tokenizer, PromptLookupDrafter(), build_params(**kwargs)) == expected
@@ -0,0 +1,58 @@
+import pytest
+
+from storage import FileBookStorage, FileSessionStorage
+from sqlite_storage import SqliteBookStorage
+
+
+def book(book_id: str, chapter_ids) -> dict:
+    return {'id': book_id, 'title': book_id, 'chapters': [{'id': chapter_id} for chapter_id in chapter_ids]}
+
+
+# 事务中的多次写入只提交一次，出错时全部回滚
+def test_sqlite_transaction(tmp_path):
+    storage = SqliteBookStorage(str(tmp_path / 'writer.db'))
+    storage.init()
+    stamp = storage.stamp()
+
+    with storage.transaction():
+        storage.save_chapter('b1', {'id': 'c1', 'title': '第一章'})
+        storage.save_book(book('b1', ['c1']))
+    assert storage.stamp() == stamp + 1
+    assert [chapter['id'] for chapter in storage.load_book('b1')['chapters']] == ['c1']
+
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.save_book(book('b1', []))
+            storage.delete_chapter('b1', 'c1')
+            raise RuntimeError()
+    assert storage.stamp() == stamp + 1
+    assert [chapter['id'] for chapter in storage.load_book('b1')['chapters']] == ['c1']
+
+
+def test_file_transaction_touches_once(tmp_path):
+    storage = FileBookStorage(str(tmp_path / 'books'))
+    storage.init()
+    stamp = storage.stamp()
+
+    with storage.transaction():
+        storage.save_chapter('b1', {'id': 'c1', 'title': '第一章'})
+        storage.save_book(book('b1', ['c1']))
+        assert storage.stamp() == stamp
+    assert storage.stamp() > stamp
+    assert [chapter['id'] for chapter in storage.load_book('b1')['chapters']] == ['c1']
+
+
+# 消息按日志顺序逐条返回，删除的消息不返回，开始读取后的写入不影响本次读取
+def test_file_session_iter_messages(tmp_path):
+    storage = FileSessionStorage(str(tmp_path / 'sessions'))
+    storage.init()
+    for i in range(5):
+        storage.append_message('s', {'id': str(i), 'role': 'user', 'content': f'消息{i}'})
+    storage.delete_message('s', '1')
+    storage.delete_message('s', '3')
+
+    messages = storage.iter_messages('s')
+    storage.append_message('s', {'id': '5', 'role': 'user', 'content': '消息5'})
+    storage.compact('s')
+    assert [message['id'] for message in messages] == ['0', '2', '4']
+    assert [message['id'] for message in storage.iter_messages('s')] == ['0', '2', '4', '5']
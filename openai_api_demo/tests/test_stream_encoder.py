@@ -0,0 +1,33 @@
+import asyncio
+
+from stream_encoder import ChunkCoalescer, iterate_with_timeout
+
+
+async def tokens():
+    for text in ("一", "二"):
+        yield text
+    # 生成停顿
+    await asyncio.sleep(0.3)
+    yield "三"
+
+
+# 生成停顿时合并中的文本按时间发送，不等下一个 token
+def test_coalescer_flushes_when_idle():
+    async def run():
+        coalescer = ChunkCoalescer(window=0.05, max_chars=100)
+        loop = asyncio.get_running_loop()
+        chunks = []
+        async for text in iterate_with_timeout(tokens(), coalescer.delay):
+            if text is None:
+                chunks.append((coalescer.flush(), loop.time()))
+                continue
+            text = coalescer.add(text)
+            if text:
+                chunks.append((text, loop.time()))
+        assert coalescer.flush() is None
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert [text for text, _ in chunks] == ["一二", "三"]
+    # 第一个 chunk 在停顿期间发出
+    assert chunks[1][1] - chunks[0][1] > 0.2
@@ -0,0 +1,57 @@
+import pytest
+
+import writer
+from storage import FileBookStorage
+
+
+@pytest.fixture
+def books(tmp_path, monkeypatch):
+    storage = FileBookStorage(str(tmp_path / 'books'))
+    monkeypatch.setattr(writer, 'book_storage', storage)
+    monkeypatch.setattr(writer, 'book_cache', writer.BookCache(storage))
+    writer.create_books_dir()
+    return storage
+
+
+# 写操作替换缓存中的对象，读者已经拿到的书籍不会被修改
+def test_writes_do_not_mutate_shared_books(books):
+    book_id = writer.create_book()[0].id
+    writer.create_chapter(book_id, writer.ChapterType(title='第一章', content='旧内容'))
+    held = writer.get_book(book_id)
+    chapter_id = held.chapters[0].id
+
+    writer.update_chapter(book_id, chapter_id, writer.ChapterType(content='新内容'))
+    writer.create_chapter(book_id, writer.ChapterType(title='第二章'))
+    writer.update_book(book_id, writer.BookType(title='新书名2'))
+
+    assert held.title == '新书名'
+    assert [(chapter.title, chapter.content) for chapter in held.chapters] == [('第一章', '旧内容')]
+
+    book = writer.get_book(book_id)
+    assert book.title == '新书名2'
+    assert [(chapter.title, chapter.content) for chapter in book.chapters] == [('第一章', '新内容'), ('第二章', '')]
+
+    writer.delete_chapter(book_id, chapter_id)
+    assert [chapter.title for chapter in book.chapters] == ['第一章', '第二章']
+    assert [chapter.title for chapter in writer.get_book(book_id).chapters] == ['第二章']
+
+    # 重新从存储加载的结果与缓存一致
+    writer.book_cache.invalidate()
+    assert [chapter.title for chapter in writer.get_book(book_id).chapters] == ['第二章']
+
+
+# 其他进程刚写入的章节在写操作之前重新加载，不会被旧的缓存覆盖
+def test_write_reloads_changes_from_other_process(books):
+    book_id = writer.create_book()[0].id
+    writer.create_chapter(book_id, writer.ChapterType(title='第一章'))
+    writer.get_book(book_id)
+
+    # 另一个进程在检查间隔内新增了一个章节
+    other = writer.BookCache(books)
+    other_book = other.get(book_id)
+    books.save_chapter(book_id, {'id': 'c2', 'title': '第二章'})
+    books.save_book(dict(other_book.model_dump(), chapters=other_book.model_dump()['chapters'] + [{'id': 'c2'}]))
+
+    writer.create_chapter(book_id, writer.ChapterType(title='第三章'))
+    writer.book_cache.invalidate()
+    assert [chapter.title for chapter in writer.get_book(book_id).chapters] == ['第一章', '第二章', '第三章']
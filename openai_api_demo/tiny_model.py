@@ -0,0 +1,273 @@
+# 随机初始化的小模型、脚本化的 echo 模型和字节级分词器，用于在 CPU 上测试和压测推理服务，不需要下载 ChatGLM3-6B 权重
+import json
+import types
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import BatchEncoding
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+class TinyChatTokenizer:
+    """
+    字节级分词器，特殊 token 和 build_chat_input 的对话格式与 ChatGLM3 的分词器保持一致
+    """
+
+    SPECIAL_TOKENS = ["<pad>", "</s>", "[gMASK]", "sop", "<|system|>",
+                      "<|user|>", "<|assistant|>", "<|observation|>"]
+
+    def __init__(self):
+        self.special_tokens = {token: i for i,
+                               token in enumerate(self.SPECIAL_TOKENS)}
+        self.offset = len(self.SPECIAL_TOKENS)
+        self.vocab_size = self.offset + 256
+        self.pad_token_id = self.special_tokens["<pad>"]
+        self.eos_token_id = self.special_tokens["</s>"]
+
+    def get_command(self, token: str) -> int:
+        return self.special_tokens[token]
+
+    def encode(self, text: str) -> List[int]:
+        return [self.offset + b for b in text.encode("utf-8")]
+
+    def decode(self, token_ids: List[int]) -> str:
+        text, buffer = [], bytearray()
+        for token_id in token_ids:
+            if token_id >= self.offset:
+                buffer.append(token_id - self.offset)
+                continue
+            if buffer:
+                text.append(buffer.decode("utf-8", errors="replace"))
+                buffer = bytearray()
+            # 与 sentencepiece 一致，<pad> 和 </s> 解码为空
+            if token_id not in (self.pad_token_id, self.eos_token_id):
+                text.append(self.SPECIAL_TOKENS[token_id])
+        if buffer:
+            text.append(buffer.decode("utf-8", errors="replace"))
+        return "".join(text)
+
+    def build_single_message(self, role: str, metadata: str, message: str) -> List[int]:
+        return [self.get_command(f"<|{role}|>")] + self.encode(f"{metadata}\n") + self.encode(message)
+
+    def build_chat_input(self, query: str, history: Optional[List[dict]] = None, role: str = "user") -> BatchEncoding:
+        input_ids = [self.get_command("[gMASK]"), self.get_command("sop")]
+        for item in history or []:
+            content = item["content"]
+            if item["role"] == "system" and "tools" in item:
+                content = content + "\n" + \
+                    json.dumps(item["tools"], indent=4, ensure_ascii=False)
+            input_ids.extend(self.build_single_message(
+                item["role"], item.get("metadata", ""), content))
+        input_ids.extend(self.build_single_message(role, "", query))
+        input_ids.append(self.get_command("<|assistant|>"))
+        return BatchEncoding({
+            "input_ids": torch.tensor([input_ids], dtype=torch.long),
+            "attention_mask": torch.ones(1, len(input_ids), dtype=torch.long),
+            "position_ids": torch.arange(len(input_ids), dtype=torch.long).unsqueeze(0),
+        }, tensor_type="pt")
+
+
+@torch.inference_mode()
+def stream_generate(model, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                    position_ids: Optional[torch.Tensor] = None, past_key_values=None,
+                    max_new_tokens: Optional[int] = None, max_length: Optional[int] = None,
+                    do_sample: bool = True, top_p: float = 1.0, temperature: float = 1.0,
+                    repetition_penalty: float = 1.0, logits_processor=None, stopping_criteria=None,
+                    eos_token_id=None, return_past_key_values: bool = False, **kwargs):
+    """
+    与 ChatGLM3 的 model.stream_generate 行为一致：每步产生 [1, 输入长度 + 已生成长度] 的 token，
+    return_past_key_values 时同时返回 past_key_values，生成 eos 后结束
+    """
+    from engine import ModelRunner
+
+    runner = ModelRunner(model)
+    device = runner.device
+    layers = runner.unpack(past_key_values) if past_key_values is not None else None
+    past_length = runner.kv_length(layers)
+
+    input_ids = input_ids.to(device)
+    length = input_ids.shape[1]
+    if position_ids is None:
+        position_ids = torch.arange(past_length, past_length + length, device=device).unsqueeze(0)
+    if attention_mask is None or attention_mask.shape[1] < past_length + length:
+        attention_mask = torch.ones(1, past_length + length, dtype=torch.long, device=device)
+
+    if max_new_tokens is None:
+        max_new_tokens = (max_length or runner.seq_length) - past_length - length
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    eos_token_id = set(eos_token_id or [])
+
+    processors = LogitsProcessorList(logits_processor or [])
+    if repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if do_sample:
+        if temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        processors.append(TopKLogitsWarper(50))
+        if top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p))
+
+    current = input_ids
+    for _ in range(max_new_tokens):
+        logits, layers = runner.forward(current, attention_mask, position_ids.to(device), layers)
+        scores = processors(input_ids, logits[:, -1, :].float())
+        if do_sample:
+            next_token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+        else:
+            next_token = torch.argmax(scores, dim=-1, keepdim=True)
+        input_ids = torch.cat((input_ids, next_token), dim=-1)
+
+        yield (input_ids, runner.pack(layers)) if return_past_key_values else input_ids
+
+        if int(next_token[0, 0]) in eos_token_id:
+            break
+        if stopping_criteria is not None and stopping_criteria(input_ids, scores):
+            break
+        current = next_token
+        position_ids = position_ids[:, -1:] + 1
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones(1, 1)), dim=1)
+
+
+class EchoChatModel(torch.nn.Module):
+    """
+    脚本化的确定性模型，不做任何计算，用于测试和压测服务本身的开销
+
+    回复内容为最后一条消息的原文；system 中带有工具且消息里提到了工具名时，
+    按 ChatGLM3 的格式调用该工具，参数的值都为消息原文。
+    past_key_values 中保存的是 token id，因此也可以在连续批处理调度器中使用。
+    """
+
+    def __init__(self, tokenizer: TinyChatTokenizer, seq_length: int = 8192):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.config = types.SimpleNamespace(
+            model_type="echo", seq_length=seq_length, vocab_size=tokenizer.vocab_size)
+        self.replies: Dict[Tuple[int, ...], List[int]] = {}
+        self.register_buffer("dummy", torch.zeros(0), persistent=False)
+
+    @property
+    def device(self) -> torch.device:
+        return self.dummy.device
+
+    def _messages(self, prompt: List[int]) -> List[Tuple[str, str]]:
+        roles = {self.tokenizer.get_command(f"<|{role}|>"): role
+                 for role in ("system", "user", "assistant", "observation")}
+        messages, role, content = [], None, []
+        for token_id in prompt:
+            if token_id in roles:
+                if role is not None:
+                    messages.append((role, self.tokenizer.decode(content)))
+                role, content = roles[token_id], []
+            elif role is not None:
+                content.append(token_id)
+        return messages
+
+    def _tools(self, messages: List[Tuple[str, str]]) -> List[dict]:
+        for role, content in messages:
+            if role != "system":
+                continue
+            # 内容为 "\n" + 提示词 + "\n" + 工具的 JSON
+            parts = content.split("\n", 2)
+            if len(parts) == 3:
+                try:
+                    tools = json.loads(parts[2])
+                except ValueError:
+                    continue
+                return tools if isinstance(tools, list) else [tools]
+        return []
+
+    def reply(self, prompt: List[int]) -> List[int]:
+        key = tuple(prompt)
+        if key not in self.replies:
+            messages = self._messages(prompt)
+            query = messages[-1][1].split("\n", 1)[-1] if messages else ""
+            text, tail = "\n" + query, [self.tokenizer.eos_token_id]
+            for tool in self._tools(messages):
+                name = tool.get("name")
+                if name and name in query:
+                    required = tool.get("parameters", {}).get("required", [])
+                    arguments = ", ".join(f"{param}={query!r}" for param in required)
+                    text = f"{name}\n```python\ntool_call({arguments})\n```"
+                    tail = [self.tokenizer.get_command("<|observation|>")]
+                    break
+            if len(self.replies) > 4096:
+                self.replies.clear()
+            self.replies[key] = self.tokenizer.encode(text) + tail
+        return self.replies[key]
+
+    def _next_token(self, sequence: List[int]) -> int:
+        assistant = self.tokenizer.get_command("<|assistant|>")
+        start = len(sequence) - 1 - sequence[::-1].index(assistant) if assistant in sequence else len(sequence) - 1
+        reply = self.reply(sequence[:start + 1])
+        generated = len(sequence) - start - 1
+        return reply[generated] if generated < len(reply) else self.tokenizer.eos_token_id
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                position_ids: Optional[torch.Tensor] = None, past_key_values=None,
+                use_cache: bool = True, return_dict: bool = True, logits_to_keep: int = 0, **kwargs):
+        # KV 为 [batch, 1, seq, 1]，值为对应位置的 token id
+        if past_key_values is None:
+            past = input_ids.new_zeros(input_ids.shape[0], 0)
+        elif hasattr(past_key_values, "layers"):
+            past = past_key_values.layers[0].keys[:, 0, :, 0].long()
+        elif hasattr(past_key_values, "key_cache"):
+            past = past_key_values.key_cache[0][:, 0, :, 0].long()
+        else:
+            past = past_key_values[0][0][:, 0, :, 0].long()
+        tokens = torch.cat((past, input_ids), dim=1)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(tokens)
+
+        count = 1 if logits_to_keep == 1 else input_ids.shape[1]
+        logits = torch.zeros(tokens.shape[0], count, self.config.vocab_size, device=self.device)
+        rows, masks = tokens.tolist(), attention_mask.tolist()
+        for b in range(tokens.shape[0]):
+            sequence = [token for token, mask in zip(rows[b], masks[b]) if mask]
+            for i in range(count):
+                end = len(sequence) - (count - 1 - i)
+                logits[b, i, self._next_token(sequence[:end])] = 1e4
+
+        kv = tokens.float()[:, None, :, None]
+        return types.SimpleNamespace(logits=logits, past_key_values=((kv, kv),))
+
+    def stream_generate(self, input_ids: torch.Tensor, **kwargs):
+        return stream_generate(self, input_ids, **kwargs)
+
+
+def load_echo_model(seq_length: int = 8192, device: str = "cpu"):
+    tokenizer = TinyChatTokenizer()
+    return EchoChatModel(tokenizer, seq_length).to(device).eval(), tokenizer
+
+
+def load_tiny_model(seed: int = 0, hidden_size: int = 64, num_layers: int = 2, seq_length: int = 8192,
+                    device: str = "cpu"):
+    # GLM 结构的小模型，参数随机初始化
+    from transformers import GlmConfig, GlmForCausalLM
+
+    tokenizer = TinyChatTokenizer()
+    config = GlmConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=hidden_size // 4,
+        max_position_embeddings=seq_length,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.get_command("sop"),
+    )
+    # 与 ChatGLM3 的配置一样通过 seq_length 给出最大长度
+    config.seq_length = seq_length
+    torch.manual_seed(seed)
+    model = GlmForCausalLM(config).to(device).eval()
+    model.stream_generate = types.MethodType(stream_generate, model)
+    return model, tokenizer
@@ -1,12 +1,17 @@
 import os
 import gc
 import json
+import time
 import torch
+from loguru import logger
 from torch.nn import Module
 from transformers import PreTrainedModel, PreTrainedTokenizer
 from transformers import AutoModel
-from transformers.generation.logits_process import LogitsProcessor
-from typing import Dict, Union, Optional, Tuple
+from transformers.generation.logits_process import LogitsProcessor, RepetitionPenaltyLogitsProcessor
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from typing import Dict, List, Union, Optional, Tuple
+
+from metrics import STAGE_SECONDS
 
 
 def auto_configure_device_map(num_gpus: int) -> Dict[str, int]:
@@ -75,6 +80,167 @@ class InvalidScoreLogitsProcessor(LogitsProcessor):
         return scores
 
 
+class PrefixedLogitsProcessor(LogitsProcessor):
+    """
+    在 input_ids 前面接上没有输入模型的 token 再调用 processor
+
+    命中前缀缓存时模型只输入未缓存的部分，重复惩罚仍需要看到完整的 prompt，结果才与未命中时相同。
+    """
+
+    def __init__(self, prefix_ids: torch.LongTensor, processor: LogitsProcessor):
+        self.prefix_ids = prefix_ids
+        self.processor = processor
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.processor(torch.cat((self.prefix_ids, input_ids), dim=-1), scores)
+
+
+class AbortCriteria(StoppingCriteria):
+    """
+    客户端断开（cancelled 被设置）或超过截止时间（time.monotonic）时停止生成
+    """
+
+    def __init__(self, cancelled=None, deadline: Optional[float] = None):
+        self.cancelled = cancelled
+        self.deadline = deadline
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if self.cancelled is not None and self.cancelled.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+
+class IncrementalDetokenizer:
+    """
+    增量解码，每次只解码最近的几个 token，而不是整个输出
+
+    prefix_offset 到 read_offset 之间是已经输出过的 token，作为解码的上下文
+    （例如 sentencepiece 的前导空格依赖前一个 token），新文本是两次解码结果的差。
+    解码结果以 "�" 结尾说明 UTF-8 字符还不完整，等待后续 token。
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, prompt_ids: Optional[List[int]] = None):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = list(prompt_ids or [])
+        self.read_offset = len(self.token_ids)
+        self.prefix_offset = max(self.read_offset - 5, 0)
+        self.text = tokenizer.decode(self.token_ids) if self.token_ids else ""
+
+    def _decode_new(self, force: bool = False) -> str:
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or (new_text.endswith("�") and not force):
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    # 添加一个 token，返回新增的文本，没有完整的新字符时返回空字符串
+    def add(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        return self._decode_new()
+
+    # 生成结束时输出剩余的文本
+    def flush(self) -> str:
+        if self.read_offset == len(self.token_ids):
+            return ""
+        return self._decode_new(force=True)
+
+
+class StopStringMatcher:
+    """
+    流式停止词匹配（Aho–Corasick 自动机）
+
+    每次只处理新生成的字符；文本末尾可能是某个停止词开头的部分暂时保留，
+    确定不是停止词后再输出。命中停止词时 text 截断到停止词之前。
+    """
+
+    def __init__(self, stop_strings: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.depth: List[int] = [0]
+        # 以该状态结尾的最长停止词
+        self.output: List[Optional[str]] = [None]
+        for stop in stop_strings:
+            if stop:
+                self._insert(stop)
+        self._build()
+
+        self.state = 0
+        self.pending = ""
+        self.text = ""
+        self.matched: Optional[str] = None
+
+    def _insert(self, stop: str) -> None:
+        state = 0
+        for ch in stop:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.output.append(None)
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.output[state] = stop
+
+    def _build(self) -> None:
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+                queue.append(next_state)
+
+    # 处理新增的文本，返回命中的停止词
+    def feed(self, delta: str) -> Optional[str]:
+        if self.matched is not None:
+            return self.matched
+
+        for ch in delta:
+            state = self.state
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            self.state = self.goto[state].get(ch, 0)
+            self.pending += ch
+
+            stop = self.output[self.state]
+            if stop is not None:
+                self.text += self.pending[:len(self.pending) - len(stop)]
+                self.pending = ""
+                self.matched = stop
+                return stop
+
+        # 只保留可能是停止词开头的部分
+        keep = self.depth[self.state]
+        if len(self.pending) > keep:
+            self.text += self.pending[:len(self.pending) - keep]
+            self.pending = self.pending[len(self.pending) - keep:]
+        return None
+
+    # 生成结束时输出保留的文本
+    def flush(self) -> str:
+        pending, self.pending = self.pending, ""
+        if self.matched is None:
+            self.text += pending
+        return pending
+
+
+# 工具调用以 <|observation|> 结束，其余停止词来自请求的 stop 参数
+def get_stop_strings(params: dict) -> List[str]:
+    stop = params.get("stop") or []
+    if isinstance(stop, str):
+        stop = [stop]
+    return ["<|observation|>"] + [item for item in stop if item]
+
+
 def process_response(output: str, use_tool: bool = False) -> Union[str, dict]:
     content = ""
     for response in output.split("<|assistant|>"):
@@ -103,7 +269,7 @@ def process_response(output: str, use_tool: bool = False) -> Union[str, dict]:
 
 
 @torch.inference_mode()
-def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
+def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict, prefix_cache=None):
     messages = params["messages"]
     functions = params["functions"]
     temperature = float(params.get("temperature", 1.0))
@@ -114,13 +280,25 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     messages = process_chatglm_messages(messages, functions=functions)
     query, role = messages[-1]["content"], messages[-1]["role"]
 
-    inputs = tokenizer.build_chat_input(
-        query, history=messages[:-1], role=role)
-    inputs = inputs.to(model.device)
-    input_echo_len = len(inputs["input_ids"][0])
+    if params.get("prompt_ids"):
+        # 会话模式下已经拼好的输入
+        prompt_ids = list(params["prompt_ids"])
+        input_ids = torch.tensor([prompt_ids], dtype=torch.long, device=model.device)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "position_ids": torch.arange(len(prompt_ids), device=model.device).unsqueeze(0),
+        }
+    else:
+        with STAGE_SECONDS.time(stage="tokenize"):
+            inputs = tokenizer.build_chat_input(
+                query, history=messages[:-1], role=role)
+        inputs = inputs.to(model.device)
+        prompt_ids = inputs["input_ids"][0].tolist()
+    input_echo_len = len(prompt_ids)
 
     if input_echo_len >= model.config.seq_length:
-        print(f"Input length larger than {model.config.seq_length}")
+        logger.warning(f"Input length larger than {model.config.seq_length}")
 
     eos_token_id = [
         tokenizer.eos_token_id,
@@ -136,50 +314,125 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     }
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
-
-    total_len = 0
+        # 推理线程同时只生成一个请求，设置全局随机种子即可复现采样结果
+        if params.get("seed") is not None:
+            torch.manual_seed(int(params["seed"]))
+    # 每个解码步检查客户端是否断开、是否超过截止时间
+    if params.get("cancelled") is not None or params.get("deadline") is not None:
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([AbortCriteria(
+            params.get("cancelled"), params.get("deadline"))])
+
+    # 命中前缀缓存时只输入未缓存的 token，与 stream_chat 传入 past_key_values 的方式相同
+    input_len = input_echo_len
+    if prefix_cache is not None:
+        gen_kwargs["return_past_key_values"] = True
+        cached, layers = prefix_cache.match(prompt_ids)
+        if cached:
+            inputs["input_ids"] = inputs["input_ids"][:, cached:]
+            if "position_ids" in inputs:
+                inputs["position_ids"] = inputs["position_ids"][:, cached:]
+            else:
+                inputs["position_ids"] = torch.arange(
+                    cached, input_echo_len, device=model.device).unsqueeze(0)
+            inputs["attention_mask"] = torch.ones(
+                1, input_echo_len, dtype=torch.long, device=model.device)
+            gen_kwargs["past_key_values"] = prefix_cache.runner.pack(layers)
+            input_len = input_echo_len - cached
+            # stream_generate 的重复惩罚只看到输入的部分，改为在前面接上缓存的 prompt
+            if repetition_penalty != 1.0:
+                gen_kwargs["repetition_penalty"] = 1.0
+                gen_kwargs["logits_processor"].append(PrefixedLogitsProcessor(
+                    torch.tensor([prompt_ids[:cached]], dtype=torch.long, device=model.device),
+                    RepetitionPenaltyLogitsProcessor(repetition_penalty)))
+
+    # 每步只取新生成的 token，增量解码出新增的文本，只对新增的文本匹配停止词
+    detokenizer = IncrementalDetokenizer(
+        tokenizer, prompt_ids if echo else None)
+    stopper = StopStringMatcher(get_stop_strings(params))
+    if echo:
+        stopper.text = detokenizer.text
+    total_len, past_key_values, conversation_ids = input_len, None, None
+    # 第一个 token 之前的时间计为预填充，之后每个 token 的间隔计为一个解码步
+    step_start, stage = time.perf_counter(), "prefill"
     for total_ids in model.stream_generate(**inputs, eos_token_id=eos_token_id, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        if echo:
-            output_ids = total_ids[:-1]
-        else:
-            output_ids = total_ids[input_echo_len:-1]
-
-        response = tokenizer.decode(output_ids)
-        if response and response[-1] != "�":
-            response, stop_found = apply_stopping_strings(
-                response, ["<|observation|>"])
-
-            yield {
-                "text": response,
-                "usage": {
-                    "prompt_tokens": input_echo_len,
-                    "completion_tokens": total_len - input_echo_len,
-                    "total_tokens": total_len,
-                },
-                "finish_reason": "function_call" if stop_found else None,
-            }
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - step_start, stage=stage)
+        step_start, stage = now, "decode_step"
+        if prefix_cache is not None:
+            total_ids, past_key_values = total_ids
+            # 第一个 token 生成后 KV 已包含整个 prompt
+            if past_key_values is not None and total_len == input_len:
+                prefix_cache.insert(
+                    prompt_ids, prefix_cache.runner.unpack(past_key_values))
+        total_len = total_ids.shape[-1]
+        token_id = int(total_ids[0, -1])
+        if token_id in eos_token_id:
+            # 会话模式下保留整段对话（不含 eos）的 KV，下一轮只需预填充新消息
+            conversation_ids = prompt_ids + \
+                total_ids[0, input_len:-1].tolist()
+            if params.get("retain_kv") and past_key_values is not None:
+                prefix_cache.insert(
+                    conversation_ids, prefix_cache.runner.unpack(past_key_values))
+            break
+
+        start = time.perf_counter()
+        delta = detokenizer.add(token_id)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="detokenize")
+        if not delta:
+            continue
+
+        start = time.perf_counter()
+        stop = stopper.feed(delta)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="stop_check")
+        if stop is not None and stop != "<|observation|>":
+            break
 
-            if stop_found:
-                break
+        yield {
+            "text": stopper.text,
+            "usage": {
+                "prompt_tokens": input_echo_len,
+                "completion_tokens": total_len - input_len,
+                "total_tokens": input_echo_len + total_len - input_len,
+            },
+            "finish_reason": "function_call" if stop else None,
+        }
+
+        if stop:
+            break
+
+    if stopper.matched is None:
+        stopper.feed(detokenizer.flush())
+        stopper.flush()
+    response = stopper.text
 
     # Only last stream result contains finish_reason, we set finish_reason as stop
     ret = {
         "text": response,
         "usage": {
             "prompt_tokens": input_echo_len,
-            "completion_tokens": total_len - input_echo_len,
-            "total_tokens": total_len,
+            "completion_tokens": total_len - input_len,
+            "total_tokens": input_echo_len + total_len - input_len,
         },
         "finish_reason": "stop",
     }
+    if params.get("retain_kv"):
+        ret["token_ids"] = conversation_ids
     yield ret
 
     gc.collect()
     torch.cuda.empty_cache()
 
 
+# 会话的下一轮输入：在上一轮对话的 token 之后接上新消息，不重新编码历史消息
+def build_session_input(tokenizer: PreTrainedTokenizer, token_ids: List[int], messages) -> List[int]:
+    input_ids = list(token_ids)
+    for message in process_chatglm_messages(messages):
+        input_ids.extend(tokenizer.build_single_message(
+            message["role"], message.get("metadata", ""), message["content"]))
+    input_ids.append(tokenizer.get_command("<|assistant|>"))
+    return input_ids
+
+
 def process_chatglm_messages(messages, functions=None):
     _messages = messages
     messages = []
@@ -218,31 +471,7 @@ def process_chatglm_messages(messages, functions=None):
     return messages
 
 
-def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
-    for response in generate_stream_chatglm3(model, tokenizer, params):
+def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict, prefix_cache=None):
+    for response in generate_stream_chatglm3(model, tokenizer, params, prefix_cache):
         pass
     return response
-
-
-def apply_stopping_strings(reply, stop_strings) -> Tuple[str, bool]:
-    stop_found = False
-    for string in stop_strings:
-        idx = reply.find(string)
-        if idx != -1:
-            reply = reply[:idx]
-            stop_found = True
-            break
-
-    if not stop_found:
-        # If something like "\nYo" is generated just before "\nYou: is completed, trim it
-        for string in stop_strings:
-            for j in range(len(string) - 1, 0, -1):
-                if reply[-j:] == string[:j]:
-                    reply = reply[:-j]
-                    break
-            else:
-                continue
-
-            break
-
-    return reply, stop_found
@@ -2,10 +2,17 @@ from __future__ import unicode_literals
 import uuid
 import os
 import json
+import base64
+import bisect
 import datetime
+import threading
+import time
+from contextlib import contextmanager
 from click import prompt
 from pydantic import BaseModel
-from typing import List
+from typing import Any, Callable, List, Dict, Optional, Tuple
+
+from storage import BookStorage, create_book_storage
 
 
 class CharacterType(BaseModel):
@@ -64,6 +71,32 @@ class ChapterList(BaseModel):
     data: List[ChapterType] = []
 
 
+class BookSummaryType(BaseModel):
+    id: str = ""
+    novelType: str = ""
+    title: str = ""
+    cover: str = ""
+    chapterCount: int = 0
+    wordCount: int = 0
+    createdAt: str = ""
+
+
+class BookSummaryList(BaseModel):
+    success: bool = True
+    message: str = "success"
+    showType: str = "silent"
+    data: List[BookSummaryType] = []
+    nextCursor: Optional[str] = None
+
+
+# 只包含指定字段的章节列表
+class ChapterFieldList(BaseModel):
+    success: bool = True
+    message: str = "success"
+    showType: str = "silent"
+    data: List[Dict[str, Any]] = []
+
+
 class ChapterDetail(BaseModel):
     success: bool = True
     message: str = "success"
@@ -91,49 +124,192 @@ class NovelTypeList(BaseModel):
 
 BOOK_PATH = './books'
 
-
-# 创建书籍目录和配置文件
+# 缓存检查数据文件是否被其他进程修改的最小间隔（秒）
+BOOK_CACHE_CHECK_INTERVAL = float(
+    os.environ.get('BOOK_CACHE_CHECK_INTERVAL', '1.0'))
+
+
+class BookCache:
+    """
+    书籍的进程内写穿缓存
+
+    解析后的书籍按 id 保存，读操作不访问磁盘；写操作先写存储再更新缓存。
+    读者拿到的对象可能还在使用，写操作在深拷贝上修改，写入存储后再替换缓存中的对象，不修改已有的对象。
+    本进程的写入会递增 generation，存储的 stamp 变化（其他进程写入）时整体重新加载。
+    """
+
+    def __init__(self, storage: BookStorage, check_interval: float = BOOK_CACHE_CHECK_INTERVAL):
+        self.storage = storage
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.books: Dict[str, BookType] = {}
+        self.generation = 0
+        self.stamp: Optional[int] = None
+        self.checked_at = 0.0
+        # 由书籍数据计算出的结果（书籍列表、排序后的目录等），generation 变化后重新计算
+        self._derived: Dict[tuple, Tuple[int, Any]] = {}
+
+    def _load(self) -> None:
+        self.storage.init()
+        self.stamp = self.storage.stamp()
+        self.books = {item['id']: BookType(**item)
+                      for item in self.storage.load_books()}
+        self.generation += 1
+
+    # 距上次检查超过 check_interval 时才比较一次 stamp，force 时总是比较
+    def _ensure_fresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and self.stamp is not None and now - self.checked_at < self.check_interval:
+            return
+
+        self.checked_at = now
+        if self.stamp is None or self.storage.stamp() != self.stamp:
+            self._load()
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.stamp = None
+
+    def derived(self, key: tuple, build: Callable[[Dict[str, BookType]], Any]) -> Any:
+        with self.lock:
+            self._ensure_fresh()
+            cached = self._derived.get(key)
+            if cached is None or cached[0] != self.generation:
+                cached = (self.generation, build(self.books))
+                self._derived[key] = cached
+            return cached[1]
+
+    def list(self) -> List[BookType]:
+        return self.derived(('list',), lambda books: list(books.values()))
+
+    def get(self, book_id: str) -> BookType:
+        with self.lock:
+            self._ensure_fresh()
+            book = self.books.get(book_id)
+            if book is None:
+                raise Exception('书籍不存在')
+            return book
+
+    # 在锁内执行写操作，其中的存储写入在一个事务中提交，写入失败时丢弃缓存，下次读取重新加载
+    # 开始事务后总是比较 stamp，其他进程刚写入的数据先重新加载，不会被旧的缓存覆盖；
+    # SQLite 的写事务同时锁住其他进程，文件存储只能缩短检查与写入之间的间隔
+    @contextmanager
+    def writing(self):
+        with self.lock:
+            self.storage.init()
+            try:
+                with self.storage.transaction():
+                    self._ensure_fresh(force=True)
+                    yield self.books
+            except Exception:
+                self.stamp = None
+                raise
+            self.generation += 1
+            self.stamp = self.storage.stamp()
+
+
+book_storage = create_book_storage(BOOK_PATH)
+book_cache = BookCache(book_storage)
+
+
+# 初始化书籍存储，旧版的 config.json 会被迁移到当前的存储后端
 def create_books_dir() -> None:
-    config_file_path = os.path.join(BOOK_PATH, "config.json")
-    if (not os.path.exists(BOOK_PATH)) or (not os.path.exists(config_file_path)):
-        os.mkdir(BOOK_PATH)
-        with open(config_file_path, "w") as f:
-            f.write(json.dumps([]))
+    book_storage.init()
 
 
 def save_books(books: List[BookType]) -> bool:
-    # 保存到 config.json
-    config_file_path = os.path.join(BOOK_PATH, "config.json")
-    save_data = []
-    for book in books:
-        save_data.append(book.dict())
-
-    with open(config_file_path, "w") as f:
-        f.write(json.dumps(save_data, ensure_ascii=False, indent=4))
+    # 保存全部书籍，包括所有章节
+    create_books_dir()
+    with book_cache.writing() as cached:
+        for book in books:
+            for chapter in book.chapters:
+                book_storage.save_chapter(book.id, chapter.model_dump())
+            book_storage.save_book(book.model_dump())
+            cached[book.id] = book
 
     return True
 
 
 def get_books() -> List[BookType]:
     # 获取书籍列表
-    create_books_dir()
+    return book_cache.list()
 
-    # 读取 config.json 文件
-    config_file_path = os.path.join(BOOK_PATH, "config.json")
-    with open(config_file_path, "r") as f:
-        data = json.loads(f.read())
-        books: List[BookType] = [BookType(**item) for item in data]
 
-    return books
+def get_book(book_id: str) -> BookType:
+    return book_cache.get(book_id)
 
 
-def get_book(book_id: str) -> BookType:
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
+BOOK_SORT_FIELDS = ('createdAt', 'title', 'chapterCount', 'wordCount')
 
-    return book
+
+def _book_summary(book: BookType) -> BookSummaryType:
+    return BookSummaryType(
+        id=book.id,
+        novelType=book.novelType,
+        title=book.title,
+        cover=book.cover,
+        chapterCount=len(book.chapters),
+        wordCount=sum(len(chapter.content) for chapter in book.chapters),
+        createdAt=book.createdAt,
+    )
+
+
+def _encode_cursor(summary: BookSummaryType, sort: str) -> str:
+    data = json.dumps([getattr(summary, sort), summary.id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        value, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise Exception('无效的分页游标')
+    return value, book_id
+
+
+# 获取书籍目录（不含章节内容），按 (排序字段, id) 分页，cursor 为上一页最后一本书的位置
+def get_book_summaries(cursor: Optional[str] = None, limit: int = 20, sort: str = 'createdAt',
+                       order: str = 'desc') -> Tuple[List[BookSummaryType], Optional[str]]:
+    if sort not in BOOK_SORT_FIELDS:
+        raise Exception(f'不支持的排序字段: {sort}')
+    reverse = order == 'desc'
+
+    def build(books: Dict[str, BookType]) -> Tuple[List[BookSummaryType], list]:
+        summaries = sorted((_book_summary(book) for book in books.values()),
+                           key=lambda item: (getattr(item, sort), item.id), reverse=reverse)
+        # 用于二分查找的位置总是升序
+        keys = [(getattr(item, sort), item.id) for item in summaries]
+        if reverse:
+            keys.reverse()
+        return summaries, keys
+
+    summaries, keys = book_cache.derived(('summaries', sort, order), build)
+
+    start = 0
+    if cursor:
+        key = _decode_cursor(cursor)
+        if reverse:
+            start = len(keys) - bisect.bisect_left(keys, key)
+        else:
+            start = bisect.bisect_right(keys, key)
+
+    page = summaries[start:start + limit]
+    next_cursor = None
+    if page and start + limit < len(summaries):
+        next_cursor = _encode_cursor(page[-1], sort)
+
+    return page, next_cursor
+
+
+# 获取书籍的章节列表，只返回 fields 中的字段
+def get_chapter_fields(book_id: str, fields: List[str]) -> List[Dict[str, Any]]:
+    book = get_book(book_id)
+
+    invalid = [field for field in fields if field not in ChapterType.model_fields]
+    if invalid:
+        raise Exception(f'不支持的章节字段: {",".join(invalid)}')
+
+    return [{field: getattr(chapter, field) for field in fields} for chapter in book.chapters]
 
 
 def create_book() -> List[BookType]:
@@ -145,55 +321,54 @@ def create_book() -> List[BookType]:
     )
 
     # 添加书籍配置
-    books = get_books()
-    books.append(new_book)
+    with book_cache.writing() as cached:
+        book_storage.save_book(new_book.model_dump())
+        cached[new_book.id] = new_book
 
-    save_books(books)
-
-    return books
+    return get_books()
 
 
 # 更新书籍
 def update_book(book_id: str, new_config: BookType):
     # 更新书籍配置
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
-
-    # 更新书籍配置，如果没有传入则不更新
-    book.title = new_config.title or book.title
-    book.cover = new_config.cover or book.cover
-    book.description = new_config.description or book.description
-    book.summary = new_config.summary or book.summary
-    book.characters = new_config.characters or book.characters
-    book.chapters = new_config.chapters or book.chapters
-
-    save_books(books)
+    with book_cache.writing() as cached:
+        book = get_book(book_id).model_copy(deep=True)
+
+        # 更新书籍配置，如果没有传入则不更新
+        book.title = new_config.title or book.title
+        book.cover = new_config.cover or book.cover
+        book.description = new_config.description or book.description
+        book.summary = new_config.summary or book.summary
+        book.characters = new_config.characters or book.characters
+
+        # 传入了章节列表时整体替换章节，删除不再存在的章节文件
+        if new_config.chapters:
+            chapter_ids = [chapter.id for chapter in new_config.chapters]
+            for chapter in book.chapters:
+                if chapter.id not in chapter_ids:
+                    book_storage.delete_chapter(book_id, chapter.id)
+            for chapter in new_config.chapters:
+                book_storage.save_chapter(book_id, chapter.model_dump())
+            book.chapters = new_config.chapters
+
+        book_storage.save_book(book.model_dump())
+        cached[book_id] = book
 
     return book
 
 
 def delete_book(book_id: str) -> List[BookType]:
     # 删除书籍
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
-
-    books.remove(book)
-    save_books(books)
+    with book_cache.writing() as cached:
+        get_book(book_id)
+        book_storage.delete_book(book_id)
+        del cached[book_id]
 
-    return books
+    return get_books()
 
 
 # 新建章节
 def create_chapter(book_id: str, chapter: ChapterType) -> List[BookType]:
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
-
     newChapter = ChapterType(
         id=str(uuid.uuid4()),
         title=chapter.title or "新章节名",
@@ -202,18 +377,24 @@ def create_chapter(book_id: str, chapter: ChapterType) -> List[BookType]:
         paragraphs=chapter.paragraphs or [],
     )
 
-    book.chapters.append(newChapter)
+    with book_cache.writing() as cached:
+        book = get_book(book_id).model_copy(deep=True)
+        book.chapters.append(newChapter)
 
-    save_books(books)
+        # 先写章节，再更新书籍中的章节顺序
+        book_storage.save_chapter(book_id, newChapter.model_dump())
+        book_storage.save_book(book.model_dump())
+        cached[book_id] = book
 
-    return books
+    return get_books()
 
 
 # 获取章节详情
 def get_chapter(book_id: str, chapter_id: str) -> ChapterType:
     book = get_book(book_id)
 
-    chapter = next((item for item in book.chapters if item.id == chapter_id))
+    chapter = next(
+        (item for item in book.chapters if item.id == chapter_id), None)
     if not chapter:
         raise Exception('章节未找到')
 
@@ -222,65 +403,62 @@ def get_chapter(book_id: str, chapter_id: str) -> ChapterType:
 
 # 更新章节
 def update_chapter(book_id: str, chapter_id: str, chapter: ChapterType) -> List[BookType]:
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
-
-    oldChapter = next(
-        (item for item in book.chapters if item.id == chapter_id))
+    with book_cache.writing() as cached:
+        book = get_book(book_id).model_copy(deep=True)
+        oldChapter = next(
+            (item for item in book.chapters if item.id == chapter_id), None)
+        if not oldChapter:
+            raise Exception('章节未找到')
 
-    oldChapter.title = chapter.title or oldChapter.title
-    oldChapter.content = chapter.content or oldChapter.content
-    oldChapter.description = chapter.description or oldChapter.description
-    oldChapter.summary = chapter.summary or oldChapter.summary
-    oldChapter.paragraphs = chapter.paragraphs or []
+        oldChapter.title = chapter.title or oldChapter.title
+        oldChapter.content = chapter.content or oldChapter.content
+        oldChapter.description = chapter.description or oldChapter.description
+        oldChapter.summary = chapter.summary or oldChapter.summary
+        oldChapter.paragraphs = chapter.paragraphs or []
 
-    save_books(books)
+        # 只重写该章节
+        book_storage.save_chapter(book_id, oldChapter.model_dump())
+        cached[book_id] = book
 
-    return books
+    return get_books()
 
 
 # 删除章节
 def delete_chapter(book_id: str, chapter_id: str) -> List[BookType]:
-    books = get_books()
-    book = next((item for item in books if item.id == book_id))
-    if not book:
-        Exception('书籍不存在')
+    with book_cache.writing() as cached:
+        book = get_book(book_id).model_copy(deep=True)
 
-    chapter = next(
-        (item for item in book.chapters if item.id == chapter_id))
+        chapter = next(
+            (item for item in book.chapters if item.id == chapter_id), None)
+        if not chapter:
+            raise Exception('章节未找到')
 
-    book.chapters.remove(chapter)
-    save_books(books)
+        book.chapters.remove(chapter)
+        book_storage.save_book(book.model_dump())
+        book_storage.delete_chapter(book_id, chapter_id)
+        cached[book_id] = book
 
-    return books
+    return get_books()
 
 
 # 保存小说类型
 def save_novel_type(data: List[NovelType]) -> bool:
-    novel_type_file = os.path.join(BOOK_PATH, "novel_type.json")
+    create_books_dir()
 
     save_data = []
     for item in data:
-        save_data.append(item.dict())
+        save_data.append(item.model_dump())
 
-    with open(novel_type_file, "w") as f:
-        f.write(json.dumps(save_data, ensure_ascii=False, indent=4))
+    book_storage.save_novel_types(save_data)
 
     return True
 
 
 # 获取小说类型
 def get_novel_types() -> List[NovelType]:
-    novel_type_file = os.path.join(BOOK_PATH, "novel_type.json")
-
-    if not os.path.exists(novel_type_file):
-        return []
+    create_books_dir()
 
-    with open(novel_type_file, "r") as f:
-        data = json.loads(f.read())
-        return [NovelType(**item) for item in data]
+    return [NovelType(**item) for item in book_storage.load_novel_types()]
 
 
 # 创建小说类型
@@ -296,7 +474,8 @@ def create_novel_type(novel_type: NovelType) -> List[NovelType]:
 # 更新小说类型
 def update_novel_type(id: str, novel_type: NovelType) -> List[NovelType]:
     data = get_novel_types()
-    old_novel_type = next((item for item in data if item.label == id))
+    old_novel_type = next(
+        (item for item in data if item.label == id), None)
     if not old_novel_type:
         raise Exception('小说类型不存在')
 
@@ -310,7 +489,8 @@ def update_novel_type(id: str, novel_type: NovelType) -> List[NovelType]:
 # 删除小说类型
 def delete_novel_type(label: str) -> List[NovelType]:
     data = get_novel_types()
-    novel_type = next((item for item in data if item.label == label))
+    novel_type = next(
+        (item for item in data if item.label == label), None)
     if not novel_type:
         raise Exception('类型不存在')
 